@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""Measure the time spent walking and expanding a module, per 10k AST
+nodes.
+
+The module is generated with a number of functions, each using a quick
+lambda, so that every statement has to be walked. The quick lambdas can
+be nested, to show the cost of walking the output of nested macros.
+With ``--lazy-functions`` the expansion of the functions is deferred
+until their first call, which never happens here.
+
+Usage::
+
+  python benchmarks/expansion.py [--functions N] [--nesting N] [--repeat N]
+                                 [--lazy-functions]
+"""
+
+import argparse
+import ast
+import importlib
+import time
+
+import macropy.activate  # noqa: F401
+from macropy.core.macros import ModuleExpansionContext, detect_macros
+
+
+FUNCTION = '''
+def func_{0}(a, b):
+    values = [a + i * b for i in range(10) if i % 2]
+    total = sum(values) if values else {{'key': (a, b)}}
+    return list(map({1}, values)), total
+'''
+
+
+def make_source(functions, nesting=1):
+    quick_lambda = 'f[_ * 2]'
+    for i in range(nesting - 1):
+        quick_lambda = 'f[_ + %s(_)]' % quick_lambda
+    return ('from macropy.quick_lambda import macros, f\n' +
+            ''.join(FUNCTION.format(i, quick_lambda)
+                    for i in range(functions)))
+
+
+def measure(source, repeat, lazy_functions=False):
+    """Return the number of nodes of the module, the best time spent
+    expanding it, including the creation of the context, which computes
+    the injected vars, and the number of nodes visited."""
+    nodes = sum(1 for n in ast.walk(ast.parse(source)))
+    best = None
+    for i in range(repeat):
+        tree = ast.parse(source)
+        bindings = detect_macros(tree, 'bench', None, 'bench')
+        modules = [(importlib.import_module(mod), bind)
+                   for mod, bind in bindings]
+        start = time.perf_counter()
+        context = ModuleExpansionContext(tree, source, modules,
+                                         lazy_functions=lazy_functions)
+        context.expand_macros()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return nodes, best, getattr(context, 'visits', None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--functions', type=int, default=500)
+    parser.add_argument('--nesting', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--lazy-functions', action='store_true')
+    args = parser.parse_args()
+    nodes, best, visits = measure(make_source(args.functions, args.nesting),
+                                  args.repeat, args.lazy_functions)
+    print('%d nodes expanded in %.1f ms, %.1f ms per 10k nodes' % (
+        nodes, best * 1000, best * 1000 * 10000 / nodes))
+    if visits is not None:
+        print('%d node visits' % visits)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""Measure the work done by the import machinery for modules that don't
+use macros, with and without MacroPy's import hook.
+
+For each mode it imports a number of freshly generated modules and
+reports, per import, the calls to the path based finder, the ``stat``
+and ``listdir`` syscalls made by it and the time spent.
+
+Usage::
+
+  python benchmarks/import_overhead.py [--modules N]
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def measure(path, count, activate):
+    import importlib._bootstrap_external as external
+
+    if activate:
+        import macropy.activate  # noqa: F401
+
+    counts = {'find_spec': 0, 'stat': 0, 'listdir': 0}
+    path_stat = external._path_stat
+    os_module = external._os
+
+    class CountingOS(object):
+        def __getattr__(self, name):
+            return getattr(os_module, name)
+
+        def listdir(self, *args):
+            counts['listdir'] += 1
+            return os_module.listdir(*args)
+
+    def counting_stat(path):
+        counts['stat'] += 1
+        return path_stat(path)
+
+    find_spec = external.PathFinder.find_spec.__func__
+
+    def counting_find_spec(cls, *args, **kwargs):
+        counts['find_spec'] += 1
+        return find_spec(cls, *args, **kwargs)
+
+    sys.path.insert(0, path)
+    external._path_stat = counting_stat
+    external._os = CountingOS()
+    external.PathFinder.find_spec = classmethod(counting_find_spec)
+    start = time.perf_counter()
+    for i in range(count):
+        __import__('plain_module_%d' % i)
+    elapsed = time.perf_counter() - start
+    for key in counts:
+        counts[key] /= count
+    counts['usec'] = elapsed / count * 1e6
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modules', type=int, default=200)
+    parser.add_argument('--run', choices=['plain', 'macropy'])
+    parser.add_argument('--path')
+    args = parser.parse_args()
+
+    if args.run:
+        res = measure(args.path, args.modules, args.run == 'macropy')
+        print(' '.join('%s=%s' % item for item in sorted(res.items())))
+        return
+
+    path = tempfile.mkdtemp()
+    try:
+        for i in range(args.modules):
+            with open(os.path.join(path, 'plain_module_%d.py' % i),
+                      'w') as f:
+                f.write('"""No macros here."""\nvalue = %d\n' % i)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, PYTHONPATH=root)
+        print('Per import of a module without macros:')
+        for mode in ('plain', 'macropy'):
+            # every mode runs in a new interpreter, with cold caches
+            out = subprocess.check_output(
+                [sys.executable, __file__, '--run', mode, '--path', path,
+                 '--modules', str(args.modules)], env=env)
+            values = dict(item.split('=')
+                          for item in out.decode().split())
+            print('  %-8s finder calls: %4.1f  stat: %4.1f  listdir: %4.2f'
+                  '  time: %6.1f usec' % (
+                      mode, float(values['find_spec']),
+                      float(values['stat']), float(values['listdir']),
+                      float(values['usec'])))
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""Measure the memory retained after importing modules using macros,
+when the loaders release the artefacts of the expansion and when they
+retain them all.
+
+A number of modules is generated in a temporary directory, each with a
+number of functions using a quick lambda, and imported in a fresh
+process for each policy. The memory allocated and still alive after
+the imports is measured with ``tracemalloc``.
+
+Usage::
+
+  python benchmarks/memory.py [--modules N] [--functions N]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+
+FUNCTION = '''
+def func_{0}(a, b):
+    values = [a + i * b for i in range(10) if i % 2]
+    return list(map(f[_ * 2], values))
+'''
+
+SCRIPT = '''
+import gc, importlib, json, sys, tracemalloc
+import macropy.activate
+
+class RetainingExporter(macropy.core.exporters.NullExporter):
+    retain = {retain!r}
+
+macropy.exporter = RetainingExporter()
+tracemalloc.start()
+before = tracemalloc.get_traced_memory()[0]
+for i in range({modules}):
+    importlib.import_module('bench_mem_%d' % i)
+gc.collect()
+print(json.dumps(tracemalloc.get_traced_memory()[0] - before))
+'''
+
+POLICIES = [
+    ('release', ()),
+    ('retain tree', ('tree',)),
+    ('retain all', ('code', 'tree', 'source')),
+]
+
+
+def make_modules(path, modules, functions):
+    source = ('from macropy.quick_lambda import macros, f\n' +
+              ''.join(FUNCTION.format(i) for i in range(functions)))
+    for i in range(modules):
+        with open(os.path.join(path, 'bench_mem_%d.py' % i), 'w') as f:
+            f.write(source)
+
+
+def measure(path, modules, retain):
+    """Return the bytes still allocated after the imports, measured in a
+    new process."""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [path, os.path.join(os.path.dirname(__file__), os.pardir)]),
+        PYTHONDONTWRITEBYTECODE='1')
+    out = subprocess.check_output(
+        [sys.executable, '-c', SCRIPT.format(modules=modules,
+                                             retain=set(retain))], env=env)
+    return json.loads(out.decode().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modules', type=int, default=100)
+    parser.add_argument('--functions', type=int, default=20)
+    args = parser.parse_args()
+    path = tempfile.mkdtemp()
+    try:
+        make_modules(path, args.modules, args.functions)
+        results = [(name, measure(path, args.modules, retain))
+                   for name, retain in POLICIES]
+    finally:
+        shutil.rmtree(path)
+    baseline = results[0][1]
+    for name, size in results:
+        print('%-12s %8.1f KiB, %+.1f KiB per module' % (
+            name, size / 1024, (size - baseline) / 1024 / args.modules))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""Compare the structural operations of `macropy.core.structure` with
+the approaches they replace, on the tree of a module.
+
+- hashing: ``structural_hash()`` vs ``hash(ast.dump())``;
+- equality: ``structurally_equal()`` vs comparing the ``ast.dump()``
+  and the ``unparse()`` of the trees;
+- copying: ``clone()`` vs ``copy.deepcopy()``.
+
+Usage::
+
+  python benchmarks/structure.py [--module PATH] [--number N]
+"""
+
+import argparse
+import ast
+import copy
+import os
+import timeit
+
+from macropy.core import unparse
+from macropy.core.structure import clone, structural_hash, structurally_equal
+
+
+def measure(tree, number):
+    """Return a list of ``(operation, approach, seconds)`` tuples, the
+    seconds being the best time of a single run."""
+    other = clone(tree)
+    cases = [
+        ('hash', 'structural_hash', lambda: structural_hash(tree)),
+        ('hash', 'ast.dump', lambda: hash(ast.dump(tree))),
+        ('equality', 'structurally_equal',
+         lambda: structurally_equal(tree, other)),
+        ('equality', 'ast.dump', lambda: ast.dump(tree) == ast.dump(other)),
+        ('equality', 'unparse', lambda: unparse(tree) == unparse(other)),
+        ('copy', 'clone', lambda: clone(tree)),
+        ('copy', 'copy.deepcopy', lambda: copy.deepcopy(tree)),
+    ]
+    return [(operation, approach,
+             min(timeit.repeat(function, number=number, repeat=3)) / number)
+            for operation, approach, function in cases]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--module', default=os.path.join(
+        os.path.dirname(__file__), os.pardir, 'macropy', 'core',
+        'macros.py'), help='the module whose tree is used')
+    parser.add_argument('--number', type=int, default=10)
+    args = parser.parse_args()
+    with open(args.module) as f:
+        tree = ast.parse(f.read())
+    print('%d nodes' % sum(1 for n in ast.walk(tree)))
+    for operation, approach, seconds in measure(tree, args.number):
+        print('%-9s %-19s %8.2f ms' % (operation, approach, seconds * 1000))
+
+
+if __name__ == '__main__':
+    main()
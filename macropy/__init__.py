@@ -13,7 +13,7 @@ def activate():
 
     from .core import import_hooks
     import sys
-    sys.meta_path.insert(0, import_hooks.MacroFinder)
+    sys.meta_path.insert(0, import_hooks.finder)
     import macropy  # noqa
     from .core import hquotes  # noqa
     from .core import failure  # noqa
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""Expansion of the macros at build time, so that the distributed code
+doesn't need the import hook.
+
+With setuptools, use the `build_py`:class: command in ``setup.py``::
+
+  from macropy.build import build_py
+
+  setup(..., cmdclass={'build_py': build_py})
+
+Other build backends can call `expand_build_dir`:func: on the directory
+where the packages are staged, before it gets archived in a wheel.
+"""
+
+import importlib.util
+import logging
+import marshal
+import os
+import sys
+
+from setuptools.command import build_py as _build_py
+
+
+logger = logging.getLogger(__name__)
+
+
+MODES = ('source', 'bytecode')
+
+
+def sourceless_pyc(code):
+    """Return the contents of a sourceless ``.pyc`` file for ``code``."""
+    # the header contains the timestamp and size of the source, in
+    # Python 3.7 preceded by the flags, all unused here
+    padding = 12 if sys.version_info >= (3, 7) else 8
+    return importlib.util.MAGIC_NUMBER + b'\0' * padding + marshal.dumps(code)
+
+
+def expand_build_dir(build_dir, mode='source'):
+    """Expand in place the modules using macros in ``build_dir``, which
+    must be the root of the staged packages.
+
+    :param mode: with ``'source'`` every module is replaced with its
+      expanded source, with ``'bytecode'`` by a sourceless ``.pyc`` file
+    :returns: the list of the paths written
+    """
+    from . import compileall
+    from .core import unparse
+    import macropy.activate  # noqa: F401
+
+    if mode not in MODES:
+        raise ValueError('Invalid mode %r' % mode)
+    build_dir = os.path.abspath(build_dir)
+    sys.path.insert(0, build_dir)
+    written = []
+    try:
+        # expand everything before changing anything, as the macro
+        # modules may use macros too
+        expanded = []
+        for name, path in compileall.find_modules(build_dir):
+            with open(path, 'rb') as f:
+                data = f.read()
+            result = compileall.expand_source(name, path, data)
+            if result is not None:
+                expanded.append((path, result[0], result[1]))
+        for path, code, tree in expanded:
+            if mode == 'source':
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(unparse(tree))
+                written.append(path)
+            else:
+                os.unlink(path)
+                path += 'c'
+                with open(path, 'wb') as f:
+                    f.write(sourceless_pyc(code))
+                written.append(path)
+            logger.info('Expanded %s', path)
+    finally:
+        sys.path.remove(build_dir)
+    return written
+
+
+class build_py(_build_py.build_py):
+    """A ``build_py`` command that expands the macros of the built
+    modules."""
+
+    user_options = _build_py.build_py.user_options + [
+        ('macropy-mode=', None,
+         "how to write the expanded modules: 'source' (default) or "
+         "'bytecode'"),
+    ]
+
+    def initialize_options(self):
+        super().initialize_options()
+        self.macropy_mode = None
+        # the paths written by `expand_build_dir`:func:
+        self.macropy_written = []
+
+    def finalize_options(self):
+        super().finalize_options()
+        if self.macropy_mode is None:
+            self.macropy_mode = 'source'
+        if self.macropy_mode not in MODES:
+            from distutils.errors import DistutilsOptionError
+            raise DistutilsOptionError(
+                "macropy-mode must be one of %s" % ', '.join(MODES))
+
+    def run(self):
+        super().run()
+        self.macropy_written = expand_build_dir(self.build_lib,
+                                                self.macropy_mode)
+        if self.macropy_mode == 'bytecode':
+            # the bytecode compiled from the unexpanded sources, if any
+            for path in self._replaced_sources():
+                for cached in self._cached_bytecode(path):
+                    if os.path.exists(cached):
+                        os.unlink(cached)
+
+    def _replaced_sources(self):
+        """Return the sources replaced by sourceless ``.pyc`` files."""
+        if self.macropy_mode != 'bytecode':
+            return set()
+        return {path[:-1] for path in self.macropy_written}
+
+    @staticmethod
+    def _cached_bytecode(path):
+        return [importlib.util.cache_from_source(path, optimization=opt)
+                for opt in ('', 1, 2)]
+
+    def get_outputs(self, include_bytecode=1):
+        outputs = super().get_outputs(include_bytecode)
+        replaced = {os.path.abspath(path)
+                    for path in self._replaced_sources()}
+        if not replaced:
+            return outputs
+        stale = {cached for path in replaced
+                 for cached in self._cached_bytecode(path)}
+        new_outputs = []
+        for path in outputs:
+            full = os.path.abspath(path)
+            if full in replaced:
+                new_outputs.append(path + 'c')
+            elif full not in stale:
+                new_outputs.append(path)
+        return new_outputs
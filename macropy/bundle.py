@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""Bundles of pre-expanded modules, for deployments where the sources
+never change.
+
+A bundle is an uncompressed zip archive containing the marshalled code
+objects of the expanded modules and a ``manifest.json`` member with,
+for each of them, its source file, the digest of its source and the
+macro modules used to expand it. It's built with::
+
+  python -m macropy.bundle -o app.zip [-j JOBS] ROOT [ROOT...]
+
+where each ``ROOT`` is a directory of the import path, as for
+`macropy.compileall`:mod:. At runtime, `install`:func: puts a
+`BundleFinder`:class: in front of ``sys.meta_path``, which executes the
+bundled code objects reading them from the memory mapped archive,
+without reading the sources nor expanding anything. The expanded code
+still imports the macro modules, as regular modules.
+"""
+
+import argparse
+import binascii
+import importlib.machinery
+import json
+import logging
+import marshal
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import zipfile
+
+from .core import cache
+
+
+logger = logging.getLogger(__name__)
+
+
+MANIFEST = 'manifest.json'
+
+_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+
+
+def _data_offset(f, info):
+    """Return the offset of the data of the zip member ``info``."""
+    f.seek(info.header_offset)
+    header = _LOCAL_HEADER.unpack(f.read(_LOCAL_HEADER.size))
+    return info.header_offset + _LOCAL_HEADER.size + header[-2] + header[-1]
+
+
+def build(roots, output, jobs=None, report=print):
+    """Expand the modules using macros under ``roots`` and write them in
+    the bundle ``output``.
+
+    :returns: the results of `macropy.compileall.expand_all`:func:
+    """
+    from . import compileall
+
+    roots = [os.path.abspath(r) for r in roots]
+    tmp = tempfile.mkdtemp()
+    try:
+        args = ['--cache-dir', tmp, '-q', '-f'] + roots
+        if jobs:
+            args[:0] = ['-j', str(jobs)]
+        options = compileall.make_parser().parse_args(args)
+        results = compileall.expand_all(roots, options, report=report)
+        expanded = {r[0]: i for i, r in enumerate(results)
+                    if r[1] == 'expanded'}
+        entries = cache.ExpansionCache(tmp)
+        modules = {}
+        with zipfile.ZipFile(output, 'w', zipfile.ZIP_STORED) as zf:
+            for index, root in enumerate(roots):
+                for name, path in compileall.find_modules(root):
+                    if name not in expanded:
+                        continue
+                    with open(path, 'rb') as f:
+                        source = f.read()
+                    entry = entries.get(cache.entry_key(source, name))
+                    if entry is None:
+                        # e.g. the source changed while being expanded
+                        i = expanded[name]
+                        results[i] = (name, 'failed', results[i][2],
+                                      'no expanded code in the cache')
+                        compileall.report_result(results[i], options, report)
+                        continue
+                    deps, code = entry
+                    zf.writestr('code/' + name, marshal.dumps(code))
+                    modules[name] = {
+                        'root': index,
+                        'path': os.path.relpath(path, root),
+                        'is_package': os.path.basename(path) == '__init__.py',
+                        'source_digest': cache.digest(source),
+                        'deps': [list(d) for d in deps],
+                    }
+        with open(output, 'rb') as f, zipfile.ZipFile(output) as zf:
+            for name, module in modules.items():
+                info = zf.getinfo('code/' + name)
+                module['offset'] = _data_offset(f, info)
+                module['size'] = info.file_size
+        manifest = {
+            'magic': binascii.hexlify(cache.MAGIC).decode(),
+            'optimize': sys.flags.optimize,
+            'roots': roots,
+            'modules': modules,
+        }
+        with zipfile.ZipFile(output, 'a', zipfile.ZIP_STORED) as zf:
+            zf.writestr(MANIFEST, json.dumps(manifest, indent=1,
+                                             sort_keys=True))
+    finally:
+        shutil.rmtree(tmp)
+    return results
+
+
+class BundleFinder(object):
+    """A meta path finder, and loader, of the modules in a bundle.
+
+    The modules keep their original ``__file__``, but they're executed
+    from the bundled code without looking at their source, unless
+    ``check`` is true. In that case a module whose source has changed
+    is ignored, and imported as usual.
+
+    It doesn't provide ``get_source()``, so that the import hook never
+    expands a bundled module again, even when it comes first in
+    ``sys.meta_path``.
+
+    :param path: the path of the bundle
+    :param roots: the directories that contain the sources, defaults to
+      those the bundle was built from
+    :param check: whether to check that the sources are unchanged
+    """
+
+    def __init__(self, path, roots=None, check=False):
+        self.path = os.path.abspath(path)
+        with zipfile.ZipFile(self.path) as zf:
+            manifest = json.loads(zf.read(MANIFEST).decode('utf-8'))
+        if (manifest['magic'] != binascii.hexlify(cache.MAGIC).decode() or
+                manifest['optimize'] != sys.flags.optimize):
+            raise ImportError('Bundle %r was built by a different Python '
+                              'version or optimization level' % path,
+                              path=path)
+        self.roots = roots or manifest['roots']
+        self.modules = manifest['modules']
+        self.check = check
+        with open(self.path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def filename(self, fullname):
+        module = self.modules[fullname]
+        return os.path.join(self.roots[module['root']], module['path'])
+
+    def find_spec(self, fullname, path, target=None):
+        module = self.modules.get(fullname)
+        if module is None:
+            return None
+        filename = self.filename(fullname)
+        if self.check and (cache.file_digest(filename) !=
+                           module['source_digest']):
+            logger.info('Source of %r has changed, ignoring the bundle',
+                        fullname)
+            return None
+        spec = importlib.machinery.ModuleSpec(
+            fullname, self, origin=filename, is_package=module['is_package'])
+        spec.has_location = True
+        if module['is_package']:
+            spec.submodule_search_locations = [os.path.dirname(filename)]
+        return spec
+
+    def create_module(self, spec):
+        pass
+
+    def exec_module(self, module):
+        exec(self.get_code(module.__name__), module.__dict__)
+
+    def get_code(self, fullname):
+        module = self.modules[fullname]
+        offset = module['offset']
+        return marshal.loads(self.data[offset:offset + module['size']])
+
+    def get_filename(self, fullname):
+        return self.filename(fullname)
+
+    def is_package(self, fullname):
+        return self.modules[fullname]['is_package']
+
+
+def install(path, roots=None, check=False):
+    """Serve the modules in the bundle at ``path`` before any other
+    finder, see `BundleFinder`:class:.
+
+    :returns: the finder
+    """
+    finder = BundleFinder(path, roots, check)
+    sys.meta_path.insert(0, finder)
+    return finder
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m macropy.bundle',
+        description='Bundle the expanded modules using macros.')
+    parser.add_argument('roots', nargs='+', metavar='ROOT',
+                        help='a directory of the import path to scan')
+    parser.add_argument('-o', '--output', required=True,
+                        help='the bundle to write')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of worker processes (default: number '
+                        'of CPUs)')
+    options = parser.parse_args(args)
+    results = build(options.roots, options.output, options.jobs)
+    failed = sum(1 for r in results if r[1] == 'failed')
+    print('%d modules bundled in %s, %d failed' % (
+        sum(1 for r in results if r[1] == 'expanded'), options.output,
+        failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    # see macropy.compileall
+    from macropy.bundle import main as _main
+    sys.exit(_main())
@@ -243,10 +243,10 @@ def case_transform(tree, gen_sym, parents):
     return [tree] + ([assign] if len(outer) > 0 else [])
 
 
-@macros.decorator
-def case(tree, gen_sym, **kw):
+@macros.decorator(context=True)
+def case(ctx):
     """Macro providing an extremely concise way of declaring classes"""
-    x = case_transform(tree, gen_sym, [hq[CaseClass]])
+    x = case_transform(ctx.tree, ctx.gen_sym, [hq[CaseClass]])
 
     return x
 
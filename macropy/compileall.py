@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""Ahead-of-time expansion of the modules that use macros.
+
+This is similar to the standard library's ``compileall`` module: it
+walks the given directories, finds the modules importing macros and
+expands them in a pool of processes, storing the results in the
+expansion cache or as ``.pyc`` files, so that later imports don't need
+to expand them again. The
+directories must be roots of the import path, like the entries of
+``sys.path``: the name of each module is computed relative to them.
+
+Usage::
+
+  python -m macropy.compileall [-j JOBS] [--cache-dir DIR | --pycache]
+                               ROOT [ROOT...]
+"""
+
+import argparse
+import concurrent.futures
+import importlib.util
+import logging
+import os
+import sys
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+def find_modules(root):
+    """Find the modules that may use macros under the directory ``root``.
+
+    :param root: a directory that is (or will be) in ``sys.path``
+    :returns: a generator of ``(module_name, path)`` tuples
+    """
+    from .core.macros import has_macro_imports
+
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames
+                             if d.isidentifier() and d != '__pycache__')
+        rel = os.path.relpath(dirpath, root)
+        package = [] if rel == os.curdir else rel.split(os.sep)
+        for filename in sorted(filenames):
+            base, ext = os.path.splitext(filename)
+            if ext != '.py' or not base.isidentifier():
+                continue
+            path = os.path.join(dirpath, filename)
+            try:
+                with open(path, 'rb') as f:
+                    source = importlib.util.decode_source(f.read())
+            except (OSError, SyntaxError, UnicodeDecodeError):
+                continue
+            if not has_macro_imports(source):
+                continue
+            parts = package if base == '__init__' else package + [base]
+            if parts:
+                yield '.'.join(parts), path
+
+
+def make_exporter(options):
+    """Create the exporter used to store the expanded modules."""
+    from .core.exporters import CacheExporter, PycExporter
+    if options.pycache:
+        return PycExporter(check_source=not options.unchecked_hash)
+    return CacheExporter(options.cache_dir)
+
+
+def _add_roots(roots):
+    for root in reversed(roots):
+        if root not in sys.path:
+            sys.path.insert(0, root)
+
+
+_exporter = None
+
+
+def _setup(roots, options):
+    """Prepare a worker process to expand modules. The macro modules it
+    imports are stored with the same exporter."""
+    global _exporter
+    if _exporter is None:
+        _add_roots(roots)
+        import macropy.activate  # noqa: F401
+        import macropy
+        _exporter = macropy.exporter = make_exporter(options)
+        sys.dont_write_bytecode = False
+    return _exporter
+
+
+def expand_source(module_name, path, data):
+    """Expand the module ``module_name``, whose raw source ``data`` comes
+    from the file at ``path``. The macro modules are imported as usual.
+
+    :returns: a ``(code, tree, deps)`` tuple, or ``None`` if the module
+      doesn't use macros
+    """
+    from .core import cache
+    from .core.import_hooks import finder
+
+    is_package = os.path.basename(path) == '__init__.py'
+    spec = importlib.util.spec_from_file_location(
+        module_name, path, submodule_search_locations=(
+            [os.path.dirname(path)] if is_package else None))
+    code, tree, used = finder.expand_macros(
+        importlib.util.decode_source(data), path, spec)
+    if code is None:
+        return None
+    return code, tree, cache.dependencies(used)
+
+
+def expand_module(roots, options, module_name, path, exporter=None):
+    """Expand a single module, storing the result with the exporter.
+
+    :returns: a ``(module_name, status, seconds, error)`` tuple, where
+      status is one of ``'expanded'``, ``'cached'``, ``'nomacros'`` or
+      ``'failed'``
+    """
+    if exporter is None:
+        exporter = _setup(roots, options)
+
+    start = time.perf_counter()
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        if not options.force and exporter.find(module_name, path,
+                                               data) is not None:
+            return module_name, 'cached', time.perf_counter() - start, None
+        expanded = expand_source(module_name, path, data)
+        if expanded is None:
+            return (module_name, 'nomacros', time.perf_counter() - start,
+                    None)
+        code, tree, deps = expanded
+        exporter.export_transformed(code, tree, module_name, path,
+                                    source=data, deps=deps)
+    except Exception as e:
+        return (module_name, 'failed', time.perf_counter() - start,
+                '%s: %s' % (type(e).__name__, e))
+    return module_name, 'expanded', time.perf_counter() - start, None
+
+
+def expand_all(roots, options, report=print):
+    """Expand all the modules found under ``roots``, using
+    ``options.jobs`` processes.
+
+    :returns: the list of results of `expand_module`:func:
+    """
+    roots = [os.path.abspath(r) for r in roots]
+    todo = [(name, path) for root in roots
+            for name, path in find_modules(root)]
+    results = []
+    if options.jobs == 1:
+        _add_roots(roots)
+        import macropy.activate  # noqa: F401
+        import macropy
+        exporter = make_exporter(options)
+        old_exporter, macropy.exporter = macropy.exporter, exporter
+        dont_write_bytecode = sys.dont_write_bytecode
+        sys.dont_write_bytecode = False
+        try:
+            for name, path in todo:
+                results.append(expand_module(roots, options, name, path,
+                                             exporter))
+                report_result(results[-1], options, report)
+        finally:
+            macropy.exporter = old_exporter
+            sys.dont_write_bytecode = dont_write_bytecode
+    else:
+        with concurrent.futures.ProcessPoolExecutor(options.jobs) as pool:
+            futures = [pool.submit(expand_module, roots, options, name, path)
+                       for name, path in todo]
+            for future in concurrent.futures.as_completed(futures):
+                results.append(future.result())
+                report_result(results[-1], options, report)
+    return results
+
+
+def report_result(result, options, report):
+    module_name, status, seconds, error = result
+    if status == 'failed':
+        report('FAILED   %8.1f ms  %s: %s' % (seconds * 1000, module_name,
+                                              error))
+    elif not options.quiet:
+        report('%-8s %8.1f ms  %s' % (status, seconds * 1000, module_name))
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        prog='python -m macropy.compileall',
+        description='Expand ahead of time the modules using macros.')
+    parser.add_argument('roots', nargs='+', metavar='ROOT',
+                        help='a directory of the import path to scan')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='number of worker processes (default: number '
+                        'of CPUs)')
+    parser.add_argument('--cache-dir', default=None,
+                        help='the directory of the expansion cache')
+    parser.add_argument('--pycache', action='store_true',
+                        help='write hash-based .pyc files in __pycache__ '
+                        'instead of using the cache directory')
+    parser.add_argument('--unchecked-hash', action='store_true',
+                        help='with --pycache, write .pyc files that are '
+                        'used without checking their source')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='expand the modules even if already cached')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='report only failures')
+    return parser
+
+
+def main(args=None):
+    options = make_parser().parse_args(args)
+    start = time.perf_counter()
+    results = expand_all(options.roots, options)
+    failed = sum(1 for r in results if r[1] == 'failed')
+    print('%d modules (%d expanded, %d cached, %d failed) in %.2f s' % (
+        len(results), sum(1 for r in results if r[1] == 'expanded'),
+        sum(1 for r in results if r[1] == 'cached'), failed,
+        time.perf_counter() - start))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    # run the version imported as a module, so that the workers can
+    # unpickle the functions they're given
+    from macropy.compileall import main as _main
+    sys.exit(_main())
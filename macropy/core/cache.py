@@ -0,0 +1,596 @@
+# -*- coding: utf-8 -*-
+"""Persistent storage for macro-expanded code objects.
+
+Entries are addressed by a key computed from the raw source of the
+expanded module, its name and everything that influences the
+compilation (the interpreter's magic number, its optimization level
+and MacroPy's version). Each entry also records the macro modules that
+were used to expand it, so that a stale entry can be detected when one
+of them changes.
+
+The entries can be stored either in a directory or in a single SQLite
+database shared by many processes. It also contains a negative cache
+of the source files that don't use macros at all.
+"""
+
+import atexit
+import hashlib
+import importlib.util
+import logging
+import marshal
+import os
+import pickle
+import sys
+import tempfile
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+MAGIC = importlib.util.MAGIC_NUMBER
+
+
+def default_cache_dir():
+    """Return the directory used by default to store the cache entries,
+    honoring ``MACROPY_CACHE_DIR`` and ``XDG_CACHE_HOME``."""
+    path = os.environ.get('MACROPY_CACHE_DIR')
+    if path:
+        return path
+    base = os.environ.get('XDG_CACHE_HOME',
+                          os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'macropy')
+
+
+def digest(data):
+    """Hex digest of the given ``bytes``."""
+    return hashlib.sha1(data).hexdigest()
+
+
+def entry_key(source, module_name):
+    """Compute the key of the expanded version of a module.
+
+    :param source: the raw source of the module, as ``bytes``
+    :param module_name: the full name of the module
+    :returns: a string
+    """
+    import macropy
+    h = hashlib.sha1(MAGIC)
+    h.update(('%s\0%s\0%d\0' % (macropy.__version__, module_name,
+                                sys.flags.optimize)).encode('utf-8'))
+    h.update(source)
+    return h.hexdigest()
+
+
+def statement_key(source, module_name, bindings):
+    """Compute the key of the expanded version of a top-level statement,
+    see `StatementCache`:class:.
+
+    :param source: the source of the statement, as ``str``
+    :param module_name: the full name of its module
+    :param bindings: a string identifying the macros bound in the module
+    :returns: a string
+    """
+    import macropy
+    h = hashlib.sha1(MAGIC)
+    h.update(('%s\0%s\0%d\0statement\0%s\0' % (
+        macropy.__version__, module_name, sys.flags.optimize,
+        bindings)).encode('utf-8'))
+    h.update(source.encode('utf-8'))
+    return h.hexdigest()
+
+
+_file_digests = {}
+
+
+def file_digest(path):
+    """Return the digest of the contents of the file at ``path`` or
+    ``None`` if it cannot be read. The result is memoized as long as the
+    file's size and modification time don't change."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    stamp = (st.st_mtime_ns, st.st_size)
+    cached = _file_digests.get(path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    try:
+        with open(path, 'rb') as f:
+            value = digest(f.read())
+    except OSError:
+        return None
+    _file_digests[path] = (stamp, value)
+    return value
+
+
+def module_record(module_name):
+    """Return a ``(name, origin, digest)`` tuple identifying the current
+    version of an already imported module."""
+    mod = sys.modules.get(module_name)
+    origin = getattr(mod, '__file__', None) or ''
+    return (module_name, origin, origin and file_digest(origin) or '')
+
+
+def dependencies(module_names):
+    """Compute the records of the given macro modules and, transitively,
+    of the macro modules that were used to expand them.
+
+    :param module_names: the names of already imported modules
+    :returns: a tuple of ``(name, origin, digest)`` tuples
+    """
+    seen = set()
+    deps = []
+    for name in module_names:
+        mod = sys.modules.get(name)
+        # a module expanded by MacroPy has its own dependencies recorded
+        # on its loader
+        inherited = getattr(getattr(mod, '__loader__', None), 'deps', None)
+        for rec in tuple(inherited or ()) + (module_record(name),):
+            if rec[0] not in seen:
+                seen.add(rec[0])
+                deps.append(tuple(rec))
+    return tuple(deps)
+
+
+def stale_deps(deps):
+    """Return the ``(name, digest)`` tuples of the modules recorded in
+    ``deps`` that have changed, with their current digest."""
+    stale = []
+    for name, origin, value in deps:
+        if origin:
+            current = file_digest(origin)
+            if current != value:
+                logger.debug('Macro module %r has changed', name)
+                stale.append((name, current))
+    return stale
+
+
+def deps_current(deps):
+    """Check that all the modules recorded in ``deps`` are unchanged."""
+    return not stale_deps(deps)
+
+
+def dump_entry(code, deps):
+    """Serialize a code object together with its dependencies."""
+    return MAGIC + marshal.dumps((tuple(deps), code))
+
+
+def load_entry(data):
+    """Deserialize what was produced by `dump_entry`:func:, returning a
+    ``(deps, code)`` tuple or ``None`` if ``data`` is invalid."""
+    if data[:len(MAGIC)] != MAGIC:
+        return None
+    try:
+        deps, code = marshal.loads(data[len(MAGIC):])
+    except (EOFError, ValueError, TypeError):
+        return None
+    return deps, code
+
+
+def atomic_write(path, data):
+    """Write ``data`` to ``path`` so that readers never see a partially
+    written file."""
+    dirname = os.path.dirname(path)
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+class NegativeCache(object):
+    """Remembers the source files known not to use macros, keyed by their
+    path, modification time and size, so that they can be skipped
+    without reading them.
+
+    :param path: an optional file where the cache is persisted. It is
+      loaded at creation and saved when the interpreter exits (or when
+      `save`:meth: is called), merging the entries with those written in
+      the meantime by other processes
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        self.removed = set()
+        self.dirty = False
+        self._lock = threading.Lock()
+        if path is not None:
+            self.entries.update(self._load())
+            atexit.register(self.save)
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                entries = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+    @staticmethod
+    def _stamp(path):
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size)
+
+    def __contains__(self, path):
+        stamp = self.entries.get(path)
+        if stamp is None:
+            return False
+        try:
+            return self._stamp(path) == stamp
+        except OSError:
+            return False
+
+    def add(self, path):
+        """Record that the current version of the file at ``path`` doesn't
+        use macros."""
+        try:
+            stamp = self._stamp(path)
+        except OSError:
+            return
+        with self._lock:
+            self.entries[path] = stamp
+            self.removed.discard(path)
+            self.dirty = True
+
+    def discard(self, path):
+        with self._lock:
+            if self.entries.pop(path, None) is not None:
+                self.removed.add(path)
+                self.dirty = True
+
+    def save(self):
+        if self.path is None or not self.dirty:
+            return
+        entries = self._load()
+        with self._lock:
+            entries.update(self.entries)
+            for path in self.removed:
+                entries.pop(path, None)
+        try:
+            atomic_write(self.path, marshal.dumps(entries))
+        except OSError:
+            logger.exception('Cannot save the negative cache to %s',
+                             self.path)
+        else:
+            self.dirty = False
+
+
+class ExpansionCache(object):
+    """A directory of content-addressed expansion entries.
+
+    Besides the entries, the cache keeps a dependency index with a file
+    per macro module listing the entries that were expanded using it,
+    each with the digest the module had at that time. This allows to
+    drop exactly the entries that depend on an outdated version of a
+    macro module, see `invalidate`:meth:.
+
+    :param directory: where to store the entries, defaults to
+      `default_cache_dir`:func:
+    """
+
+    def __init__(self, directory=None):
+        self.directory = os.path.abspath(directory or default_cache_dir())
+
+    def path_for(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """Return the ``(deps, code)`` stored under ``key`` or ``None`` if
+        there's no valid entry for it."""
+        try:
+            with open(self.path_for(key), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        entry = load_entry(data)
+        if entry is None:
+            logger.debug('Discarding invalid cache entry %s', key)
+            self.discard(key)
+        return entry
+
+    def put(self, key, code, deps):
+        try:
+            atomic_write(self.path_for(key), dump_entry(code, deps))
+            for name, origin, value in deps:
+                self._add_dependent(name, key, value)
+        except OSError:
+            logger.exception('Cannot write cache entry %s', key)
+
+    def index_path_for(self, module_name):
+        return os.path.join(self.directory, 'deps',
+                            digest(module_name.encode('utf-8')))
+
+    def _add_dependent(self, module_name, key, value):
+        path = self.index_path_for(module_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # appends of a single short line are atomic, no need to lock
+        with open(path, 'a') as f:
+            f.write('%s %s\n' % (key, value))
+
+    def dependents(self, module_name):
+        """Return the ``(key, digest)`` tuples of the entries that were
+        expanded using the macro module ``module_name``."""
+        try:
+            with open(self.index_path_for(module_name)) as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return []
+        return [tuple(line.split(' ', 1)) for line in lines if ' ' in line]
+
+    def invalidate(self, module_name, current=None):
+        """Drop the entries that depend on the macro module
+        ``module_name``, except those expanded with the version of it
+        whose digest is ``current``.
+
+        :returns: the number of entries dropped
+        """
+        dependents = self.dependents(module_name)
+        keep = [(k, v) for k, v in dependents if current is not None
+                and v == current]
+        dropped = {k for k, v in dependents if (k, v) not in keep}
+        for key in dropped:
+            self.discard(key)
+        path = self.index_path_for(module_name)
+        try:
+            if keep:
+                atomic_write(path, ''.join('%s %s\n' % item
+                                           for item in keep).encode('ascii'))
+            else:
+                os.unlink(path)
+        except OSError:
+            pass
+        if dropped:
+            logger.info('Invalidated %d cache entries depending on %r',
+                        len(dropped), module_name)
+        return len(dropped)
+
+    def discard(self, key):
+        try:
+            os.unlink(self.path_for(key))
+        except OSError:
+            pass
+
+
+class StatementCache(object):
+    """Stores the expansion of single top-level statements, so that
+    only the statements that changed are expanded again when a module
+    is edited, see `~.incremental`:mod:.
+
+    The values are pickled and stored as the code of the entries of an
+    `ExpansionCache`:class: or a `SQLiteExpansionCache`:class:, which
+    track the macro modules they depend on as usual.
+
+    :param entries: the underlying cache
+    """
+
+    def __init__(self, entries):
+        self.entries = entries
+
+    def get(self, key):
+        """Return the value stored under ``key`` or ``None`` if there's no
+        valid entry for it."""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        deps, data = entry
+        stale = stale_deps(deps)
+        if stale:
+            for name, current in stale:
+                self.entries.invalidate(name, current)
+            self.entries.discard(key)
+            return None
+        try:
+            return pickle.loads(data)
+        except Exception:
+            logger.debug('Discarding invalid statement entry %s', key)
+            self.entries.discard(key)
+            return None
+
+    def put(self, key, value, deps):
+        """Store ``value``, unless it can't be pickled.
+
+        :returns: whether it has been stored
+        """
+        try:
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            logger.debug('Cannot pickle statement entry %s', key)
+            return False
+        self.entries.put(key, data, deps)
+        return True
+
+
+"""The statements creating the tables of a `SQLiteExpansionCache`:class:."""
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS entries (
+           key TEXT PRIMARY KEY, data BLOB NOT NULL)""",
+    """CREATE TABLE IF NOT EXISTS deps (
+           module TEXT NOT NULL, key TEXT NOT NULL,
+           digest TEXT NOT NULL, PRIMARY KEY (module, key))""",
+    """CREATE TABLE IF NOT EXISTS claims (
+           key TEXT PRIMARY KEY, pid INTEGER NOT NULL,
+           time REAL NOT NULL)""",
+)
+
+
+class SQLiteExpansionCache(object):
+    """An expansion cache stored in a single SQLite database, that can be
+    shared by many processes at once.
+
+    The database uses write-ahead logging, so that readers are never
+    blocked by a writer, and is memory mapped. Every write happens in a
+    transaction. Besides the same operations of
+    `ExpansionCache`:class:, it allows a process to *claim* the
+    expansion of an entry, so that the others can wait for it instead
+    of expanding the same module, see `claim`:meth:.
+
+    :param path: the database file, defaults to ``cache.sqlite`` in
+      `default_cache_dir`:func:
+    :param mmap_size: the number of bytes of the database to memory map
+    """
+
+    def __init__(self, path=None, mmap_size=256 * 1024 * 1024):
+        self.path = os.path.abspath(
+            path or os.path.join(default_cache_dir(), 'cache.sqlite'))
+        self.mmap_size = mmap_size
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    @property
+    def conn(self):
+        # connections must not be shared with forked processes
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = self._connect()
+            self._pid = os.getpid()
+        return self._conn
+
+    def _connect(self):
+        import sqlite3
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None,
+                               check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA mmap_size=%d' % self.mmap_size)
+        # create the schema holding the write lock, as processes starting
+        # at once would otherwise race on it; ``executescript()`` would
+        # commit the transaction first
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for statement in SCHEMA:
+                conn.execute(statement)
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return conn
+
+    def _transaction(self):
+        """Return a context manager running a write transaction."""
+        return _Transaction(self)
+
+    def get(self, key):
+        """Return the ``(deps, code)`` stored under ``key`` or ``None`` if
+        there's no valid entry for it."""
+        with self._lock:
+            row = self.conn.execute('SELECT data FROM entries WHERE key = ?',
+                                    (key,)).fetchone()
+        if row is None:
+            return None
+        entry = load_entry(row[0])
+        if entry is None:
+            logger.debug('Discarding invalid cache entry %s', key)
+            self.discard(key)
+        return entry
+
+    def put(self, key, code, deps):
+        """Store an entry and release the claim on it, if any."""
+        import sqlite3
+        try:
+            with self._transaction() as conn:
+                conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?)',
+                             (key, dump_entry(code, deps)))
+                conn.executemany(
+                    'INSERT OR REPLACE INTO deps VALUES (?, ?, ?)',
+                    [(name, key, value) for name, origin, value in deps])
+                conn.execute('DELETE FROM claims WHERE key = ?', (key,))
+        except sqlite3.Error:
+            logger.exception('Cannot write cache entry %s', key)
+
+    def claim(self, key, timeout):
+        """Try to become the process in charge of expanding the entry
+        ``key``. A claim older than ``timeout`` seconds is considered
+        abandoned.
+
+        :returns: ``True`` if the claim succeeded, ``False`` if another
+          process holds it or the entry is already there
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            if conn.execute('SELECT 1 FROM entries WHERE key = ?',
+                            (key,)).fetchone():
+                return False
+            row = conn.execute('SELECT pid, time FROM claims WHERE key = ?',
+                               (key,)).fetchone()
+            if (row is not None and row[0] != os.getpid() and
+                    now - row[1] < timeout):
+                return False
+            conn.execute('INSERT OR REPLACE INTO claims VALUES (?, ?, ?)',
+                         (key, os.getpid(), now))
+        return True
+
+    def release(self, key):
+        """Release the claim on the entry ``key`` without storing it."""
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM claims WHERE key = ? AND pid = ?',
+                         (key, os.getpid()))
+
+    def dependents(self, module_name):
+        """Return the ``(key, digest)`` tuples of the entries that were
+        expanded using the macro module ``module_name``."""
+        with self._lock:
+            return self.conn.execute(
+                'SELECT key, digest FROM deps WHERE module = ?',
+                (module_name,)).fetchall()
+
+    def invalidate(self, module_name, current=None):
+        """Drop the entries that depend on the macro module
+        ``module_name``, except those expanded with the version of it
+        whose digest is ``current``.
+
+        :returns: the number of entries dropped
+        """
+        with self._transaction() as conn:
+            keys = [k for k, in conn.execute(
+                'SELECT key FROM deps WHERE module = ? AND digest IS NOT ?',
+                (module_name, current))]
+            for key in keys:
+                self._delete(conn, key)
+        if keys:
+            logger.info('Invalidated %d cache entries depending on %r',
+                        len(keys), module_name)
+        return len(keys)
+
+    def discard(self, key):
+        with self._transaction() as conn:
+            self._delete(conn, key)
+
+    @staticmethod
+    def _delete(conn, key):
+        conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+        conn.execute('DELETE FROM deps WHERE key = ?', (key,))
+
+
+class _Transaction(object):
+    """An immediate transaction on a `SQLiteExpansionCache`:class:,
+    serialized with the other threads of the process."""
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def __enter__(self):
+        self.cache._lock.acquire()
+        try:
+            self.conn = self.cache.conn
+            self.conn.execute('BEGIN IMMEDIATE')
+        except BaseException:
+            self.cache._lock.release()
+            raise
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.conn.execute('ROLLBACK' if exc_type else 'COMMIT')
+        finally:
+            self.cache._lock.release()
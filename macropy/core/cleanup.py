@@ -5,13 +5,43 @@ to return."""
 import ast
 
 from .util import register
-from .macros import filters
+from .macros import filters, NodeFilter
 from .walkers import Walker
 
 
-@register(filters)
-def fix_ctx(tree, **kw):
-    return ast_ctx_fixer.recurse(tree, ctx=ast.Load())
+class FixCtx(NodeFilter):
+    """Fix any missing `ctx` attributes within an AST; allows you to build
+    your ASTs without caring about that stuff and just filling it in later.
+    """
+
+    node_types = (ast.Name, ast.Attribute, ast.Subscript, ast.Starred,
+                  ast.List, ast.Tuple, ast.AugAssign, ast.Assign, ast.Delete)
+
+    def start(self, **kw):
+        return ast.Load()
+
+    def visit(self, node, ctx):
+        if getattr(node, 'ctx', None) is None and 'ctx' in node._fields:
+            node.ctx = ctx
+        return node, ctx
+
+    def child_state(self, node, field, value, ctx):
+        node_type = type(node)
+        if node_type is ast.AugAssign and field == 'target':
+            return ast.AugStore()
+        if node_type is ast.Attribute and field == 'value':
+            return ast.Load()
+        if node_type is ast.Assign:
+            if field == 'targets':
+                return ast.Store()
+            if field == 'value':
+                return ast.Load()
+        if node_type is ast.Delete and field == 'targets':
+            return ast.Del()
+        return ctx
+
+
+fix_ctx = register(filters)(FixCtx())
 
 
 @Walker
@@ -37,32 +67,31 @@ def ast_ctx_fixer(tree, stop, set_ctx, set_ctx_for, **kw):
         set_ctx_for(tree.targets, ctx=ast.Del())
 
 
-@register(filters)
-def fill_line_numbers(tree, lineno, col_offset, **kw):
+class FillLineNumbers(NodeFilter):
     """Fill in line numbers somewhat more cleverly than the
     ast.fix_missing_locations method, which doesn't take into account the
     fact that line numbers are monotonically increasing down lists of AST
     nodes."""
-    if type(tree) is list:
-        for sub in tree:
-            if isinstance(sub, ast.AST) \
-                    and hasattr(sub, "lineno") \
-                    and hasattr(sub, "col_offset") \
-                    and (sub.lineno, sub.col_offset) > (lineno, col_offset):
-
-                lineno = sub.lineno
-                col_offset = sub.col_offset
-
-            fill_line_numbers(sub, lineno, col_offset)
-    elif isinstance(tree, ast.AST):
-        if not (hasattr(tree, "lineno") and hasattr(tree, "col_offset")):
-            tree.lineno = lineno
-            tree.col_offset = col_offset
-        for name, sub in ast.iter_fields(tree):
-            fill_line_numbers(sub, tree.lineno, tree.col_offset)
-    elif isinstance(tree, (str, int, float)) or tree is None:
-        pass
-    else:
-        raise TypeError("Invalid AST node '{!r}',  type: '{!r}' "
-                        "after expansion".format(tree, type(tree)))
-    return tree
+
+    def start(self, lineno, col_offset, **kw):
+        return (lineno, col_offset)
+
+    def visit(self, node, pos):
+        if not (hasattr(node, "lineno") and hasattr(node, "col_offset")):
+            node.lineno, node.col_offset = pos
+            return node, pos
+        return node, (node.lineno, node.col_offset)
+
+    def next_state(self, node, pos):
+        if (hasattr(node, "lineno") and hasattr(node, "col_offset") and
+            (node.lineno, node.col_offset) > pos):  # noqa: E129
+            return (node.lineno, node.col_offset)
+        return pos
+
+    def check_leaf(self, value):
+        if not (isinstance(value, (str, int, float)) or value is None):
+            raise TypeError("Invalid AST node '{!r}',  type: '{!r}' "
+                            "after expansion".format(value, type(value)))
+
+
+fill_line_numbers = register(filters)(FillLineNumbers())
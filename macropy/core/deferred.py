@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""Deferred expansion of the bodies of functions, until their first call.
+
+When a `~.macros.ModuleExpansionContext`:class: is created with
+``lazy_functions=True``, the body of each eligible function defined at
+the top level of the module is replaced by a stub, and only the rest
+of the module is expanded at import time. The first time the function
+is called, the stub reads the source of the module again, expands the
+original function and swaps its code in, so that later calls run the
+expanded code directly.
+
+A function is eligible when it's a plain ``def`` using macros only in
+its body, i.e. not in its decorators, defaults or annotations, and it
+isn't a generator. Methods, nested and ``async`` functions are always
+expanded at import time, as are the functions registered as injected
+vars, filters or post processing functions, and every function of the
+modules defining macros, which may be called while expanding others.
+"""
+
+import ast
+import hashlib
+import importlib
+import importlib.util
+import threading
+import types
+
+from . import compat
+from .gen_sym import collect_names
+
+
+"""The name of the `DeferredFunctions`:class: instance in the module."""
+REGISTRY_NAME = '__macropy_deferred__'
+
+
+"""The registries whose functions are called while expanding modules."""
+EXPANSION_REGISTRIES = frozenset(['injected_vars', 'filters',
+                                  'post_processing'])
+
+
+def _name_of(node):
+    if type(node) is ast.Name:
+        return node.id
+    if type(node) is ast.Attribute:
+        return node.attr
+    return None
+
+
+def defines_macros(tree):
+    """Tell whether the module ``tree`` defines macros, i.e. it assigns
+    a ``Macros()`` instance at the top level."""
+    return any(type(stmt) is ast.Assign and type(stmt.value) is ast.Call and
+               _name_of(stmt.value.func) == 'Macros' for stmt in tree.body)
+
+
+def _registered(stmt):
+    """Tell whether the function ``stmt`` is registered in one of the
+    `EXPANSION_REGISTRIES`:data:, e.g. with ``@register(filters)``."""
+    return any(type(dec) is ast.Call and
+               any(_name_of(arg) in EXPANSION_REGISTRIES for arg in dec.args)
+               for dec in stmt.decorator_list)
+
+
+def source_digest(src):
+    """Return the digest identifying the source of a module."""
+    return hashlib.sha1(src.encode('utf-8')).hexdigest()
+
+
+def deferrable(stmt, macro_free):
+    """Tell whether the expansion of the body of the top-level statement
+    ``stmt`` can be deferred.
+
+    :param macro_free: the result of `~.macros.macro_free_nodes`:func:
+      on the module's tree
+    :returns: the set of the names used in the function if it can be
+      deferred, ``None`` otherwise
+    """
+    if (type(stmt) is not ast.FunctionDef or
+            macro_free.get(id(stmt)) is stmt or _registered(stmt)):
+        return None
+    fixed = stmt.decorator_list + [stmt.args]
+    if stmt.returns is not None:
+        fixed.append(stmt.returns)
+    if any(macro_free.get(id(node)) is not node for node in fixed):
+        return None
+    names = set()
+    for child in stmt.body:
+        for node in ast.walk(child):
+            tnode = type(node)
+            if tnode is ast.Name:
+                names.add(node.id)
+            elif tnode is ast.Yield or tnode is ast.YieldFrom:
+                return None
+    return names | collect_names(stmt.args) | {stmt.name}
+
+
+def _stub_body(stmt):
+    """Return the body of the stub of the function ``stmt``, which
+    forwards its arguments to the expanded function."""
+    args = stmt.args
+    load = ast.Load()
+    forwarded = [ast.Name(a.arg, load) for a in
+                 getattr(args, 'posonlyargs', []) + args.args]
+    if args.vararg is not None:
+        forwarded.append(ast.Starred(ast.Name(args.vararg.arg, load), load))
+    keywords = [ast.keyword(a.arg, ast.Name(a.arg, load))
+                for a in args.kwonlyargs]
+    if args.kwarg is not None:
+        keywords.append(ast.keyword(None, ast.Name(args.kwarg.arg, load)))
+    expand = compat.Call(ast.Attribute(ast.Name(REGISTRY_NAME, load),
+                                       'expand', load),
+                         [ast.Num(stmt.lineno)], [])
+    first = stmt.body[0]
+    stub = ast.fix_missing_locations(ast.copy_location(
+        ast.Return(compat.Call(expand, forwarded, keywords)), first))
+    if (type(first) is ast.Expr and isinstance(first.value, ast.Str)):
+        # keep the docstring
+        return [first, stub]
+    return [stub]
+
+
+def defer_functions(context, tree):
+    """Replace the bodies of the eligible functions of the module ``tree``
+    with stubs.
+
+    :param context: the `~.macros.ModuleExpansionContext`:class:
+    :param tree: an ``ast.Module``
+    :returns: the statements creating the registry of the stubs, to be
+      put at the start of the expanded module, or an empty list if no
+      function has been deferred
+    """
+    if defines_macros(tree):
+        return []
+    reserved = set()
+    macro_free = context.macro_free
+    load = ast.Load()
+    for stmt in tree.body:
+        names = deferrable(stmt, macro_free)
+        if names is None:
+            continue
+        reserved |= names
+        stmt.body = _stub_body(stmt)
+        register = ast.fix_missing_locations(ast.copy_location(compat.Call(
+            ast.Attribute(ast.Name(REGISTRY_NAME, load), 'register', load),
+            [ast.Num(stmt.lineno)], []), stmt))
+        stmt.decorator_list.append(register)
+        # nothing left to expand in the stubs
+        for node in stmt.body + [register]:
+            macro_free[id(node)] = node
+    if not reserved:
+        return []
+    # the symbols generated for the rest of the module must not clash
+    # with the names used in the deferred bodies
+    context.file_vars['gen_sym'].reserve(reserved)
+    registry = ast.parse(
+        'from macropy.core.deferred import DeferredFunctions as {0}\n'
+        '{0} = {0}(globals(), {1!r})'.format(
+            REGISTRY_NAME, source_digest(context.src))).body
+    return [ast.fix_missing_locations(stmt) for stmt in registry]
+
+
+class DeferredFunctions(object):
+    """The functions of a module whose expansion has been deferred, see
+    `defer_functions`:func:.
+
+    :param module_globals: the namespace of the module
+    :param digest: the digest of the source the module was expanded from
+    """
+
+    def __init__(self, module_globals, digest):
+        self.globals = module_globals
+        self.digest = digest
+        self.functions = {}
+        self.expanded = set()
+        # the functions being expanded
+        self.expanding = set()
+        self._module = None
+        self._lock = threading.RLock()
+
+    def register(self, lineno):
+        """Return a decorator registering the stub of the function defined
+        at ``lineno``."""
+        def register(function):
+            self.functions[lineno] = function
+            return function
+        return register
+
+    def _parse_module(self):
+        """Return the filename, the source, the tree, the macro modules and
+        the names used in the module, read again from its source."""
+        if self._module is None:
+            from .import_hooks import finder
+            from .macros import detect_macros
+            spec = self.globals['__spec__']
+            spec = getattr(spec.loader, 'nomacro_spec', spec)
+            data = finder.get_source_bytes(spec)
+            src = data and importlib.util.decode_source(data)
+            if not src or source_digest(src) != self.digest:
+                raise ImportError('Cannot expand the functions of %s: its '
+                                  'source changed since it was imported' %
+                                  spec.name, name=spec.name)
+            tree = ast.parse(src)
+            bindings = detect_macros(tree, spec.name, spec.parent, spec.name,
+                                     src=src)
+            modules = [(importlib.import_module(mod), bind)
+                       for mod, bind in bindings]
+            self._module = (spec.origin, src, tree, modules,
+                            collect_names(tree))
+        return self._module
+
+    def expand(self, lineno):
+        """Expand the function defined at ``lineno``, if not already done,
+        and return it."""
+        function = self.functions[lineno]
+        with self._lock:
+            if lineno in self.expanding:
+                # called while expanding itself, e.g. by a post processing
+                # function: expand it eagerly, without post processing
+                function.__code__ = self._expand_code(lineno, eager=True)
+            elif lineno not in self.expanded:
+                self.expanding.add(lineno)
+                try:
+                    function.__code__ = self._expand_code(lineno)
+                finally:
+                    self.expanding.discard(lineno)
+                self.expanded.add(lineno)
+        return function
+
+    def _expand_code(self, lineno, eager=False):
+        from .macros import ModuleExpansionContext
+        filename, src, tree, modules, names = self._parse_module()
+        function_def = next(
+            stmt for stmt in tree.body
+            if type(stmt) is ast.FunctionDef and stmt.lineno == lineno)
+        context = ModuleExpansionContext(
+            ast.Module(body=[function_def], type_ignores=[]), src, modules)
+        if eager:
+            context.post_processing = ()
+        # the module's names, and those bound by the expansion of the
+        # functions deferred before this one
+        context.file_vars['gen_sym'].reserve(names | set(self.globals))
+        new_tree = context.expand_macros()
+        # post processing may add statements before the function
+        preamble, new_def = new_tree.body[:-1], new_tree.body[-1]
+        if preamble:
+            exec(compile(ast.Module(body=preamble, type_ignores=[]),
+                         filename, 'exec'), self.globals)
+        code = compile(ast.Module(body=[new_def], type_ignores=[]),
+                       filename, 'exec')
+        return next(const for const in code.co_consts
+                    if type(const) is types.CodeType and
+                    const.co_name == function_def.name)
@@ -8,6 +8,7 @@ import ast
 
 from . import unparse
 from .macros import injected_vars
+from .structure import structurally_equal
 from .util import Lazy, distinct, register
 from .walkers import Walker
 
@@ -44,6 +45,20 @@ _transforms = {
 }
 
 
+def _same_code(parsed, tree):
+    """Tell whether the module ``parsed`` contains the same code as
+    ``tree``."""
+    if isinstance(tree, ast.expr):
+        return (len(parsed.body) == 1 and
+                isinstance(parsed.body[0], ast.Expr) and
+                structurally_equal(parsed.body[0].value, tree, ctx=False))
+    if isinstance(tree, ast.stmt):
+        tree = [tree]
+    if isinstance(tree, list):
+        return structurally_equal(parsed.body, tree, ctx=False)
+    return unparse(parsed).strip() == unparse(tree).strip()
+
+
 @register(injected_vars)
 def exact_src(tree, src, **kw):
 
@@ -73,7 +88,7 @@ def exact_src(tree, src, **kw):
                 else:
                     x = prelim
                 parsed = ast.parse(x)
-                if unparse(parsed).strip() == unparse(tree).strip():
+                if _same_code(parsed, tree):
                     return prelim
 
             except SyntaxError as e:
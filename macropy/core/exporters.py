@@ -2,32 +2,26 @@
 """Ways of dealing with macro-expanded code, e.g. caching or
 re-serializing it."""
 
-import imp
+import hashlib
+import importlib.util
 import logging
 import marshal
 import os
 import shutil
+import sys
+import time
 
-from . import unparse
+from . import cache, unparse
 
 
 logger = logging.getLogger(__name__)
 
 
-def wr_long(f, x):
-    """Internal; write a 32-bit int to a file in little-endian order."""
-    f.write(chr( x        & 0xff))
-    f.write(chr((x >> 8)  & 0xff))
-    f.write(chr((x >> 16) & 0xff))
-    f.write(chr((x >> 24) & 0xff))
-
-
 class NullExporter(object):
-    def export_transformed(self, code, tree, module_name, file_name):
+    def export_transformed(self, code, tree, module_name, file_name, **kw):
         pass
 
-    def find(self, file_path, pathname, description, module_name,
-             package_path):
+    def find(self, module_name, file_name, source):
         pass
 
 
@@ -38,7 +32,7 @@ class SaveExporter(object):
         shutil.rmtree(self.directory, ignore_errors=True)
         shutil.copytree(self.root, directory)
 
-    def export_transformed(self, code, tree, module_name, file_name):
+    def export_transformed(self, code, tree, module_name, file_name, **kw):
 
         # do the export only if module's file_name is a subpath of the
         # root
@@ -54,40 +48,215 @@ class SaveExporter(object):
                 f.write(unparse(tree))
             logger.debug('Exported module %r to %r', file_name, new_path)
 
-    def find(self, file_path, pathname, description, module_name, package_path):
+    def find(self, module_name, file_name, source):
         pass
 
 
-suffix = __debug__ and 'c' or 'o'
+class CacheExporter(object):
+    """Stores the expanded code objects in a persistent
+    `~.cache.ExpansionCache`:class: and serves them back on later
+    imports, as long as neither the module's source nor any of the
+    macro modules used to expand it have changed.
+
+    With ``incremental``, it also stores the expansion of each top-level
+    statement, so that when a module changes only the statements that
+    changed are expanded again, see `~.incremental`:mod:.
+
+    :param directory: the cache directory, see
+      `~.cache.default_cache_dir`:func:
+    :param incremental: whether to store the expansion of the statements
+    """
+
+    """The `~.cache.StatementCache`:class: used to expand the modules, if
+    any."""
+    statement_cache = None
+
+    def __init__(self, directory=None, incremental=False):
+        self.cache = cache.ExpansionCache(directory)
+        if incremental:
+            self.statement_cache = cache.StatementCache(self.cache)
+
+    def export_transformed(self, code, tree, module_name, file_name,
+                           source=None, deps=(), **kw):
+        if source is None:
+            return
+        self.cache.put(cache.entry_key(source, module_name), code, deps)
+        logger.debug('Cached expansion of module %r', module_name)
+
+    def find(self, module_name, file_name, source):
+        found = self._get(cache.entry_key(source, module_name))
+        if found is not None:
+            logger.debug('Using cached expansion of module %r', module_name)
+        return found
+
+    def _get(self, key):
+        """Return the ``(code, deps)`` of the entry ``key``, if there's
+        one still valid."""
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        deps, code = entry
+        stale = cache.stale_deps(deps)
+        if stale:
+            # drop every entry expanded with the outdated macro modules,
+            # not just this one
+            for name, current in stale:
+                self.cache.invalidate(name, current)
+            self.cache.discard(key)
+            return None
+        return code, deps
+
+    def invalidate(self, module_name):
+        """Drop the cached expansions that depend on the current or past
+        versions of the macro module ``module_name``."""
+        return self.cache.invalidate(module_name)
+
+
+class SharedCacheExporter(CacheExporter):
+    """Like `CacheExporter`:class:, but stores the expanded code objects
+    in a single `~.cache.SQLiteExpansionCache`:class: that can be
+    shared by many processes starting at the same time, e.g. the
+    workers of an application server.
+
+    When a module isn't in the cache, the first process looking for it
+    claims its expansion, while the others wait for the result, up to
+    ``timeout`` seconds, before expanding it themselves.
+
+    :param path: the database file, see
+      `~.cache.SQLiteExpansionCache`:class:
+    :param timeout: how long to wait for another process' expansion
+    :param poll_interval: how often to check if it has completed
+    :param incremental: whether to store the expansion of the statements
+    """
+
+    def __init__(self, path=None, timeout=60, poll_interval=0.05,
+                 incremental=False):
+        self.cache = cache.SQLiteExpansionCache(path)
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        if incremental:
+            self.statement_cache = cache.StatementCache(self.cache)
+
+    def find(self, module_name, file_name, source):
+        key = cache.entry_key(source, module_name)
+        deadline = time.monotonic() + self.timeout
+        while True:
+            found = self._get(key)
+            if found is not None:
+                logger.debug('Using cached expansion of module %r',
+                             module_name)
+                return found
+            if self.cache.claim(key, self.timeout):
+                return None
+            if time.monotonic() >= deadline:
+                logger.warning('Timed out waiting for the expansion of '
+                               'module %r', module_name)
+                return None
+            time.sleep(self.poll_interval)
+
+    def abandon(self, module_name, file_name, source):
+        """Called when a module that wasn't found won't be exported, e.g.
+        because its expansion failed."""
+        self.cache.release(cache.entry_key(source, module_name))
+
+
+PYC_TAG = '%s-macropy' % sys.implementation.cache_tag
+"""The tag of the ``.pyc`` files written by `PycExporter`:class:, distinct
+from the interpreter's own one so that the two never collide."""
+
+FLAG_HASH_BASED = 0b01
+FLAG_CHECK_SOURCE = 0b10
+
+
+def source_hash(source):
+    """The 8 bytes hash of ``source`` stored in hash-based ``.pyc``
+    files."""
+    if hasattr(importlib.util, 'source_hash'):
+        return importlib.util.source_hash(source)
+    # before Python 3.7 there's no hash-based pyc, any stable hash will do
+    return hashlib.sha1(source).digest()[:8]
+
+
+def check_hash_based_pycs():
+    """Return the value of the interpreter's ``--check-hash-based-pycs``
+    option, one of ``'default'``, ``'always'`` or ``'never'``."""
+    try:
+        import _imp
+        return _imp.check_hash_based_pycs
+    except (ImportError, AttributeError):
+        return 'default'
 
 
 class PycExporter(object):
-    def __init__(self, root=os.getcwd()):
-        self.root = root
-
-    def export_transformed(self, code, tree, module_name, file_name):
-        """TODO: this needs to be updated, look into py_compile.compile, the
-        following code was copied verbatim from there on python2"""
-        f = open(file_name + suffix , 'wb')
-        f.write('\0\0\0\0')
-        timestamp = long(os.fstat(f.fileno()).st_mtime)
-        wr_long(f, timestamp)
-        marshal.dump(code, f)
-        f.flush()
-        f.seek(0, 0)
-        f.write(imp.get_magic())
-
-    def find(self, file_path, pathname, description, module_name, package_path):
+    """Writes the expanded modules as hash-based ``.pyc`` files (see
+    :pep:`552`) in the ``__pycache__`` directory beside their source,
+    tagged with `PYC_TAG`:data:, and loads them back on later imports.
+
+    Besides the code object, each file records the macro modules used to
+    expand it. A *checked* file is used only if the hash of the source
+    and the macro modules are unchanged, while an *unchecked* one is
+    always trusted, which fits read-only deployments where the files are
+    generated ahead of time, see `macropy.compileall`:mod:. As for the
+    interpreter's own files, the ``--check-hash-based-pycs`` option
+    overrides this.
+
+    :param check_source: whether to write checked files
+    """
+
+    def __init__(self, check_source=True):
+        self.check_source = check_source
+
+    @staticmethod
+    def pyc_path(file_name):
+        """Return the path of the ``.pyc`` of the source file
+        ``file_name``."""
+        head, tail = os.path.split(file_name)
+        base = tail.rpartition('.')[0] or tail
+        opt = sys.flags.optimize
+        name = '%s.%s%s.pyc' % (base, PYC_TAG, '.opt-%d' % opt if opt else '')
+        return os.path.join(head, '__pycache__', name)
+
+    def export_transformed(self, code, tree, module_name, file_name,
+                           source=None, deps=(), **kw):
+        if source is None or sys.dont_write_bytecode:
+            return
+        flags = FLAG_HASH_BASED
+        if self.check_source:
+            flags |= FLAG_CHECK_SOURCE
+        data = (cache.MAGIC + flags.to_bytes(4, 'little') +
+                source_hash(source) + marshal.dumps((tuple(deps), code)))
+        path = self.pyc_path(file_name)
         try:
-            file = open(file_path, 'rb')
-            f = open(file.name + suffix, 'rb')
-            py_time = os.fstat(file.fileno()).st_mtime
-            pyc_time = os.fstat(f.fileno()).st_mtime
+            cache.atomic_write(path, data)
+        except OSError:
+            logger.debug('Cannot write %r', path)
+        else:
+            logger.debug('Wrote %r', path)
 
-            if py_time > pyc_time:
-                return None
-            x = imp.load_compiled(module_name, pathname + suffix, f)
-            return x
-        except Exception as e:
-            # print(e)
-            raise
+    def find(self, module_name, file_name, source):
+        path = self.pyc_path(file_name)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        if len(data) < 16 or data[:4] != cache.MAGIC:
+            return None
+        flags = int.from_bytes(data[4:8], 'little')
+        if not flags & FLAG_HASH_BASED:
+            return None
+        mode = check_hash_based_pycs()
+        check = mode == 'always' or (mode == 'default' and
+                                     flags & FLAG_CHECK_SOURCE)
+        if check and data[8:16] != source_hash(source):
+            logger.debug('%r is outdated', path)
+            return None
+        try:
+            deps, code = marshal.loads(data[16:])
+        except (EOFError, ValueError, TypeError):
+            logger.debug('%r is invalid', path)
+            return None
+        if check and cache.stale_deps(deps):
+            return None
+        logger.debug('Using %r for module %r', path, module_name)
+        return code, deps
@@ -7,7 +7,24 @@ Exposes this functionality as the `gen_sym` function.
 
 import ast
 
-from . import compat, macros, util, walkers
+from . import compat, macros, util
+
+
+def collect_names(tree):
+    """Return the set of the names used or bound in ``tree``."""
+    names = set()
+    scope_nodes = compat.scope_nodes
+    for node in ast.walk(tree):
+        tnode = type(node)
+        if tnode is ast.Name:
+            names.add(node.id)
+        elif tnode is ast.arg:
+            names.add(node.arg)
+        elif tnode is ast.Import or tnode is ast.ImportFrom:
+            names.update(x.asname or x.name for x in node.names)
+        elif tnode in scope_nodes:
+            names.add(node.name)
+    return names
 
 
 @util.register(macros.injected_vars)
@@ -17,35 +34,36 @@ def gen_sym(tree, **kw):
     that they will not cause accidental shadowing, as long as the
     scope of the new symbol is limited to `tree` e.g. by a lambda
     expression or a function body
+
+    The generator records the symbols it has created in its
+    ``generated`` list, and its ``reserve(names)`` method excludes more
+    names, e.g. the ones created by a previous expansion.
     """
-    @walkers.Walker
-    def name_finder(tree, collect, **kw):
-        ttree = type(tree)
-        if ttree is ast.Name:
-            collect(tree.id)
-        elif ttree is ast.arg:
-            collect(tree.arg)
-        elif ttree is ast.Import:
-            names = [x.asname or x.name for x in tree.names]
-            for name in names:
-                collect(name)
-        elif ttree is ast.ImportFrom:
-            names = [x.asname or x.name for x in tree.names]
-            for name in names:
-                collect(name)
-        elif ttree in compat.scope_nodes:
-            collect(tree.name)
-
-    found_names = set(name_finder.collect(tree))
+    found_names = None
+    reserved = set()
 
     def name_for(name="sym"):
+        nonlocal found_names
+        if found_names is None:
+            # collected the first time a symbol is requested
+            found_names = collect_names(tree) | reserved
 
         if name not in found_names:
             found_names.add(name)
+            generated.append(name)
             return name
         offset = 1
         while name + str(offset) in found_names:
             offset += 1
         found_names.add(name + str(offset))
+        generated.append(name + str(offset))
         return name + str(offset)
+
+    def reserve(names):
+        reserved.update(names)
+        if found_names is not None:
+            found_names.update(names)
+
+    generated = name_for.generated = []
+    name_for.reserve = reserve
     return name_for
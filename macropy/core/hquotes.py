@@ -6,8 +6,8 @@ scope rather than their expansion scope.
 import ast
 import pickle
 
-from .macros import (Macros, check_annotated, filters, injected_vars,
-                     macro_stub, post_processing)
+from .macros import (Macros, NodeFilter, check_annotated, filters,
+                     injected_vars, macro_stub, post_processing)
 
 from .quotes import (macros, q, unquote_search, u, ast_list,   # noqa: F401
                      name, ast_literal)
@@ -40,11 +40,11 @@ def captured_registry(**kw):
 
 
 @register(post_processing)  # noqa: F811
-def post_proc(tree, captured_registry, gen_sym, **kw):
+def post_proc(tree, captured_registry, file_vars, **kw):
     if len(captured_registry) == 0:
         return tree
 
-    unpickle_name = gen_sym("unpickled")
+    unpickle_name = file_vars['gen_sym']("unpickled")
     with q as pickle_import:
         from pickle import _loads as x  # noqa: F401
 
@@ -67,43 +67,47 @@ def post_proc(tree, captured_registry, gen_sym, **kw):
     return tree
 
 
-@register(filters)
-def hygienate(tree, captured_registry, gen_sym, **kw):
-    # print('Hygienate %s' % ast.dump(tree) if isinstance(tree, ast.AST)
-    #       else tree, file=sys.stderr)
-    @Walker
-    def hygienator(tree, stop, **kw):
-        if type(tree) is Captured:
-            new_sym = [sym for val, sym in captured_registry
-                       if val is tree.val]
-            if not new_sym:
-                new_sym = gen_sym(tree.name)
-                captured_registry.append((tree.val, new_sym))
-            else:
-                new_sym = new_sym[0]
-            return ast.Name(new_sym, ast.Load())
-
-    return hygienator.recurse(tree)
-
-
-@macros.block
-def hq(tree, target, **kw):
-    tree = unquote_search.recurse(tree)
+class Hygienate(NodeFilter):
+    """Replace the captured values with names bound to them at runtime."""
+
+    node_types = (Captured,)
+
+    def start(self, captured_registry, file_vars, **kw):
+        return captured_registry, file_vars
+
+    def visit(self, node, state):
+        captured_registry, file_vars = state
+        new_sym = [sym for val, sym in captured_registry
+                   if val is node.val]
+        if not new_sym:
+            new_sym = file_vars['gen_sym'](node.name)
+            captured_registry.append((node.val, new_sym))
+        else:
+            new_sym = new_sym[0]
+        return ast.Name(new_sym, ast.Load()), state
+
+
+hygienate = register(filters)(Hygienate())
+
+
+@macros.block(context=True, pure=True)
+def hq(ctx):
+    tree = unquote_search.recurse(ctx.tree)
     tree = hygienator.recurse(tree)
     tree = ast_repr(tree)
     # print('Hquote block %s' % ast.dump(tree) if isinstance(tree, ast.AST)
     #       else tree, file=sys.stderr)
-    return [ast.Assign([target], tree)]
+    return [ast.Assign([ctx.target], tree)]
 
 
-@macros.expr  # noqa: F811
-def hq(tree, **kw):
+@macros.expr(context=True, pure=True)  # noqa: F811
+def hq(ctx):
     """Hygienic Quasiquote macro, used to quote sections of code while
     ensuring that names within the quoted code will refer to the value
     bound to that name when the code was quoted. Used together with
     the `u`, `name`, `ast`, `ast_list`, `unhygienic` unquotes.
     """
-    tree = unquote_search.recurse(tree)
+    tree = unquote_search.recurse(ctx.tree)
     # print('Hquote after search %s' % ast.dump(tree)
     #       if isinstance(tree, ast.AST) else tree, file=sys.stderr)
     tree = hygienator.recurse(tree)
@@ -4,15 +4,18 @@ MacroPy"""
 
 import ast
 import importlib
+import importlib.util
 from importlib.util import spec_from_loader
 import logging
+import os
 import sys
+import sysconfig
 
 import macropy.activate
 
 from . import macros  # noqa: F401
+from . import cache  # noqa: F401
 from . import exporters  # noqa: F401
-from .util import singleton
 
 
 logger = logging.getLogger(__name__)
@@ -32,25 +35,63 @@ class _MacroLoader(object):
 class MacroLoader:
     """Performs the real module loading in Python 3. the other is still
     there until the export stuff is fixed.
+
+    :param nomacro_spec: the spec of the module as found by the other finders
+    :param code: the code object of the expanded module
+    :param tree: the expanded tree, or ``None`` if ``code`` comes from the
+      exporter
+    :param source: the raw source of the module, as ``bytes``
+    :param deps: a sequence of ``(name, origin, digest)`` tuples identifying
+      the macro modules used during the expansion, including those used
+      to expand them
+
+    Once the module has been executed, the loader releases ``code``,
+    ``tree`` and ``source``, as it stays referenced by the module's spec
+    for the life of the process, except those named in the ``retain``
+    attribute of the exporter, if any, e.g. ``retain = {'tree'}``. The
+    ``deps`` are always kept, as they're inherited by the modules
+    expanded with the macros of this one.
     """
 
-    def __init__(self, nomacro_spec, code, tree):
+    """The attributes released after the execution of the module."""
+    artefacts = ('code', 'tree', 'source')
+
+    def __init__(self, nomacro_spec, code, tree, source=None, deps=()):
         self.nomacro_spec = nomacro_spec
         self.code = code
         self.tree = tree
+        self.source = source
+        self.deps = deps
 
     def create_module(self, spec):
         pass
 
     def exec_module(self, module):
-        exec(self.code, module.__dict__)
-        self.export()
+        if self.code is None:
+            raise ImportError('The code of %s has been released, import it '
+                              'again' % module.__name__, name=module.__name__)
+        # export before running the module, so that an exporter never
+        # waits for its execution, which may import other modules
+        if self.tree is not None:
+            self.export()
+        try:
+            exec(self.code, module.__dict__)
+        finally:
+            self.release()
+
+    def release(self):
+        """Drop the artefacts of the expansion that the exporter doesn't
+        ask to retain."""
+        retain = getattr(macropy.exporter, 'retain', ())
+        for name in self.artefacts:
+            if name not in retain:
+                setattr(self, name, None)
 
     def export(self):
         try:
             macropy.exporter.export_transformed(
                 self.code, self.tree, self.nomacro_spec.name,
-                self.nomacro_spec.origin)
+                self.nomacro_spec.origin, source=self.source, deps=self.deps)
         except Exception as e:
             raise
 
@@ -61,91 +102,264 @@ class MacroLoader:
         return self.nomacro_spec.loader.is_package(fullname)
 
 
-@singleton
+class PathPolicy(object):
+    """Decides which source files are worth looking at for macros.
+
+    Each path is matched against the ``include`` and ``exclude``
+    directories, the most specific one wins. When ``include`` is not
+    empty, the files outside of it are excluded. MacroPy's own package
+    is always included, as it needs its macros to work.
+
+    :param include: a sequence of directories whose modules are expanded
+    :param exclude: a sequence of directories whose modules are never
+      expanded, by default the standard library (but not the
+      ``site-packages`` directories it may contain)
+    """
+
+    def __init__(self, include=(), exclude=None):
+        roots = []
+        if exclude is None:
+            exclude = self.stdlib_paths()
+            if not include:
+                roots += [(self._normalize(p), True)
+                          for p in self.site_paths()]
+        own = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        roots += [(self._normalize(p), False) for p in exclude]
+        roots += [(self._normalize(p), True) for p in include]
+        roots.append((self._normalize(own), True))
+        # longest first, so the first matching root is the most specific
+        self.roots = sorted(roots, key=lambda r: len(r[0]), reverse=True)
+        self.default = not include
+        self._dirs = {}
+
+    @staticmethod
+    def stdlib_paths():
+        """The directories of the standard library."""
+        paths = sysconfig.get_paths()
+        return {paths[k] for k in ('stdlib', 'platstdlib') if k in paths}
+
+    @staticmethod
+    def site_paths():
+        """The directories where third party packages are installed."""
+        paths = sysconfig.get_paths()
+        return {paths[k] for k in ('purelib', 'platlib') if k in paths}
+
+    @staticmethod
+    def _normalize(path):
+        return os.path.join(os.path.normcase(os.path.abspath(path)), '')
+
+    def allows(self, filename):
+        dirname = os.path.dirname(filename)
+        allowed = self._dirs.get(dirname)
+        if allowed is None:
+            path = self._normalize(dirname)
+            for root, allowed in self.roots:
+                if path.startswith(root):
+                    break
+            else:
+                allowed = self.default
+            self._dirs[dirname] = allowed
+        return allowed
+
+
 class MacroFinder(object):
     """Loads a module and looks for macros inside, only providing a loader
     if it finds some.
+
+    Before reading a source file it consults its ``policy``, a
+    `PathPolicy`:class: instance, and its ``negative_cache``, a
+    `~.cache.NegativeCache`:class: instance, both of which can be
+    replaced to tune what gets looked at. When ``lazy_functions`` is
+    true, the expansion of the functions of the modules is deferred
+    until their first call, see `~.deferred`:mod:. The class attributes
+    are the defaults of every instance.
+
+    The finder installed by ``macropy.activate`` is `finder`:data:, but
+    others can be created, each expanding the modules with its own
+    `~.macros.ExpansionSession`:class:. Many threads can import modules
+    through the same finder at once.
+
+    :param session: the `~.macros.ExpansionSession`:class: used to
+      expand the modules, by default ``macros.default_session``
+    :param policy: a `PathPolicy`:class: for this instance
+    :param negative_cache: a `~.cache.NegativeCache`:class: for this
+      instance
     """
 
+    policy = PathPolicy()
+    negative_cache = cache.NegativeCache()
+    lazy_functions = False
+
+    def __init__(self, session=None, policy=None, negative_cache=None):
+        self.session = session
+        if policy is not None:
+            self.policy = policy
+        if negative_cache is not None:
+            self.negative_cache = negative_cache
+
+    def _skip_finder(self, finder):
+        # when testing with pytest, it installs a finder that for
+        # some yet unknown reasons makes macros expansion
+        # fail. For now it will just avoid using it and pass to
+        # the next one
+        return (isinstance(finder, MacroFinder) or
+                'pytest' in finder.__module__)
+
     def _find_spec_nomacro(self, fullname, path, target=None):
         """Try to find the original, non macro-expanded module using all the
         remaining meta_path finders. This one is installed by
         ``macropy.activate`` at index 0."""
         spec = None
         for finder in sys.meta_path:
-            # when testing with pytest, it installs a finder that for
-            # some yet unknown reasons makes macros expansion
-            # fail. For now it will just avoid using it and pass to
-            # the next one
-            if finder is self or 'pytest' in finder.__module__:
+            if self._skip_finder(finder):
                 continue
             if hasattr(finder, 'find_spec'):
                 spec = finder.find_spec(fullname, path, target=target)
-            elif hasattr(finder, 'load_module'):
-                spec = spec_from_loader(fullname, finder)
+            elif hasattr(finder, 'find_module'):
+                # legacy finders, like the vendoring one of setuptools
+                loader = finder.find_module(fullname, path)
+                if loader is not None:
+                    spec = spec_from_loader(fullname, loader)
             if spec is not None:
                 break
         return spec
 
+    def _decline(self, spec):
+        """Return the spec to use for a module without macros. It is the
+        one already found by the other finders, so that the import
+        machinery doesn't need to search for it again, unless one of
+        them was skipped and may want to handle the module."""
+        for finder in sys.meta_path:
+            if finder is not self and self._skip_finder(finder):
+                return None
+        return spec
+
+    def _no_macros(self, spec):
+        """Remember that the module described by ``spec`` doesn't use
+        macros."""
+        if spec.has_location:
+            self.negative_cache.add(spec.origin)
+
+    def _abandon(self, fullname, origin, data):
+        """Tell the exporter that the module it didn't find won't be
+        exported, so that it doesn't wait for it."""
+        abandon = getattr(macropy.exporter, 'abandon', None)
+        if abandon is not None:
+            abandon(fullname, origin, data)
+
     def expand_macros(self, source_code, filename, spec):
         """ Parses the source_code and expands the resulting ast.
-        Returns both the compiled ast and new ast.
-        If no macros are found, returns None, None."""
-        if not source_code or "macros" not in source_code:
-            return None, None
+        Returns the compiled ast, the new ast and the names of the macro
+        modules used. If no macros are found, returns None, None, None.
+
+        The macro modules whose macros are never used by the module are
+        neither imported nor imported by the compiled code."""
+        if not source_code or not macropy.core.macros.has_macro_imports(
+                source_code):
+            return None, None, None
 
         logger.info('Expand macros in %s', filename)
 
         tree = ast.parse(source_code)
+        statements = len(tree.body)
         bindings = macropy.core.macros.detect_macros(tree, spec.name,
                                                      spec.parent,
-                                                     spec.name)
+                                                     spec.name,
+                                                     src=source_code)
 
         if not bindings:
-            return None, None
+            if len(tree.body) == statements:
+                return None, None, None
+            # only unused macros were imported, nothing to expand
+            return compile(tree, filename, "exec"), tree, []
 
         modules = []
         for mod, bind in bindings:
             modules.append((importlib.import_module(mod), bind))
-        new_tree = macropy.core.macros.ModuleExpansionContext(
-            tree, source_code, modules).expand_macros()
+        context = macropy.core.macros.ModuleExpansionContext(
+            tree, source_code, modules, statement_cache=getattr(
+                macropy.exporter, 'statement_cache', None),
+            module_name=spec.name, lazy_functions=self.lazy_functions,
+            session=self.session)
+        new_tree = context.expand_macros()
+        logger.debug('Expanded %s visiting %d nodes, skipping %d', filename,
+                     context.visits, context.skipped)
         try:
-            return compile(tree, filename, "exec"), new_tree
+            return (compile(tree, filename, "exec"), new_tree,
+                    [mod for mod, bind in bindings])
         except Exception:
             logger.exception("Error while compiling file %s", filename)
             raise
 
+    def get_source_bytes(self, spec):
+        """Read the raw source of the module described by ``spec``."""
+        loader = spec.loader
+        if hasattr(loader, 'get_data') and spec.has_location:
+            return loader.get_data(spec.origin)
+        source = loader.get_source(spec.name)
+        return source.encode('utf-8') if source is not None else None
+
     def find_spec(self, fullname, path, target=None):
         spec = self._find_spec_nomacro(fullname, path, target)
-        if spec is None or not (hasattr(spec.loader, 'get_source') and
-            callable(spec.loader.get_source)):  # noqa: E128
+        if spec is None:
             if fullname != 'org':
                 # stdlib pickle.py at line 94 contains a ``from
                 # org.python.core for Jython which is always failing,
                 # of course
                 logging.debug('Failed finding spec for %s', fullname)
             return
+        macro_spec = self._find_macro_spec(fullname, spec)
+        if macro_spec is not None:
+            return macro_spec
+        return self._decline(spec)
+
+    def _find_macro_spec(self, fullname, spec):
+        """Return a spec using a `MacroLoader`:class: if the module described
+        by ``spec`` uses macros, ``None`` otherwise."""
+        if not (hasattr(spec.loader, 'get_source') and
+                callable(spec.loader.get_source)):
+            return
         origin = spec.origin
         if origin == 'builtin':
             return
-        # # try to find already exported module
-        # # TODO: are these the right arguments?
-        # # NOTE: This is a noop
-        # module = macropy.core.exporters.NullExporter().find(
-        #     file_path, file_path, "", module_name, package_path)
-        # if module:
-        #     return _MacroLoader(ast.mod)
+        if spec.has_location and (not self.policy.allows(origin) or
+                                  origin in self.negative_cache):
+            return
         try:
-            source = spec.loader.get_source(fullname)
-        except ImportError:
+            data = self.get_source_bytes(spec)
+        except (ImportError, OSError):
             logging.debug('Loader for %s was unable to find the sources',
                           fullname)
             return
         except Exception:
             logging.exception('Loader for %s raised an error', fullname)
             return
-        code, tree = self.expand_macros(source, origin, spec)
+        if not data or b"macros" not in data:
+            self._no_macros(spec)
+            return
+        source = importlib.util.decode_source(data)
+        if not macropy.core.macros.has_macro_imports(source):
+            self._no_macros(spec)
+            return
+        # try to find an already expanded version of the module
+        found = macropy.exporter.find(fullname, origin, data)
+        if found is not None:
+            code, deps = found
+            return spec_from_loader(fullname,
+                                    MacroLoader(spec, code, None, data, deps))
+        try:
+            code, tree, used = self.expand_macros(source, origin, spec)
+        except BaseException:
+            self._abandon(fullname, origin, data)
+            raise
         if not code:  # no macros!
+            self._abandon(fullname, origin, data)
+            self._no_macros(spec)
             return
-        loader = MacroLoader(spec, code, tree)
+        deps = cache.dependencies(used)
+        loader = MacroLoader(spec, code, tree, data, deps)
         return spec_from_loader(fullname, loader)
+
+
+"""The `MacroFinder`:class: installed by ``macropy.activate``."""
+finder = MacroFinder()
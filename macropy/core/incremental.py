@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""Incremental expansion of modules, one top-level statement at a time.
+
+When a `~.macros.ModuleExpansionContext`:class: is given a
+`~.cache.StatementCache`:class:, the expansion of each top-level
+statement using macros is stored under a key computed from its source,
+the name of the module and the macros bound in it. When the module is
+edited, the statements whose source is unchanged reuse their stored
+expansion, moved to their new line, and only the others are expanded
+again.
+
+The expansion of a statement can be stored only if its macros use no
+injected vars other than those that can be replayed, see
+`REPLAYABLE_VARS`:data:: the symbols it got from ``gen_sym`` are
+reserved again, and the values it captured with ``hq`` are registered
+again, so that they are restored by the module's post processing. A
+stored expansion is discarded when any of its symbols is now used
+elsewhere in the module.
+"""
+
+import logging
+
+from . import cache
+from .gen_sym import collect_names
+from .macros import _shift_positions
+
+
+logger = logging.getLogger(__name__)
+
+
+"""The injected vars whose effects can be replayed."""
+REPLAYABLE_VARS = frozenset(['gen_sym', 'captured_registry', 'exact_src'])
+
+
+def first_line(stmt):
+    """Return the first line of a statement, including its decorators."""
+    return min([stmt.lineno] + [d.lineno for d in
+                                getattr(stmt, 'decorator_list', ())])
+
+
+def statement_sources(body, src):
+    """Return the source of each statement of ``body``, which is the body
+    of a module parsed from ``src``, from its first line to its last.
+    Without an ``end_lineno``, the statement ends on the line before the
+    next statement starts. It's ``None`` for the statements sharing a
+    line with another one, whose source can't be told apart.
+    """
+    lines = src.splitlines(True)
+    starts = [first_line(stmt) for stmt in body]
+    ends = [start - 1 for start in starts[1:]] + [len(lines)]
+    sources = []
+    for i, stmt in enumerate(body):
+        start = starts[i]
+        end = getattr(stmt, 'end_lineno', None) or ends[i]
+        if (end < start or (i > 0 and body[i].col_offset > 0) or
+                (i + 1 < len(body) and body[i + 1].col_offset > 0)):
+            sources.append(None)
+        else:
+            sources.append(''.join(lines[start - 1:end]).rstrip())
+    return sources
+
+
+def bindings_key(bindings):
+    """Return a string identifying the macros bound in a module."""
+    return repr(sorted((mod.__name__, sorted(names))
+                       for mod, names in bindings))
+
+
+def expand_statements(context, tree):
+    """Expand the body of the module ``tree`` with ``context``, reusing
+    the expansions stored in its ``statement_cache``.
+
+    :param context: a `~.macros.ModuleExpansionContext`:class:
+    :param tree: an ``ast.Module``
+    :returns: the new body
+    """
+    statement_cache = context.statement_cache
+    file_vars = context.file_vars
+    body = tree.body
+    sources = statement_sources(body, context.src)
+    bindings = bindings_key(context.bindings)
+    if context.lazy_functions:
+        # the deferred functions are stored as stubs
+        bindings += ' lazy'
+    deps = cache.dependencies([mod.__name__ for mod, names
+                               in context.bindings])
+    # the names that the stored symbols must not clash with
+    names = collect_names(tree)
+    # first find the stored expansions and reserve their symbols, so that
+    # the statements expanded afterwards don't use them
+    entries = []
+    reserved = []
+    for stmt, source in zip(body, sources):
+        if source is None or context.macro_free.get(id(stmt)) is stmt:
+            entries.append(None)
+            continue
+        key = cache.statement_key(source, context.module_name, bindings)
+        entry = statement_cache.get(key)
+        if entry is not None and names.intersection(entry[2]):
+            entry = None
+        elif entry is not None:
+            names.update(entry[2])
+            reserved.extend(entry[2])
+        entries.append((key, entry))
+    if reserved:
+        file_vars['gen_sym'].reserve(reserved)
+    new_body = []
+    reused = 0
+    for stmt, found in zip(body, entries):
+        if found is None:
+            new_body.extend(_as_list(context.walk_tree(stmt)))
+            continue
+        key, entry = found
+        line = first_line(stmt)
+        if entry is None:
+            new_body.extend(_expand(context, stmt, key, line, deps))
+            continue
+        stored_line, stmts, symbols, captured = entry
+        if stored_line != line:
+            for new_stmt in stmts:
+                _shift_positions(new_stmt, line - stored_line, 0,
+                                 stored_line)
+        if captured:
+            file_vars['captured_registry'].extend(captured)
+        new_body.extend(stmts)
+        reused += 1
+    logger.debug('Reused the expansion of %d statements of %s', reused,
+                 context.module_name)
+    return new_body
+
+
+def _expand(context, stmt, key, line, deps):
+    """Expand a single statement, storing its expansion if possible."""
+    file_vars = context.file_vars
+    values = file_vars.values
+    symbols = len(values['gen_sym'].generated) if 'gen_sym' in values else 0
+    captured = len(values.get('captured_registry', ()))
+    file_vars.accessed = set()
+    stmts = _as_list(context.walk_tree(stmt))
+    symbols = (values['gen_sym'].generated[symbols:] if 'gen_sym' in values
+               else [])
+    if file_vars.accessed <= REPLAYABLE_VARS:
+        captured = values.get('captured_registry', [])[captured:]
+        context.statement_cache.put(key, (line, stmts, symbols, captured),
+                                    deps)
+    return stmts
+
+
+def _as_list(tree):
+    return tree if type(tree) is list else [tree]
@@ -4,12 +4,16 @@
 from abc import ABC, abstractmethod
 import ast
 import collections
+import collections.abc
 import functools
 import importlib
 import inspect
 import logging
+import re
+import threading
+import time
 
-from . import compat, real_repr, Captured, Literal
+from . import compat, real_repr, structure, Captured, Literal
 
 
 logger = logging.getLogger(__name__)
@@ -59,6 +63,204 @@ MacroData = collections.namedtuple('MacroData', ['macro', 'macro_tree',
                                                  'kwargs', 'name'])
 
 
+class MacroContext(object):
+    """The single argument received by the macros registered with
+    ``context=True``, e.g. ``@macros.expr(context=True)``, instead of
+    the keyword arguments. It has the same members: ``tree``, ``args``,
+    ``src``, ``expand_macros``, ``target`` (``None`` but for block
+    macros) and the injected vars, like ``gen_sym`` or ``exact_src``,
+    which are computed when first accessed.
+
+    :param file_vars: the `InjectedVars`:class: instance of the module
+    """
+
+    __slots__ = ('tree', 'args', 'src', 'expand_macros', 'target',
+                 'file_vars')
+
+    def __init__(self, tree, args, src, expand_macros, file_vars,
+                 target=None):
+        self.tree = tree
+        self.args = args
+        self.src = src
+        self.expand_macros = expand_macros
+        self.file_vars = file_vars
+        self.target = target
+
+    def __getattr__(self, name):
+        # only called for the names that aren't slots
+        try:
+            return self.file_vars[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+
+# how each macro function has to be called, by function: a ``(generator,
+# context, pure)`` tuple telling if it's a generator function, if it
+# takes a `MacroContext`:class: and if its output can be memoized
+_conventions = {}
+
+
+def calling_convention(function, context=None, pure=False):
+    """Return how ``function`` has to be called as a macro, as a
+    ``(generator, context, pure)`` tuple, caching it. Functions not
+    registered with ``context=True`` take keyword arguments.
+
+    :param function: a macro function
+    :param context: when not ``None``, record whether the function takes
+      a `MacroContext`:class: and whether it's ``pure``
+    :param pure: whether the output of the function depends only on its
+      ``tree``, ``args`` and ``target``, see `ExpansionMemo`:class:
+    """
+    convention = _conventions.get(function)
+    if convention is None or context is not None:
+        generator = inspect.isgeneratorfunction(function)
+        if pure and generator:
+            raise ValueError('The generator macro %r cannot be pure' %
+                             function.__name__)
+        convention = _conventions[function] = (
+            generator, bool(context), bool(pure))
+        if not context:
+            declared_parameters(function)
+    return convention
+
+
+def _shift_positions(tree, lines, columns, first_line):
+    """Move the nodes of ``tree`` down by ``lines``, and those on the
+    line ``first_line`` right by ``columns``."""
+    for node in ast.walk(tree):
+        lineno = getattr(node, 'lineno', None)
+        if lineno is not None:
+            if lineno == first_line:
+                node.col_offset += columns
+            node.lineno = lineno + lines
+        end_lineno = getattr(node, 'end_lineno', None)
+        if end_lineno is not None:
+            if end_lineno == first_line:
+                node.end_col_offset += columns
+            node.end_lineno = end_lineno + lines
+
+
+class ExpansionMemo(object):
+    """The outputs of the *pure* macros, those registered with
+    ``pure=True``, e.g. ``@macros.expr(pure=True)``, keyed by the macro
+    function and the structure of its input. When the same macro is
+    invoked again on an input with the same structure, a copy of the
+    previous output is used instead of calling it again, with the line
+    numbers moved to the new invocation.
+
+    A pure macro must not use the injected vars nor have side effects:
+    e.g. ``q`` and ``hq`` are pure, ``f`` isn't as it uses ``gen_sym``.
+    The memo can be used by many threads at once.
+
+    :param maxsize: the number of outputs kept, the least recently used
+      are dropped
+    """
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(function, tree, args, kwargs):
+        """Return the key of an invocation, or ``None`` if its input
+        can't be hashed."""
+        key = (function, structure.structure_key(tree),
+               structure.structure_key(list(args)),
+               tuple((k, structure.structure_key(v))
+                     for k, v in sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def get(self, key, lineno, col_offset):
+        """Return a copy of the output stored with ``key``, positioned
+        at ``lineno`` and ``col_offset``, or ``None``."""
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        tree, first_line, first_col = entry
+        tree = structure.clone(tree)
+        if (lineno, col_offset) != (first_line, first_col):
+            _shift_positions(tree, lineno - first_line,
+                             col_offset - first_col, first_line)
+        return tree
+
+    def put(self, key, tree, lineno, col_offset):
+        """Store a copy of the output ``tree`` of the invocation at
+        ``lineno`` and ``col_offset``."""
+        try:
+            tree = structure.clone(tree)
+        except Exception:
+            return
+        with self._lock:
+            self.entries[key] = (tree, lineno, col_offset)
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+
+"""The `ExpansionMemo`:class: used by the expansion."""
+expansion_memo = ExpansionMemo()
+
+
+class MacroExpansionLimitError(Exception):
+    """Raised when the expansion of a module exceeds one of its
+    `ExpansionLimits`:class:. Unlike the other errors raised while
+    expanding a macro, it isn't deferred to the execution of the
+    module: the import fails.
+
+    :param name: the name of the macro being expanded
+    :param lineno: the line of its invocation
+    :param message: what has been exceeded
+    """
+
+    def __init__(self, name, lineno, message):
+        super().__init__('Expanding macro %r at line %s: %s' % (
+            name, lineno, message))
+        self.name = name
+        self.lineno = lineno
+
+
+class ExpansionLimits(object):
+    """Bounds on the work done to expand a module, to turn a runaway
+    expansion, e.g. a macro whose output contains itself, into a
+    `MacroExpansionLimitError`:class:. ``None`` means no limit.
+
+    :param max_depth: the maximum number of macro invocations found in
+      the output of another one, one inside the other, e.g. a macro
+      outputting its own invocation again and again. The invocations
+      nested in the source, and expanded with the body of the
+      enclosing one, aren't counted
+    :param max_nodes: the maximum number of nodes walked while expanding
+      a module, which includes all the nodes output by its macros
+    :param max_seconds: the maximum wall time taken by the expansion of
+      a macro invocation, including its output. It's checked when the
+      expansion ends and when another macro is invoked, so it can't stop
+      a macro function that never returns
+    """
+
+    def __init__(self, max_depth=50, max_nodes=None, max_seconds=None):
+        self.max_depth = max_depth
+        self.max_nodes = max_nodes
+        self.max_seconds = max_seconds
+
+
+"""The `ExpansionLimits`:class: used by default for each module."""
+expansion_limits = ExpansionLimits()
+
+
 class MacroType(ABC):
     """Base class for the macro types. Each macro type has a name that
     will be used as the name of its registry (lowered). Each type
@@ -67,6 +269,10 @@ class MacroType(ABC):
     :param registry: A `Macros.Registry`:class: instance
     """
 
+    """The classes of the nodes that can be invocations of macros of this
+    type, or ``None`` if any node can be."""
+    node_types = None
+
     def __init__(self, registry):
         self.registry = registry
 
@@ -104,6 +310,8 @@ class Expr(MacroType):
     """Handles macros of the expression type, defined by using square
     brackets, like ``amacro[foo]``."""
 
+    node_types = (ast.Subscript,)
+
     def detect_macro(self, in_tree):
         if (isinstance(in_tree, ast.Subscript) and
             type(in_tree.slice) is ast.Index):  # noqa: E129
@@ -127,6 +335,8 @@ class Block(MacroType):
 
     """
 
+    node_types = (ast.With,)
+
     def detect_macro(self, in_tree):
         if isinstance(in_tree, ast.With):
             assert isinstance(in_tree.body, list), real_repr(in_tree.body)
@@ -163,6 +373,8 @@ class Decorator(MacroType):
     executing ``anothermacro`` first and then ``amacro``.
     """
 
+    node_types = compat.scope_nodes
+
     def detect_macro(self, in_tree):
         if (isinstance(in_tree, compat.scope_nodes) and
             len(in_tree.decorator_list)):  # noqa: E129
@@ -227,13 +439,28 @@ class Macros:
 
         :param wrap: A function that will be called with the
           registering macro function as parameter
+        :param functions: whether the registered values are macro
+          functions, whose `calling_convention`:func: is computed at
+          registration
+
+        Used without the function, it returns a decorator, e.g.
+        ``@macros.expr(context=True)`` registers a macro taking a
+        single `MacroContext`:class: argument, and
+        ``@macros.expr(pure=True)`` one whose output is memoized, see
+        `ExpansionMemo`:class:.
         """
 
-        def __init__(self, wrap=lambda x: x):
+        def __init__(self, wrap=lambda x: x, functions=False):
             self.registry = {}
             self.wrap = wrap
-
-        def __call__(self, f, name=None):
+            self.functions = functions
+
+        def __call__(self, f=None, name=None, context=False, pure=False):
+            if f is None:
+                return functools.partial(self, name=name, context=context,
+                                         pure=pure)
+            if self.functions:
+                calling_convention(f, context, pure)
             if name is not None:
                 self.registry[name] = f
             else:
@@ -259,7 +486,7 @@ class Macros:
         `Macros.Registry`:class: and registers it with the type name
         (lowercased)."""
         assert issubclass(macrotype_cls, MacroType), "Invalid macro type class"
-        reg = Macros.Registry(wrap_func)
+        reg = Macros.Registry(wrap_func, functions=True)
         setattr(self, macrotype_cls.__name__.lower(), reg)
         self.macro_registries.append(reg.registry)
 
@@ -274,6 +501,329 @@ filters = []
 post_processing = []
 
 
+class ExpansionSession(object):
+    """The registries and the state shared by the expansion of many
+    modules.
+
+    Each module is expanded by a `ModuleExpansionContext`:class: of its
+    own, which takes a snapshot of the registries of its session when
+    it's created, so that the macro modules imported meanwhile, e.g. by
+    other threads, don't change an expansion in progress. The state
+    shared by the expansions, like the `ExpansionMemo`:class:, is
+    protected by locks, so that many threads can expand modules with
+    the same session at once.
+
+    :param injected_vars: the functions computing the injected vars, by
+      default the `injected_vars`:data: list, so that the functions
+      registered later are used too
+    :param filters: the filters, by default `filters`:data:
+    :param post_processing: the post processing functions, by default
+      `post_processing`:data:
+    :param limits: an `ExpansionLimits`:class: instance, by default
+      `expansion_limits`:data:
+    :param memo: the `ExpansionMemo`:class: of the pure macros, by
+      default `expansion_memo`:data:, or ``None`` to not memoize them
+    """
+
+    def __init__(self, injected_vars=injected_vars, filters=filters,
+                 post_processing=post_processing, limits=None,
+                 memo=expansion_memo):
+        self.injected_vars = injected_vars
+        self.filters = filters
+        self.post_processing = post_processing
+        self.limits = limits
+        self.memo = memo
+
+    def snapshot(self):
+        """Return tuples of the current injected vars, filters and post
+        processing functions."""
+        return (tuple(self.injected_vars), tuple(self.filters),
+                tuple(self.post_processing))
+
+
+"""The `ExpansionSession`:class: used when no other is given."""
+default_session = ExpansionSession()
+
+
+# the names of the parameters of the functions receiving the injected
+# vars, by function
+_parameters = {}
+
+
+def declared_parameters(function):
+    """Return the names of the parameters of ``function`` that can be
+    passed by keyword, caching them.
+
+    :param function: a callable
+    :returns: a frozenset of names
+    """
+    try:
+        return _parameters[function]
+    except KeyError:
+        names = _parameters[function] = frozenset(
+            p.name for p in inspect.signature(function).parameters.values()
+            if p.kind in (p.POSITIONAL_OR_KEYWORD, p.KEYWORD_ONLY))
+        return names
+
+
+class InjectedVars(collections.abc.Mapping):
+    """A mapping containing the *realization* of the `injected_vars`:data:
+    of a module, each of them being computed the first time it's used.
+
+    The functions receive the ``kw`` arguments and, among the injected
+    vars, only those that they declare as parameters. Those who need
+    to decide at run time whether to compute an injected var can
+    declare a ``file_vars`` parameter, which receives the mapping
+    itself.
+
+    :param functions: a sequence of functions, the last one wins when
+      more of them have the same name
+    :param kw: the arguments passed to all the functions, e.g. ``tree``
+    """
+
+    def __init__(self, functions, **kw):
+        self.functions = {f.__name__: f for f in functions}
+        self.kw = kw
+        self.values = {}
+        # the names of the vars used, can be reset to track a part of
+        # the expansion
+        self.accessed = set()
+        self._computing = set()
+
+    def __getitem__(self, name):
+        self.accessed.add(name)
+        try:
+            return self.values[name]
+        except KeyError:
+            function = self.functions[name]
+        if name in self._computing:
+            raise RuntimeError('Injected var %r depends on itself' % name)
+        self._computing.add(name)
+        try:
+            value = self.values[name] = self.call(function, **self.kw)
+        finally:
+            self._computing.discard(name)
+        return value
+
+    def __iter__(self):
+        return iter(self.functions)
+
+    def __len__(self):
+        return len(self.functions)
+
+    def call(self, function, **kw):
+        """Call ``function`` with the ``kw`` arguments and the injected
+        vars it declares, computing them if needed."""
+        for name in declared_parameters(function):
+            if name not in kw:
+                if name in self.functions:
+                    kw[name] = self[name]
+                elif name == 'file_vars':
+                    kw[name] = self
+        return function(**kw)
+
+
+class NodeFilter(object):
+    """Base class of the filters that touch up the output of a macro one
+    node at a time. Such filters can be added to `filters`:data: like
+    the others, but the consecutive ones are fused: they are applied
+    together in a single walk of the tree, top-down, each node being
+    passed through all of them in order before its children are walked.
+
+    Each filter threads a *state* of its own down the tree, e.g. the
+    context of the names or the current line number, like the ``ctx``
+    of a `~.walkers.Walker`:class:.
+    """
+
+    # the classes of the nodes the filter is interested in, or ``None``
+    # for all the AST nodes. The others just pass the state to their
+    # children unchanged
+    node_types = None
+
+    def start(self, **kw):
+        """Return the state of the root of the tree. It receives the same
+        arguments as the other filters."""
+        return None
+
+    def visit(self, node, state):
+        """Transform a node, returning a ``(node, state)`` tuple with the
+        node to use in its place and the state to pass to its children.
+        """
+        return node, state
+
+    def child_state(self, node, field, value, state):
+        """Return the state to pass to the ``value`` of the ``field`` of a
+        visited ``node``."""
+        return state
+
+    def next_state(self, node, state):
+        """Return the state to pass to the next sibling of ``node``, which
+        is an element of a list."""
+        return state
+
+    def check_leaf(self, value):
+        """Check a value that isn't a node, e.g. an identifier."""
+
+    def __call__(self, tree, file_vars=None, **kw):
+        return apply_node_filters(tree, [self], file_vars, **kw)
+
+
+class _FusedWalk(object):
+    """A walk applying many `NodeFilter`:class: instances at once."""
+
+    def __init__(self, node_filters):
+        self.filters = node_filters
+        self.dispatch = {}
+
+    def applicable(self, cls):
+        """Tell which filters are interested in the nodes of class
+        ``cls``."""
+        try:
+            return self.dispatch[cls]
+        except KeyError:
+            node = issubclass(cls, ast.AST)
+            res = self.dispatch[cls] = tuple(
+                node if f.node_types is None else issubclass(cls, f.node_types)
+                for f in self.filters)
+            return res
+
+    def walk(self, tree, states):
+        if type(tree) is list:
+            new_tree = []
+            for t in tree:
+                new_t = self.walk(t, states)
+                if type(new_t) is list:
+                    new_tree.extend(new_t)
+                else:
+                    new_tree.append(new_t)
+                if isinstance(new_t, ast.AST):
+                    states = [f.next_state(new_t, state)
+                              for f, state in zip(self.filters, states)]
+            tree[:] = new_tree
+            return tree
+        states = list(states)
+        visited = [False] * len(states)
+        for i, f in enumerate(self.filters):
+            if self.applicable(type(tree))[i]:
+                tree, states[i] = f.visit(tree, states[i])
+                visited[i] = True
+        if isinstance(tree, ast.AST):
+            for field in tree._fields:
+                value = getattr(tree, field, None)
+                field_states = [
+                    f.child_state(tree, field, value, state) if v else state
+                    for f, state, v in zip(self.filters, states, visited)]
+                setattr(tree, field, self.walk(value, field_states))
+        elif not any(visited):
+            for f in self.filters:
+                f.check_leaf(tree)
+        return tree
+
+
+def apply_node_filters(tree, node_filters, file_vars=None, **kw):
+    """Apply the `NodeFilter`:class: instances ``node_filters`` to
+    ``tree`` in a single walk.
+
+    :param tree: an AST tree or a list of them
+    :param file_vars: an optional `InjectedVars`:class: instance,
+      providing the injected vars declared by the ``start()`` methods
+    :param kw: the arguments used to compute the initial states
+    :returns: the transformed tree
+    """
+    if file_vars is None:
+        states = [f.start(**kw) for f in node_filters]
+    else:
+        states = [file_vars.call(f.start, **kw) for f in node_filters]
+    return _FusedWalk(node_filters).walk(tree, states)
+
+
+def apply_filters(tree, file_vars, functions=None, **kw):
+    """Apply the `filters`:data: to ``tree``, last registered first,
+    fusing the consecutive node filters.
+
+    :param tree: the output of a macro
+    :param file_vars: the `InjectedVars`:class: instance of the module
+    :param functions: the filters to apply instead of `filters`:data:
+    :param kw: the arguments to pass to the filters
+    :returns: the transformed tree
+    """
+    fused = []
+    for function in reversed(filters if functions is None else functions):
+        if isinstance(function, NodeFilter):
+            fused.append(function)
+            continue
+        if fused:
+            tree = apply_node_filters(tree, fused, file_vars, **kw)
+            fused = []
+        tree = file_vars.call(function, tree=tree, **kw)
+    if fused:
+        tree = apply_node_filters(tree, fused, file_vars, **kw)
+    return tree
+
+
+def macro_free_nodes(tree, names):
+    """Find the largest subtrees of ``tree`` that cannot contain macros,
+    i.e. that don't contain any ``ast.Name`` in ``names``, as every
+    macro is invoked by name.
+
+    :param tree: an AST tree
+    :param names: a container of the bound macro names
+    :returns: a mapping between the ``id()`` of each subtree's root and
+      the root itself, so that ids can't be reused while it's alive
+    """
+    free = {}
+
+    AST = ast.AST
+    Name = ast.Name
+
+    def visit(node):
+        if type(node) is Name:
+            return node.id not in names
+        clean_children = []
+        clean = True
+        for field in node._fields:
+            value = getattr(node, field, None)
+            if type(value) is list:
+                for child in value:
+                    if isinstance(child, AST):
+                        if visit(child):
+                            clean_children.append(child)
+                        else:
+                            clean = False
+            elif isinstance(value, AST):
+                if visit(value):
+                    clean_children.append(value)
+                else:
+                    clean = False
+        if not clean:
+            for child in clean_children:
+                free[id(child)] = child
+        return clean
+
+    if visit(tree):
+        free[id(tree)] = tree
+    return free
+
+
+def node_signature(node):
+    """Return a tuple describing the fields of ``node``, with its children
+    and the items of its lists identified by ``id()``, so that it
+    differs once any field is set or any child replaced.
+
+    :param node: an AST node
+    """
+    signature = []
+    for field in node._fields:
+        value = getattr(node, field, None)
+        if type(value) is list:
+            signature.append(tuple(map(id, value)))
+        elif isinstance(value, ast.AST):
+            signature.append(id(value))
+        else:
+            signature.append(value)
+    return tuple(signature)
+
+
 def preserve_line_numbers(tree, new_tree):
     """Decorates a tree-transformer function to stick the original line
     numbers onto the transformed tree.
@@ -326,45 +876,140 @@ class ExpansionContext:
     source for the values of the other members, except ``tree``."""
     parent = None
 
-    """A mapping containing the *realization* of the `~.injected_vars`,
-    which are calculated per-module."""
-    file_vars = {}
+    """An `InjectedVars`:class: mapping containing the *realization* of the
+    `~.injected_vars`, which are calculated per-module."""
+    file_vars = InjectedVars(())
 
     """A list containing one or more instances of `MacroType`:class:
     subclasses, usually defined as per-module level."""
     macro_types = []
 
+    """A mapping of the subtrees of the original tree that don't contain
+    macros, see `macro_free_nodes`:func:. They are skipped, but only
+    until a macro output is being walked."""
+    macro_free = {}
+
+    """The names bound to macros, if known."""
+    macro_names = None
+
+    """How many macro outputs are being walked."""
+    _output_depth = 0
+
+    """How many of the `invocations` are having their output walked,
+    which is what `ExpansionLimits.max_depth` bounds."""
+    _reexpansions = 0
+
+    """How many walks explicitly requested by macros are running, see
+    `expand_macros`:meth:."""
+    _forced = 0
+
+    """The `ExpansionLimits`:class: of the expansion."""
+    limits = ExpansionLimits(None)
+
+    """The filters applied to the output of each macro, see
+    `apply_filters`:func:."""
+    filters = filters
+
+    """The `ExpansionMemo`:class: of the pure macros, if any."""
+    memo = expansion_memo
+
     def __init__(self, tree, parent=None):
         self.tree = tree
+        self.dispatch = {}
+        # the nodes already walked, by id, see `walk_tree`:meth:
+        self.processed = {}
+        self.visits = 0
+        self.skipped = 0
+        # the ``(name, lineno, start)`` of the invocations being expanded
+        self.invocations = []
         if parent is not None:
             assert isinstance(parent, ExpansionContext)
             self.parent = parent
             self.file_vars = parent.file_vars
             self.macro_types = parent.macro_types
+            self.macro_names = parent.macro_names
+            self.limits = parent.limits
+            self.filters = parent.filters
+            self.memo = parent.memo
+
+    def check_limits(self, name, lineno):
+        """Check that a new invocation of the macro ``name`` at line
+        ``lineno`` doesn't exceed the `limits`, raising a
+        `MacroExpansionLimitError`:class: otherwise."""
+        limits = self.limits
+        if (limits.max_depth is not None and
+                self._reexpansions >= limits.max_depth):
+            # the outermost invocation is the one in the source
+            outer_name, outer_lineno, start = self.invocations[0]
+            raise MacroExpansionLimitError(
+                outer_name, outer_lineno, 'more than %d nested expansions '
+                'of macro outputs, the last of %r at line %s; does a macro '
+                'output its own invocation?' % (limits.max_depth, name,
+                                                lineno))
+        if limits.max_nodes is not None and self.visits > limits.max_nodes:
+            raise MacroExpansionLimitError(
+                name, lineno, 'more than %d nodes walked' % limits.max_nodes)
+        if limits.max_seconds is not None and self.invocations:
+            outer_name, outer_lineno, start = self.invocations[0]
+            self.check_time(outer_name, outer_lineno, start)
+
+    def check_time(self, name, lineno, start):
+        """Check that the invocation of the macro ``name`` at line
+        ``lineno``, started at ``start``, hasn't taken too long."""
+        seconds = self.limits.max_seconds
+        if seconds is not None and time.perf_counter() - start > seconds:
+            raise MacroExpansionLimitError(
+                name, lineno, 'expansion took more than %s seconds' %
+                seconds)
+
+    def macro_types_for(self, node_type):
+        """Return the macro types whose macros may be invoked by a node of
+        class ``node_type``, caching the result.
+
+        :param node_type: a class
+        :returns: a list of `MacroType`:class: instances
+        """
+        try:
+            return self.dispatch[node_type]
+        except KeyError:
+            mtypes = self.dispatch[node_type] = [
+                mtype for mtype in self.macro_types
+                if mtype.node_types is None or
+                issubclass(node_type, mtype.node_types)]
+            return mtypes
 
     def expand_macros(self, tree=None):
         """Basic expansion function, It just calls `~.walk_tree`:meth: with
         the ``tree`` passed in at instantiation time if it's not passed as
         parameter.
 
+        When a ``tree`` is passed, e.g. by a macro, it is walked in full,
+        including the nodes already processed.
+
         :param tree: an AST tree
         :returns: an AST tree
         """
         if tree is None:
-            tree = self.tree
-        return self.walk_tree(tree)
-
-    def macro_expand(self, tree):
+            return self.walk_tree(self.tree)
+        self._forced += 1
+        try:
+            return self.walk_tree(tree)
+        finally:
+            self._forced -= 1
+
+    def macro_expand(self, tree, macro_types=None):
         """This is a coroutine that expands found macros, and yields back
         transformed AST tree for the calling "walking" logic to transform.
 
         :param tree: an AST tree
+        :param macro_types: the macro types to try, defaults to all
         :returns: an AST tree or ``None``
         """
         new_tree = None
         found_macro = False
         # for every macro type
-        for mtype in self.macro_types:
+        for mtype in (self.macro_types if macro_types is None
+                      else macro_types):
             new_tree = None
             # its ``detect_macro()`` is a coro, start a pull/send cycle
             type_it = mtype.detect_macro(tree)
@@ -378,25 +1023,48 @@ class ExpansionContext:
                                  mdata.name, mtype.__class__.__name__,
                                  mdata.macro_tree.lineno)
                     found_macro = True
+                    lineno = mdata.macro_tree.lineno
+                    self.check_limits(mdata.name, lineno)
+                    depth = len(self.invocations)
+                    self.invocations.append((mdata.name, lineno,
+                                             time.perf_counter()))
                     mfunc, mmod = mdata.macro
+                    generator, context, pure = calling_convention(mfunc)
                     # if the macro function is itself a coro, give  it
                     # control about when expand its body, if before or
                     # after its own expansion, it's similar in spirit
                     # to ``contextlib.contexmanager()`` decorator
-                    if inspect.isgeneratorfunction(mfunc):
+                    if generator:
                         new_tree = mdata.body_tree
                     else:
                         # if not yield it for a pre-execution walking
                         new_tree = yield mdata.body_tree
+                    key = memoized = None
+                    memo = self.memo
+                    if pure and memo is not None:
+                        key = memo.key(mfunc, new_tree, mdata.call_args,
+                                       mdata.kwargs)
+                        if key is not None:
+                            memoized = memo.get(
+                                key, mdata.macro_tree.lineno,
+                                mdata.macro_tree.col_offset)
                     try:
-                        new_tree = mfunc(
-                            tree=new_tree,
-                            args=mdata.call_args,
-                            src=self.src,
-                            expand_macros=self.expand_macros,
-                            **dict(tuple(mdata.kwargs.items()) +
-                                   tuple(self.file_vars.items()))
-                        )
+                        if memoized is not None:
+                            new_tree = memoized
+                        elif context:
+                            new_tree = mfunc(MacroContext(
+                                new_tree, mdata.call_args, self.src,
+                                self.expand_macros, self.file_vars,
+                                **mdata.kwargs))
+                        else:
+                            new_tree = self.file_vars.call(
+                                mfunc,
+                                tree=new_tree,
+                                args=mdata.call_args,
+                                src=self.src,
+                                expand_macros=self.expand_macros,
+                                **mdata.kwargs
+                            )
                         # the result is a generator, treat it like a
                         # context manager
                         if inspect.isgenerator(new_tree):
@@ -408,6 +1076,11 @@ class ExpansionContext:
                             except StopIteration as final:
                                 if final.value is not None:
                                     new_tree = final.value
+                        elif key is not None and memoized is None:
+                            memo.put(key, new_tree, mdata.macro_tree.lineno,
+                                     mdata.macro_tree.col_offset)
+                    except MacroExpansionLimitError:
+                        raise
                     except Exception as e:
                         # here this exception is raised during macro
                         # expansion, at import time. If we come here,
@@ -418,19 +1091,25 @@ class ExpansionContext:
                         new_tree = e
 
                     # apply the filters
-                    for function in reversed(filters):
-                        new_tree = function(
-                            tree=new_tree,
-                            args=mdata.call_args,
-                            src=self.src,
-                            expand_macros=self.expand_macros,
-                            lineno=mdata.macro_tree.lineno,
-                            col_offset=mdata.macro_tree.col_offset,
-                            **dict(tuple(mdata.kwargs.items()) +
-                                   tuple(self.file_vars.items()))
-                        )
+                    new_tree = apply_filters(
+                        new_tree, self.file_vars, self.filters,
+                        args=mdata.call_args,
+                        src=self.src,
+                        expand_macros=self.expand_macros,
+                        lineno=mdata.macro_tree.lineno,
+                        col_offset=mdata.macro_tree.col_offset,
+                        **mdata.kwargs
+                    )
                     # yield it for one more walking
-                    new_tree = yield new_tree
+                    self._reexpansions += 1
+                    try:
+                        new_tree = yield new_tree
+                    finally:
+                        self._reexpansions -= 1
+                    start = self.invocations[depth][2]
+                    # the nested invocations, if any, have ended too
+                    del self.invocations[depth:]
+                    self.check_time(mdata.name, lineno, start)
             except StopIteration as final:
                 # if the ``detect_macro()`` function returns a final
                 # value, take it and ext as well, if it has found at
@@ -471,10 +1150,24 @@ class ExpansionContext:
         :param tree: an AST tree
         :returns: an AST tree
         """
+        if not self._forced and (
+                (self._output_depth == 0 and
+                 self.macro_free.get(id(tree)) is tree) or
+                self.is_processed(tree)):
+            self.skipped += 1
+            return tree
         if (isinstance(tree, ast.AST) or type(tree) is Literal or
             type(tree) is Captured):  # noqa: #E129
-            expand_it = self.macro_expand(tree)
+            self.visits += 1
+            macro_types = self.macro_types_for(type(tree))
+            if not macro_types:
+                # no macro can be invoked by this kind of node
+                self.walk_children(tree)
+                self.mark_processed(tree)
+                return tree
+            expand_it = self.macro_expand(tree, macro_types)
             new_tree = None
+            self._output_depth += 1
             try:
                 while True:
                     new_tree = self.walk_tree(expand_it.send(new_tree))
@@ -483,12 +1176,66 @@ class ExpansionContext:
                 # if at least one macro was found
                 if final.value is not None and new_tree is not None:
                     new_tree = self.walk_tree(final.value)
+            finally:
+                self._output_depth -= 1
             if new_tree is not None:
                 preserve_line_numbers(tree, new_tree)
-                tree = new_tree
+                self._output_depth += 1
+                try:
+                    self.walk_children(new_tree)
+                finally:
+                    self._output_depth -= 1
+                self.mark_processed(new_tree)
+                return new_tree
         self.walk_children(tree)
+        self.mark_processed(tree)
         return tree
 
+    def mark_processed(self, tree):
+        """Record that ``tree`` has been walked, with all its children, so
+        that it's skipped when it's found again unchanged, e.g. in the
+        output of an enclosing macro, see `is_processed`:meth:.
+
+        :param tree: an AST tree or a list of them
+        """
+        if type(tree) is list:
+            for t in tree:
+                self.mark_processed(t)
+        elif isinstance(tree, ast.AST):
+            self.processed[id(tree)] = (tree, node_signature(tree))
+
+    def is_processed(self, tree):
+        """Tell whether ``tree`` has been walked and neither it nor any of
+        its children has changed since, e.g. because a macro given the
+        walked tree edited it in place. Scope nodes are never skipped by
+        themselves, as the non-macro decorators of a decorated one get
+        re-attached to it after its body has been walked.
+
+        :param tree: an AST tree
+        """
+        entry = self.processed.get(id(tree))
+        if (entry is None or entry[0] is not tree or
+                isinstance(tree, compat.scope_nodes)):
+            return False
+        return self._unchanged(tree)
+
+    def _unchanged(self, tree):
+        entry = self.processed.get(id(tree))
+        if entry is None or entry[0] is not tree:
+            return False
+        signature = node_signature(tree)
+        if entry[1] != signature:
+            # a renamed name can't invoke a macro, e.g. the placeholders
+            # renamed by the quick lambda
+            if (type(tree) is not ast.Name or self.macro_names is None or
+                    tree.id in self.macro_names):
+                return False
+            self.processed[id(tree)] = (tree, signature)
+        for child in ast.iter_child_nodes(tree):
+            if not self._unchanged(child):
+                return False
+        return True
+
 
 class ModuleExpansionContext(ExpansionContext):
     """A subclass of the `ExpansionContext`:class: tailored to be
@@ -499,16 +1246,38 @@ class ModuleExpansionContext(ExpansionContext):
     :param src: the source string of the ``tree``
     :param bindings: a mapping between each imported macro module and its used
       macro names
+    :param limits: an optional `ExpansionLimits`:class: instance, by
+      default the one of the session or `expansion_limits`:data:
+    :param statement_cache: an optional `~.cache.StatementCache`:class:,
+      to expand the module one top-level statement at a time, reusing
+      the expansion of the unchanged ones, see `~.incremental`:mod:
+    :param module_name: the name of the module, required with
+      ``statement_cache``
+    :param lazy_functions: whether to defer the expansion of the bodies
+      of the module's functions until their first call, see
+      `~.deferred`:mod:
+    :param session: the `ExpansionSession`:class: providing the
+      registries, by default `default_session`:data:
     """
 
-    def __init__(self, tree, src, bindings):
+    def __init__(self, tree, src, bindings, limits=None,
+                 statement_cache=None, module_name=None,
+                 lazy_functions=False, session=None):
         super().__init__(tree)
         self.src = src
-        self.file_vars = {}
-        for v in injected_vars:
-            self.file_vars[v.__name__] = v(tree=tree, src=src,
-                                           expand_macros=self.expand_macros,
-                                           **self.file_vars)
+        self.bindings = bindings
+        self.session = default_session if session is None else session
+        functions, self.filters, self.post_processing = (
+            self.session.snapshot())
+        if limits is None:
+            limits = self.session.limits
+        self.limits = expansion_limits if limits is None else limits
+        self.memo = self.session.memo
+        self.statement_cache = statement_cache
+        self.module_name = module_name
+        self.lazy_functions = lazy_functions
+        self.file_vars = InjectedVars(functions, tree=tree, src=src,
+                                      expand_macros=self.expand_macros)
 
         allnames = [
             (mod, name, asname)
@@ -522,6 +1291,9 @@ class ModuleExpansionContext(ExpansionContext):
             for registry in [mod.macros.macro_registries[ix]]
             if name in registry.keys()
         }) for ix, cls in enumerate(Macros.macro_types)]
+        self.macro_names = frozenset(
+            name for mtype in self.macro_types for name in mtype.registry)
+        self.macro_free = macro_free_nodes(tree, self.macro_names)
 
     def expand_macros(self, tree=None):
         if tree is None:
@@ -530,9 +1302,22 @@ class ModuleExpansionContext(ExpansionContext):
             return super().expand_macros(tree)
 
         preamble = self.pre_process(tree)
-        tree = super().expand_macros(tree)
+        registry = None
+        # the deferred functions would be compiled without the
+        # ``__future__`` flags of the module
+        if self.lazy_functions and not preamble and isinstance(tree,
+                                                              ast.Module):
+            from . import deferred
+            registry = deferred.defer_functions(self, tree)
+        if self.statement_cache is not None and isinstance(tree, ast.Module):
+            from . import incremental
+            tree.body = incremental.expand_statements(self, tree)
+        else:
+            tree = self.walk_tree(tree)
         tree = self.post_process(tree)
 
+        if registry:
+            tree.body = registry + tree.body
         if preamble:
             tree.body = preamble + tree.body
 
@@ -566,25 +1351,59 @@ class ModuleExpansionContext(ExpansionContext):
         return preamble
 
     def post_process(self, tree):
-        """Executes the functions added to the `~.post_processing` list.
+        """Executes the functions added to the `~.post_processing` list,
+        or to the one of the session.
 
         :param tree: an AST tree
         :returns: an AST tree
         """
-        for post in post_processing:
-            tree = post(
+        for post in self.post_processing:
+            tree = self.file_vars.call(
+                post,
                 tree=tree,
                 src=self.src,
-                expand_macros=self.expand_macros,
-                **self.file_vars
+                expand_macros=self.expand_macros
             )
         return tree
 
 
-def detect_macros(tree, from_fullname, from_package=None, from_module=None):
+# Matches every top-level ``from ... import macros`` statement, and then
+# some: such a statement starts at the beginning of a line (top-level
+# code is never indented) or after a semicolon, and each part of it may
+# be separated by spaces or line continuations, while the imported names
+# may also be parenthesized, spanning multiple lines.
+_WS = r'(?:[ \t\f]|\\\r?\n)'
+MACRO_IMPORT_RE = re.compile(
+    r'(?:(?:^|\r)\f*|;' + _WS + r'*)from(?:[\w.]|' + _WS + r')*?' + _WS +
+    r'import' + _WS + r'*(?:\((?:\s|#[^\n]*)*)?macros\b', re.M)
+
+
+def has_macro_imports(src):
+    """Quickly tell if the source code ``src`` may contain imports of
+    macros, without parsing it. A ``False`` result is definitive: in such
+    case `detect_macros`:func: would find nothing.
+    """
+    return "macros" in src and MACRO_IMPORT_RE.search(src) is not None
+
+
+def mentions_name(src, name, times=1):
+    """Tell whether the identifier ``name`` occurs in ``src`` more than
+    ``times`` times. Its occurrences in comments and strings count too.
+    """
+    return len(re.findall(r'\b%s\b' % re.escape(name), src)) > times
+
+
+def detect_macros(tree, from_fullname, from_package=None, from_module=None,
+                  src=None):
     """Look for macros imports within an AST, transforming them and extracting
-    the list of macro modules."""
+    the list of macro modules.
+
+    When the source ``src`` of the tree is given, the imports whose bound
+    names never occur in it, besides the import itself, are removed from
+    the tree without importing their module, as they can't be used.
+    """
     bindings = []
+    unused = []
 
     logger.info("Finding macros in %r", from_fullname)
     for stmt in tree.body:
@@ -598,6 +1417,14 @@ def detect_macros(tree, from_fullname, from_package=None, from_module=None):
             if fullname == __name__:
                 continue
 
+            if src is not None and len(stmt.names) > 1 and not any(
+                    mentions_name(src, t.asname or t.name)
+                    for t in stmt.names[1:]):
+                logger.info("Skipping the unused macros of %r in %r",
+                            fullname, from_module)
+                unused.append(stmt)
+                continue
+
             logger.info("Importing macros from %r into %r", fullname,
                         from_module)
             mod = importlib.import_module(fullname)
@@ -619,6 +1446,8 @@ def detect_macros(tree, from_fullname, from_package=None, from_module=None):
                 mod.macros.expose_unhygienic.registry.keys()
             ])
 
+    if unused:
+        tree.body = [stmt for stmt in tree.body if stmt not in unused]
     return bindings
 
 
@@ -26,7 +26,7 @@ def unquote_search(tree, **kw):
                 return f(right)
 
 
-@macros.expr
+@macros.expr(pure=True)
 def q(tree, **kw):
     tree = unquote_search.recurse(tree)
     # print('Quote expr after search %s' % ast.dump(tree)
@@ -37,7 +37,7 @@ def q(tree, **kw):
     return tree
 
 
-@macros.block  # noqa: F811
+@macros.block(pure=True)  # noqa: F811
 def q(tree, target, **kw):
     """Quasiquote macro, used to lift sections of code into their AST
     representation which can be manipulated at runtime. Used together with
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""Structural comparison, hashing and copying of trees.
+
+The trees are made of `ast.AST` nodes, lists of them, `~.Literal` and
+`~.Captured` instances and plain values. Two trees are structurally
+equal when their nodes have the same classes and fields, regardless of
+their identity; the positions of the nodes aren't compared unless
+asked, like ``ast.dump()`` does, and the ``ctx`` fields can be ignored
+as well, as the macros often build trees without them.
+"""
+
+import ast
+import copy
+
+from . import Captured, Literal
+
+
+# the values that are never copied nor walked into
+_atoms = frozenset((str, int, bool, type(None), bytes, type(Ellipsis)))
+
+# the nodes without fields nor positions, like ``ast.Load`` or
+# ``ast.Add``, which can be shared among trees
+_shared = (ast.expr_context, ast.boolop, ast.operator, ast.unaryop,
+           ast.cmpop)
+
+
+def _value_key(x):
+    tx = type(x)
+    if tx is float or tx is complex:
+        # distinguish 0.0 from -0.0, and make nan equal to itself
+        return (tx, repr(x))
+    if tx is tuple:
+        return (tx, tuple(_value_key(i) for i in x))
+    if tx is frozenset:
+        return (tx, frozenset(_value_key(i) for i in x))
+    # 1, 1.0 and True are equal but they aren't the same constant
+    return (tx, x)
+
+
+class Identity(object):
+    """Wraps a value so that it's compared and hashed by identity, keeping
+    it alive as long as the wrapper is, so that its ``id()`` can't be
+    reused by another value meanwhile."""
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return type(other) is Identity and other.value is self.value
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return id(self.value)
+
+
+def structure_key(tree, positions=False, ctx=True):
+    """Return a hashable key of ``tree``, equal to the key of any tree
+    structurally equal to it. The `~.Captured`:class: values are
+    compared by identity, and kept alive by the key.
+
+    :param tree: a tree
+    :param positions: whether the positions of the nodes count
+    :param ctx: whether the ``ctx`` fields count
+    :returns: a tuple
+    """
+    tx = type(tree)
+    if tx is str or tree is None:
+        return tree
+    if tx is list:
+        return (list,) + tuple([structure_key(t, positions, ctx)
+                                for t in tree])
+    if isinstance(tree, ast.AST):
+        key = [tx]
+        for field in tx._fields:
+            if ctx or field != 'ctx':
+                key.append(structure_key(getattr(tree, field, None),
+                                         positions, ctx))
+        if positions:
+            for attr in tx._attributes:
+                key.append(getattr(tree, attr, None))
+        return tuple(key)
+    if tx is Literal:
+        return (Literal, structure_key(tree.body, positions, ctx))
+    if tx is Captured:
+        return (Captured, Identity(tree.val), tree.name)
+    return _value_key(tree)
+
+
+def structural_hash(tree, positions=False, ctx=True):
+    """Return a hash of ``tree`` consistent with
+    `structurally_equal`:func:, valid in the current process.
+
+    See `structure_key`:func: for the parameters.
+    """
+    return hash(structure_key(tree, positions, ctx))
+
+
+def structurally_equal(a, b, positions=False, ctx=True):
+    """Tell whether the trees ``a`` and ``b`` are structurally equal.
+
+    See `structure_key`:func: for the parameters.
+    """
+    ta = type(a)
+    if ta is not type(b):
+        return False
+    if ta is list:
+        if len(a) != len(b):
+            return False
+        for x, y in zip(a, b):
+            if not structurally_equal(x, y, positions, ctx):
+                return False
+        return True
+    if isinstance(a, ast.AST):
+        for field in ta._fields:
+            if (ctx or field != 'ctx') and not structurally_equal(
+                    getattr(a, field, None), getattr(b, field, None),
+                    positions, ctx):
+                return False
+        if positions:
+            for attr in ta._attributes:
+                if getattr(a, attr, None) != getattr(b, attr, None):
+                    return False
+        return True
+    if ta is Literal:
+        return structurally_equal(a.body, b.body, positions, ctx)
+    if ta is Captured:
+        return a.val is b.val and a.name == b.name
+    if ta in _atoms:
+        return a == b
+    return _value_key(a) == _value_key(b)
+
+
+def clone(tree):
+    """Return a copy of ``tree``, much faster than ``copy.deepcopy()``.
+
+    The nodes are copied, but the fields of the nodes that are plain
+    values, the nodes without fields (like ``ast.Load``) and the values
+    of the `~.Captured`:class: instances are shared with the original
+    tree. Any other object is deep copied.
+
+    :param tree: a tree
+    :returns: the copy
+    """
+    tx = type(tree)
+    if tx in _atoms:
+        return tree
+    if tx is list:
+        return [clone(t) for t in tree]
+    if isinstance(tree, ast.AST):
+        if isinstance(tree, _shared):
+            return tree
+        new = tx.__new__(tx)
+        new.__dict__.update([(k, clone(v))
+                             for k, v in tree.__dict__.items()])
+        return new
+    if tx is Literal:
+        return Literal(clone(tree.body))
+    if tx is Captured:
+        return Captured(tree.val, tree.name)
+    if tx is float or tx is complex or tx is tuple or tx is frozenset:
+        return tree
+    return copy.deepcopy(tree)
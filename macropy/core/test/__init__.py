@@ -61,6 +61,8 @@ from . import macros
 from . import hquotes
 from . import exporters
 from . import analysis
+from . import import_hooks
+from . import structure
 Tests = test_suite(cases = [
     quotes,
     unparse,
@@ -68,6 +70,8 @@ Tests = test_suite(cases = [
     macros,
     Cases,
     hquotes,
-#    exporters,
-    analysis
+    exporters,
+    analysis,
+    import_hooks,
+    structure
 ])
@@ -1,70 +1,377 @@
-import unittest
-import sys
+import importlib
 import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import textwrap
+import unittest
+
+import macropy
+from macropy.core import cache
+from macropy.core.exporters import (CacheExporter, NullExporter,
+                                     PycExporter, SharedCacheExporter)
+
 pyc_cache_count = 0
 pyc_cache_macro_count = 0
-from macropy.core.exporters import NullExporter, PycExporter, SaveExporter
 
 THIS_FOLDER = os.path.dirname(__file__)
 
+MACRO_MODULE = '''
+import ast
+import macropy.core.macros
+macros = macropy.core.macros.Macros()
+count = 0
+
+@macros.expr
+def f(tree, **kw):
+    global count
+    count += 1
+    return ast.Num(n=%d)
+'''
+
+
+def fresh_import(name):
+    """Import the module ``name`` forgetting any previous import of it."""
+    sys.modules.pop(name, None)
+    importlib.invalidate_caches()
+    return importlib.import_module(name)
+
+
+class TempModules(object):
+    """Writes modules in a temporary directory added to ``sys.path``,
+    removing everything on exit."""
+
+    def __enter__(self):
+        self.path = tempfile.mkdtemp()
+        self.names = set()
+        sys.path.insert(0, self.path)
+        return self
+
+    def write(self, name, src):
+        self.names.add(name)
+        sys.modules.pop(name, None)
+        filename = os.path.join(self.path, name + '.py')
+        # ensure a different mtime on fast filesystems
+        mtime = None
+        if os.path.exists(filename):
+            mtime = os.stat(filename).st_mtime + 1
+        with open(filename, 'w') as f:
+            f.write(textwrap.dedent(src))
+        if mtime is not None:
+            os.utime(filename, (mtime, mtime))
+        return filename
+
+    def __exit__(self, *exc):
+        sys.path.remove(self.path)
+        for name in self.names:
+            sys.modules.pop(name, None)
+        shutil.rmtree(self.path)
+
+
 class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        macropy.exporter = NullExporter()
+        shutil.rmtree(self.cache_dir)
+
     def test_null_exporter(self):
-        import pyc_cache
         # every load and reload should re-run both macro and file
-        assert (pyc_cache_count, pyc_cache_macro_count) == (1, 1)
-        reload(pyc_cache)
-        assert (pyc_cache_count, pyc_cache_macro_count) == (2, 2)
-        reload(pyc_cache)
-        assert (pyc_cache_count, pyc_cache_macro_count) == (3, 3)
+        counts = (pyc_cache_count, pyc_cache_macro_count)
+        fresh_import('macropy.core.test.exporters.pyc_cache')
+        assert (pyc_cache_count, pyc_cache_macro_count) == (
+            counts[0] + 1, counts[1] + 1)
+        fresh_import('macropy.core.test.exporters.pyc_cache')
+        assert (pyc_cache_count, pyc_cache_macro_count) == (
+            counts[0] + 2, counts[1] + 2)
 
-    def test_pyc_exporter(self):
-        import macropy
+    def test_cache_exporter(self):
+        macropy.exporter = CacheExporter(self.cache_dir)
+        counts = (pyc_cache_count, pyc_cache_macro_count)
+        fresh_import('macropy.core.test.exporters.pyc_cache')
+        assert (pyc_cache_count, pyc_cache_macro_count) == (
+            counts[0] + 1, counts[1] + 1)
 
-        macropy.exporter = PycExporter()
-        import pyc_cache
-        assert (pyc_cache_count, pyc_cache_macro_count) == (3, 3)
+        # re-importing the module should re-run the file but not the macro
+        fresh_import('macropy.core.test.exporters.pyc_cache')
+        assert (pyc_cache_count, pyc_cache_macro_count) == (
+            counts[0] + 2, counts[1] + 1)
+        fresh_import('macropy.core.test.exporters.pyc_cache')
+        assert (pyc_cache_count, pyc_cache_macro_count) == (
+            counts[0] + 3, counts[1] + 1)
 
-        # reloading the file should re-run file but not macro
-        reload(pyc_cache)
-        assert (pyc_cache_count, pyc_cache_macro_count) == (4, 3)
-        reload(pyc_cache)
-        assert (pyc_cache_count, pyc_cache_macro_count) == (5, 3)
+    def test_cache_exporter_invalidation(self):
+        macropy.exporter = CacheExporter(self.cache_dir)
+        with TempModules() as tmp:
+            tmp.write('cache_macro', MACRO_MODULE % 1)
+            tmp.write('cache_target', '''
+                from cache_macro import macros, f
+                value = f[0]
+            ''')
+            assert fresh_import('cache_target').value == 1
+            assert sys.modules['cache_macro'].count == 1
 
-        
-        cache_file = os.path.join(THIS_FOLDER, "pyc_cache.py")
-        # unless you touch the file to bring its mtime up to that of the
-        # stored .pyc, in which case the macro gets re-run too
-        f = open(cache_file, "a")
-        f.write(" ")
-        f.close()
+            assert fresh_import('cache_target').value == 1
+            assert sys.modules['cache_macro'].count == 1
 
-        reload(pyc_cache)
-        assert (pyc_cache_count, pyc_cache_macro_count) == (6, 4)
+            # changing the module's source triggers a new expansion
+            tmp.write('cache_target', '''
+                from cache_macro import macros, f
+                value = f[0] + 1
+            ''')
+            assert fresh_import('cache_target').value == 2
+            assert sys.modules['cache_macro'].count == 2
 
-        reload(pyc_cache)
-        assert (pyc_cache_count, pyc_cache_macro_count) == (7, 4)
+            # and so does changing the macro
+            tmp.write('cache_macro', MACRO_MODULE % 10)
+            fresh_import('cache_macro')
+            assert fresh_import('cache_target').value == 11
+            assert sys.modules['cache_macro'].count == 1
 
-        f = open(cache_file, "a")
-        f.write(" ")
-        f.close()
+    def test_cache_dependencies(self):
+        exporter = macropy.exporter = CacheExporter(self.cache_dir)
+        with TempModules() as tmp:
+            tmp.write('dep_macro', MACRO_MODULE % 1)
+            tmp.write('dep_hq_macro', """
+                import ast
+                import macropy.core.macros
+                from macropy.core.hquotes import macros, hq
+                macros = macropy.core.macros.Macros()
 
-        reload(pyc_cache)
-        assert (pyc_cache_count, pyc_cache_macro_count) == (8, 5), (pyc_cache_count, pyc_cache_macro_count)
+                @macros.expr
+                def g(tree, **kw):
+                    return hq[ast_literal[tree] * 2]
+            """)
+            sources = {
+                'dep_a1': 'from dep_macro import macros, f\nvalue = f[0]\n',
+                'dep_a2': 'from dep_macro import macros, f\nvalue = f[1]\n',
+                'dep_b': 'from dep_hq_macro import macros, g\nvalue = g[3]\n',
+            }
+            for name, src in sources.items():
+                tmp.write(name, src)
+                fresh_import(name)
+            keys = {name: cache.entry_key(src.encode('utf-8'), name)
+                    for name, src in sources.items()}
 
-    def test_save_exporter(self):
-        import macropy
+            # the dependencies of the macro modules are recorded too
+            deps, code = exporter.cache.get(keys['dep_b'])
+            assert [d[0] for d in deps] == ['macropy.core.quotes',
+                                            'macropy.core.hquotes',
+                                            'dep_hq_macro']
+            assert fresh_import('dep_b').value == 6
+
+            # changing a macro module drops only the entries depending on
+            # it, the first time a stale one is found
+            tmp.write('dep_macro', MACRO_MODULE % 2)
+            fresh_import('dep_macro')
+            assert fresh_import('dep_a1').value == 2
+            assert exporter.cache.get(keys['dep_a2']) is None
+            assert exporter.cache.get(keys['dep_b']) is not None
+            assert [k for k, v in exporter.cache.dependents('dep_macro')] == [
+                keys['dep_a1']]
+
+            assert exporter.invalidate('dep_hq_macro') == 1
+            assert exporter.cache.get(keys['dep_b']) is None
+            assert exporter.cache.get(keys['dep_a1']) is not None
 
-        exported = os.path.join(THIS_FOLDER, "exported")
+    def test_incremental_cache_exporter(self):
+        macropy.exporter = CacheExporter(self.cache_dir, incremental=True)
+        with TempModules() as tmp:
+            tmp.write('inc_macro', """
+                import ast
+                import macropy.core.macros
+                from macropy.core import unparse
+                macros = macropy.core.macros.Macros()
+                count = 0
+
+                @macros.expr
+                def f(tree, gen_sym, **kw):
+                    global count
+                    count += 1
+                    name = gen_sym('v')
+                    return ast.parse('(lambda %s: %s * 10)(%s)' % (
+                        name, name, unparse(tree))).body[0].value
+            """)
+            tmp.write('inc_target', """
+                from inc_macro import macros, f
+                a = f[1]
+
+                def g(x):
+                    return f[x] + 1
+            """)
+            mod = fresh_import('inc_target')
+            assert (mod.a, mod.g(2)) == (10, 21)
+            assert sys.modules['inc_macro'].count == 2
+            line = mod.g.__code__.co_firstlineno
+
+            # only the statement that changed is expanded again, the
+            # other one is moved to its new line
+            tmp.write('inc_target', """
+
+
+                from inc_macro import macros, f
+                a = f[3]
+
+                def g(x):
+                    return f[x] + 1
+            """)
+            mod = fresh_import('inc_target')
+            assert (mod.a, mod.g(2)) == (30, 21)
+            assert sys.modules['inc_macro'].count == 3
+            assert mod.g.__code__.co_firstlineno == line + 2
+
+            # a stored symbol now used elsewhere in the module forces a
+            # new expansion
+            tmp.write('inc_target', """
+                from inc_macro import macros, f
+                v1 = 5
+                a = f[v1]
+
+                def g(x):
+                    return f[x] + 1
+            """)
+            mod = fresh_import('inc_target')
+            assert (mod.v1, mod.a, mod.g(2)) == (5, 50, 21)
+            assert sys.modules['inc_macro'].count == 5
+
+            # a statement whose last line is shared with the next one
+            tmp.write('inc_shared', """
+                from inc_macro import macros, f
+                a = f[(1 +
+                       2)]; b = 0
+            """)
+            assert fresh_import('inc_shared').a == 30
+            tmp.write('inc_shared', """
+                from inc_macro import macros, f
+                a = f[(1 +
+                       5)]; b = 0
+            """)
+            assert fresh_import('inc_shared').a == 60
+
+    def test_shared_cache_exporter(self):
+        exporter = macropy.exporter = SharedCacheExporter(
+            os.path.join(self.cache_dir, 'cache.sqlite'))
+        with TempModules() as tmp:
+            tmp.write('shared_macro', MACRO_MODULE % 1)
+            tmp.write('shared_target', """
+                from shared_macro import macros, f
+                value = f[0]
+            """)
+            assert fresh_import('shared_target').value == 1
+            assert fresh_import('shared_target').value == 1
+            assert sys.modules['shared_macro'].count == 1
+
+            tmp.write('shared_macro', MACRO_MODULE % 2)
+            fresh_import('shared_macro')
+            assert fresh_import('shared_target').value == 2
+            assert exporter.invalidate('shared_macro') == 1
+
+            # a failed expansion releases the claim
+            src = 'from shared_macro import macros, f\nvalue = f[0'
+            tmp.write('shared_broken', src)
+            with self.assertRaises(SyntaxError):
+                fresh_import('shared_broken')
+            key = cache.entry_key(src.encode('utf-8'), 'shared_broken')
+            assert exporter.cache.conn.execute(
+                'SELECT * FROM claims WHERE key = ?', (key,)).fetchall() == []
+
+    def test_shared_cache_concurrency(self):
+        # many processes importing the same module expand it only once
+        with TempModules() as tmp:
+            log = os.path.join(tmp.path, 'expansions')
+            tmp.write('slow_macro', """
+                import ast, time
+                import macropy.core.macros
+                macros = macropy.core.macros.Macros()
+
+                @macros.expr
+                def f(tree, **kw):
+                    with open(%r, 'a') as log:
+                        log.write('x')
+                    time.sleep(0.5)
+                    return ast.Num(n=42)
+            """ % log)
+            tmp.write('slow_target', """
+                from slow_macro import macros, f
+                value = f[0]
+            """)
+            script = '; '.join([
+                'import macropy.activate',
+                'from macropy.core.exporters import SharedCacheExporter',
+                'macropy.exporter = SharedCacheExporter(%r)' % os.path.join(
+                    self.cache_dir, 'cache.sqlite'),
+                'import slow_target',
+                'assert slow_target.value == 42'])
+            env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+                [tmp.path, os.path.dirname(os.path.dirname(
+                    macropy.__file__))]))
+            procs = [subprocess.Popen([sys.executable, '-c', script],
+                                      env=env) for i in range(4)]
+            assert [p.wait() for p in procs] == [0] * 4
+            with open(log) as f:
+                assert f.read() == 'x'
+
+    def test_pyc_exporter(self):
+        macropy.exporter = PycExporter()
+        dont_write_bytecode, sys.dont_write_bytecode = (
+            sys.dont_write_bytecode, False)
+        self.addCleanup(setattr, sys, 'dont_write_bytecode',
+                        dont_write_bytecode)
+        with TempModules() as tmp:
+            tmp.write('pyc_macro', MACRO_MODULE % 1)
+            filename = tmp.write('pyc_target', """
+                from pyc_macro import macros, f
+                value = f[0]
+            """)
+            assert fresh_import('pyc_target').value == 1
+            pyc = PycExporter.pyc_path(filename)
+            assert os.path.basename(pyc).startswith('pyc_target.cpython-')
+            assert '-macropy' in pyc and os.path.exists(pyc)
+            # it doesn't collide with the interpreter's own file
+            assert pyc != importlib.util.cache_from_source(filename)
+
+            assert fresh_import('pyc_target').value == 1
+            assert sys.modules['pyc_macro'].count == 1
+
+            # a change to the macro module makes the file outdated
+            tmp.write('pyc_macro', MACRO_MODULE % 2)
+            fresh_import('pyc_macro')
+            assert fresh_import('pyc_target').value == 2
+            assert sys.modules['pyc_macro'].count == 1
+
+            # unchecked files are used even if the source changes
+            macropy.exporter = PycExporter(check_source=False)
+            tmp.write('pyc_target', """
+                from pyc_macro import macros, f
+                value = f[0] + 1
+            """)
+            assert fresh_import('pyc_target').value == 3
+            tmp.write('pyc_target', """
+                from pyc_macro import macros, f
+                value = f[0] + 2
+            """)
+            assert fresh_import('pyc_target').value == 3
+            assert sys.modules['pyc_macro'].count == 2
+
+            # whatever the exporter, as it's the file that tells
+            macropy.exporter = PycExporter()
+            assert fresh_import('pyc_target').value == 3
+            os.unlink(pyc)
+            assert fresh_import('pyc_target').value == 4
+
+    def test_save_exporter(self):
+        from macropy.core.exporters import SaveExporter
+        exported = os.path.join(self.cache_dir, "exported")
         macropy.exporter = SaveExporter(exported, THIS_FOLDER)
 
         # the original code should work
-        import save
+        save = fresh_import('macropy.core.test.exporters.save')
         assert save.run() == 14
 
-        macropy.exporter = NullExporter()
-
-        # the copy of the code saved in the ./exported folder should work too
-        import macropy.core.test.exporters.exported.save as save_exported
-        assert save_exported.run() == 14
-        import shutil
-        shutil.rmtree(exported)
\ No newline at end of file
+        # the copy of the code saved in the exported folder should work too
+        with open(os.path.join(exported, 'save.py')) as f:
+            src = f.read()
+        assert 'f[' not in src
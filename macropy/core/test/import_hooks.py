@@ -0,0 +1,283 @@
+import ast
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import textwrap
+import unittest
+
+import macropy
+from macropy.core.cache import NegativeCache
+from macropy.core.exporters import NullExporter
+from macropy.core.import_hooks import MacroFinder, PathPolicy, finder
+
+from .exporters import TempModules, fresh_import
+
+
+class Tests(unittest.TestCase):
+
+    def test_path_policy(self):
+        base = os.path.abspath(os.sep + 'srv')
+        policy = PathPolicy(exclude=[base])
+        assert not policy.allows(os.path.join(base, 'app', 'mod.py'))
+        assert policy.allows(os.path.join(base + 'x', 'mod.py'))
+
+        # the most specific directory wins
+        app = os.path.join(base, 'app')
+        policy = PathPolicy(include=[app], exclude=[base])
+        assert policy.allows(os.path.join(app, 'mod.py'))
+        assert not policy.allows(os.path.join(base, 'other', 'mod.py'))
+        policy = PathPolicy(include=[base],
+                            exclude=[os.path.join(app, 'vendor')])
+        assert policy.allows(os.path.join(app, 'mod.py'))
+        assert not policy.allows(os.path.join(app, 'vendor', 'mod.py'))
+
+        # with an include list, everything else is excluded except MacroPy
+        assert not policy.allows(os.path.abspath('mod.py'))
+        assert policy.allows(os.path.abspath(__file__))
+
+        # the standard library is excluded by default
+        policy = PathPolicy()
+        assert not policy.allows(os.__file__)
+        assert policy.allows(os.path.abspath(__file__))
+
+    def test_negative_cache(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp, 'mod.py')
+            with open(filename, 'w') as f:
+                f.write('x = 1\n')
+            cache_file = os.path.join(tmp, 'negative')
+            cache = NegativeCache(cache_file)
+            assert filename not in cache
+            cache.add(filename)
+            assert filename in cache
+            cache.save()
+
+            # it is persisted
+            assert filename in NegativeCache(cache_file)
+
+            # and it's invalidated by any change to the file
+            with open(filename, 'a') as f:
+                f.write('y = 2\n')
+            assert filename not in cache
+            assert filename not in NegativeCache(cache_file)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_finder_skips_known_files(self):
+        read = []
+        get_source_bytes = finder.get_source_bytes
+
+        def counting(spec):
+            read.append(spec.name)
+            return get_source_bytes(spec)
+
+        finder.get_source_bytes = counting
+        try:
+            with TempModules() as tmp:
+                filename = tmp.write('plain_module', '''
+                    """Mentions macros but doesn't use them."""
+                    value = 1
+                ''')
+                assert fresh_import('plain_module').value == 1
+                assert filename in MacroFinder.negative_cache
+                assert fresh_import('plain_module').value == 1
+                assert read == ['plain_module']
+
+                # once it changes, it's read again
+                tmp.write('plain_module', '''
+                    from macropy.quick_lambda import macros, f
+                    value = f[_ + 1](1)
+                ''')
+                assert fresh_import('plain_module').value == 2
+                assert read == ['plain_module'] * 2
+        finally:
+            del finder.get_source_bytes
+
+    def test_declined_modules_are_resolved_once(self):
+        calls = []
+
+        class CountingFinder(object):
+            def find_spec(self, fullname, path, target=None):
+                calls.append(fullname)
+
+        finder = CountingFinder()
+        sys.meta_path.insert(1, finder)
+        try:
+            with TempModules() as tmp:
+                tmp.write('declined_module', 'value = 1\n')
+                assert fresh_import('declined_module').value == 1
+        finally:
+            sys.meta_path.remove(finder)
+        assert calls == ['declined_module']
+
+    def test_unused_macros_are_not_imported(self):
+        with TempModules() as tmp:
+            tmp.write('unused_macros', '''
+                from unused_provider import macros, f, g
+                value = 1
+            ''')
+            assert fresh_import('unused_macros').value == 1
+            tmp.write('unused_macros', '''
+                from unused_provider import macros, g, h
+                from macropy.quick_lambda import macros, f as lam
+                value = lam[_ + 1](1)
+            ''')
+            assert fresh_import('unused_macros').value == 2
+            assert 'unused_provider' not in sys.modules
+
+    def test_loader_releases_artefacts(self):
+        with TempModules() as tmp:
+            tmp.write('released_module', '''
+                from macropy.quick_lambda import macros, f
+                value = f[_ + 1](1)
+            ''')
+            loader = fresh_import('released_module').__spec__.loader
+            assert (loader.code, loader.tree, loader.source) == (None,) * 3
+            assert [d[0] for d in loader.deps][-1] == 'macropy.quick_lambda'
+
+            class RetainingExporter(NullExporter):
+                retain = {'tree'}
+
+            macropy.exporter = RetainingExporter()
+            try:
+                loader = fresh_import('released_module').__spec__.loader
+            finally:
+                macropy.exporter = NullExporter()
+            assert loader.code is None and loader.source is None
+            assert isinstance(loader.tree, ast.Module)
+
+    def test_finder_session(self):
+        from macropy.core.macros import ExpansionSession, filters
+        expanded = []
+
+        def record(tree, **kw):
+            expanded.append(tree)
+            return tree
+
+        session_finder = MacroFinder(
+            session=ExpansionSession(filters=list(filters) + [record]),
+            negative_cache=NegativeCache())
+        sys.meta_path.insert(0, session_finder)
+        try:
+            with TempModules() as tmp:
+                tmp.write('session_module', '''
+                    from macropy.quick_lambda import macros, f
+                    value = f[_ + 1](1)
+                ''')
+                assert fresh_import('session_module').value == 2
+        finally:
+            sys.meta_path.remove(session_finder)
+        assert len(expanded) == 1
+
+    def test_lazy_functions(self):
+        finder.lazy_functions = True
+        try:
+            with TempModules() as tmp:
+                tmp.write('lazy_macro', '''
+                    import ast
+                    import macropy.core.macros
+                    from macropy.core.hquotes import macros, hq
+                    macros = macropy.core.macros.Macros()
+                    count = 0
+
+                    def double(x):
+                        return x * 2
+
+                    @macros.expr
+                    def f(tree, **kw):
+                        global count
+                        count += 1
+                        return ast.BinOp(tree, ast.Mult(), ast.Num(10))
+
+                    @macros.expr
+                    def g(tree, **kw):
+                        global count
+                        count += 1
+                        return hq[double(ast_literal[tree])]
+                ''')
+                tmp.write('lazy_target', '''
+                    import functools
+                    from lazy_macro import macros, f, g
+
+                    value = f[1]
+
+                    def one(x):
+                        """Doc."""
+                        return f[x]
+
+                    @functools.lru_cache()
+                    def two(x, *args, y=2, **kw):
+                        return g[x] + y + len(args) + len(kw)
+
+                    def gen():
+                        yield f[1]
+
+                    def never():
+                        return f[3]
+                ''')
+                mod = fresh_import('lazy_target')
+                macro = sys.modules['lazy_macro']
+                # only the module's code and the generator are expanded
+                assert macro.count == 2
+                assert mod.value == 10 and list(mod.gen()) == [10]
+                assert mod.one.__doc__ == 'Doc.'
+
+                assert mod.one(2) == 20
+                assert mod.one(3) == 30
+                assert macro.count == 3
+                assert mod.one.__code__.co_firstlineno == 7
+
+                # the captured values are restored, and the decorators
+                # keep wrapping the same function
+                assert mod.two(1, 0, 0, z=0) == 7
+                assert mod.two(1) == 4
+                assert macro.count == 4
+        finally:
+            del finder.lazy_functions
+
+    def test_lazy_functions_of_macro_modules(self):
+        from macropy.core import deferred
+        # the functions of a module defining macros, or registered in the
+        # expansion registries, are expanded at import time
+        tree = ast.parse(textwrap.dedent('''
+            import macropy.core.macros
+            macros = macropy.core.macros.Macros()
+
+            def helper(x):
+                return f[x]
+        '''))
+        assert deferred.defines_macros(tree)
+        tree = ast.parse(textwrap.dedent('''
+            @register(post_processing)
+            def process(tree, **kw):
+                return f[tree]
+        '''))
+        assert deferred._registered(tree.body[0])
+
+        # the macro modules imported for the first time in lazy mode,
+        # e.g. quick_lambda and its post processing, work as usual
+        with TempModules() as tmp:
+            tmp.write('lazy_quick', '''
+                from macropy.quick_lambda import macros, f, lazy
+
+                def add(x):
+                    return f[_ + x](1)
+
+                def later():
+                    return lazy[add(2)]()
+            ''')
+            script = '; '.join([
+                'import macropy.activate',
+                'from macropy.core.import_hooks import finder',
+                'finder.lazy_functions = True',
+                'import lazy_quick, macropy.quick_lambda as ql',
+                'assert not hasattr(ql, "__macropy_deferred__")',
+                'assert lazy_quick.add(2) == 3',
+                'assert lazy_quick.later() == 3'])
+            env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1',
+                       PYTHONPATH=os.pathsep.join([tmp.path, os.path.dirname(
+                           os.path.dirname(macropy.__file__))]))
+            subprocess.check_call([sys.executable, '-c', script], env=env)
@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
-import unittest
+import ast
+import importlib
 import sys
+import textwrap
+import unittest
 
 from macropy.core import compat
+from macropy.core.macros import has_macro_imports, macro_free_nodes
 
 
 class Tests(unittest.TestCase):
@@ -83,3 +87,323 @@ class Tests(unittest.TestCase):
         assert aliases.run_aliased() == "wtf"
         with self.assertRaises(Exception):
             aliases.run_ignored()
+
+    def test_has_macro_imports(self):
+        for src in [
+            "from a import macros, f",
+            "from a.b import macros",
+            "from .. a import(macros)",
+            "from a import (\n    # the macros\n    macros, f)",
+            "from a \\\n    import macros",
+            "import os; from a import macros",
+            "x = 1\r\nfrom a import macros\r\n",
+        ]:
+            assert has_macro_imports(src), src
+
+        for src in [
+            "# from a import macros",
+            '"""\n    from a import macros, f\n"""',
+            "def f():\n    from a import macros",
+            "import macros",
+            "my_macros = 1",
+        ]:
+            assert not has_macro_imports(src), src
+
+    def test_macro_free_nodes(self):
+        tree = ast.parse(textwrap.dedent('''
+            import os
+            def g(x):
+                return x + 1
+            class A:
+                def m(self):
+                    return f[1]
+                n = 2
+        '''))
+        imp, func, cls = tree.body
+        free = macro_free_nodes(tree, {'f'})
+        # only the largest subtrees are recorded
+        assert {node for node in free.values()
+                if not isinstance(node, ast.expr_context)} == {
+                    imp, func, cls.body[1],
+                    cls.body[0].args, cls.body[0].body[0].value.slice}
+        assert all(free[id(node)] is node for node in free.values())
+        assert macro_free_nodes(tree, {'h'}) == {id(tree): tree}
+
+    def test_nested_expansion_visits(self):
+        from macropy.core.macros import ModuleExpansionContext, detect_macros
+        # each node is walked a bounded number of times, however deep
+        # the nesting of the macros is
+        visits = []
+        for nesting in (4, 8, 16):
+            quick_lambda = 'f[_ * 2]'
+            for i in range(nesting - 1):
+                quick_lambda = 'f[_ + %s(_)]' % quick_lambda
+            src = 'from macropy.quick_lambda import macros, f\n' + quick_lambda
+            tree = ast.parse(src)
+            modules = [(importlib.import_module(mod), bind) for mod, bind
+                       in detect_macros(tree, 'nested', None, 'nested')]
+            context = ModuleExpansionContext(tree, src, modules)
+            new_tree = context.expand_macros()
+            assert context.visits < len(list(ast.walk(new_tree)))
+            visits.append(context.visits)
+        assert visits[2] - visits[1] <= 2 * (visits[1] - visits[0])
+
+    def test_edited_body_is_walked_again(self):
+        # the macro adds an invocation in the body it gets, already walked
+        from . import rewrite_body
+        assert rewrite_body.run() == (100, 2)
+
+    def test_fused_node_filters(self):
+        from macropy.core import Captured
+        from macropy.core.macros import InjectedVars, apply_node_filters
+        from macropy.core.cleanup import fix_ctx, fill_line_numbers
+        from macropy.core.hquotes import hygienate
+        # an output with no ctx, no positions and a captured value
+        value = object()
+        tree = [ast.Assign(targets=[ast.Name(id='x')],
+                           value=ast.BinOp(ast.Name(id='y'), ast.Add(),
+                                           Captured(value, 'v'))),
+                ast.Expr(ast.Name(id='x'), lineno=7, col_offset=4),
+                ast.Delete(targets=[ast.Name(id='x')])]
+        registry = []
+
+        def gen_sym(**kw):
+            return lambda name: name + '_1'
+
+        tree = apply_node_filters(
+            tree, [hygienate, fill_line_numbers, fix_ctx],
+            InjectedVars([gen_sym]), lineno=5, col_offset=0,
+            captured_registry=registry)
+        assign, expr, delete = tree
+        assert type(assign.targets[0].ctx) is ast.Store
+        assert type(assign.value.left.ctx) is ast.Load
+        # the captured value is replaced before the other filters see it
+        assert registry == [(value, 'v_1')]
+        assert assign.value.right.id == 'v_1'
+        assert type(assign.value.right.ctx) is ast.Load
+        assert assign.value.right.lineno == 5
+        assert type(delete.targets[0].ctx) is ast.Del
+        # line numbers increase down the lists
+        assert (expr.value.lineno, expr.value.col_offset) == (7, 4)
+        assert (delete.lineno, delete.targets[0].lineno) == (7, 7)
+
+        with self.assertRaises(TypeError):
+            fill_line_numbers(ast.Expr(object()), lineno=1, col_offset=0)
+
+    def test_injected_vars_are_lazy(self):
+        from macropy.core.macros import InjectedVars
+        calls = []
+
+        def base(tree, **kw):
+            calls.append('base')
+            return tree + 1
+
+        def derived(base, **kw):
+            calls.append('derived')
+            return base * 2
+
+        def unused(**kw):
+            calls.append('unused')
+
+        def macro(tree, derived, **kw):
+            return derived, sorted(kw)
+
+        file_vars = InjectedVars([base, derived, unused], tree=1)
+        assert calls == []
+        # only the declared vars are passed, and computed once
+        assert file_vars.call(macro, tree=None, args=()) == (4, ['args'])
+        assert file_vars.call(macro, tree=None) == (4, [])
+        assert calls == ['base', 'derived']
+        assert sorted(file_vars) == ['base', 'derived', 'unused']
+
+    def test_module_expansion_computes_only_used_vars(self):
+        from macropy.core.macros import ModuleExpansionContext, detect_macros
+        src = 'from macropy.quick_lambda import macros, f\nf[_ + 1]\n'
+        tree = ast.parse(src)
+        modules = [(importlib.import_module(mod), bind) for mod, bind
+                   in detect_macros(tree, 'lazy_vars', None, 'lazy_vars')]
+        context = ModuleExpansionContext(tree, src, modules)
+        context.expand_macros()
+        assert 'gen_sym' in context.file_vars.values
+        assert 'exact_src' not in context.file_vars.values
+        assert 'interned_name' not in context.file_vars.values
+
+    def test_context_calling_convention(self):
+        from macropy.core.macros import (InjectedVars, MacroContext, Macros,
+                                         calling_convention)
+        macros = Macros()
+
+        @macros.expr(context=True)
+        def with_context(ctx):
+            return ctx.tree
+
+        @macros.block(name='renamed')
+        def with_kwargs(tree, **kw):
+            yield tree
+
+        assert macros.macro_registries[0]['with_context'] is \
+            with_context.func
+        assert calling_convention(with_context.func) == (False, True, False)
+        assert calling_convention(with_kwargs.func) == (True, False, False)
+        assert 'renamed' in macros.macro_registries[1]
+
+        def gen_sym(**kw):
+            return 'gen_sym'
+
+        ctx = MacroContext('tree', [], 'src', None, InjectedVars([gen_sym]),
+                           target='target')
+        assert (ctx.tree, ctx.target, ctx.gen_sym) == (
+            'tree', 'target', 'gen_sym')
+        with self.assertRaises(AttributeError):
+            ctx.missing
+        with self.assertRaises(AttributeError):
+            ctx.other = 1
+
+    def test_expansion_memo(self):
+        from macropy.core.macros import (ExpansionMemo, ModuleExpansionContext,
+                                         detect_macros, expansion_memo)
+        memo = ExpansionMemo(maxsize=2)
+        tree = ast.parse('(a +\n b)', mode='eval').body
+        key = memo.key('macro', tree, [], {'target': None})
+        assert key == memo.key('macro', ast.parse('a + b', mode='eval').body,
+                               [], {'target': None})
+        assert memo.get(key, 1, 0) is None
+        memo.put(key, tree, 1, 1)
+        # the copy is moved to the new position
+        clone = memo.get(key, 10, 5)
+        assert clone is not tree and ast.dump(clone) == ast.dump(tree)
+        assert (clone.left.lineno, clone.left.col_offset) == (10, 5)
+        assert (clone.right.lineno, clone.right.col_offset) == (11, 1)
+        assert (memo.hits, memo.misses) == (1, 1)
+        memo.put('other', tree, 1, 0)
+        memo.put('another', tree, 1, 0)
+        assert key not in memo.entries
+
+        src = textwrap.dedent('''
+            from macropy.core.quotes import macros, q
+            first = q[memo_value + 1]
+            second = q[memo_value + 1]
+            third = q[memo_value + 2]
+        ''')
+        tree = ast.parse(src)
+        modules = [(importlib.import_module(mod), bind) for mod, bind
+                   in detect_macros(tree, 'memo', None, 'memo')]
+        hits = expansion_memo.hits
+        ModuleExpansionContext(tree, src, modules).expand_macros()
+        assert expansion_memo.hits == hits + 1
+        first, second, third = tree.body[1:]
+        assert ast.dump(first.value) == ast.dump(second.value)
+        assert ast.dump(first.value) != ast.dump(third.value)
+        assert second.value.lineno == 4
+
+    def test_expansion_session(self):
+        import threading
+        from macropy.core import unparse
+        from macropy.core.macros import (ExpansionSession,
+                                         ModuleExpansionContext,
+                                         detect_macros, filters)
+        src = textwrap.dedent('''
+            from macropy.quick_lambda import macros, f
+            from macropy.core.hquotes import macros, hq
+            double = f[_ * 2]
+            tree = hq[double(1)]
+        ''')
+
+        def expand(session=None):
+            tree = ast.parse(src)
+            modules = [(importlib.import_module(mod), bind) for mod, bind
+                       in detect_macros(tree, 'session', None, 'session')]
+            return unparse(ModuleExpansionContext(
+                tree, src, modules, session=session).expand_macros())
+
+        outputs = []
+
+        def record(tree, **kw):
+            outputs.append(tree)
+            return tree
+
+        # the registries of a session are its own
+        session = ExpansionSession(filters=list(filters) + [record],
+                                   memo=None)
+        expected = expand()
+        assert outputs == []
+        assert expand(session) == expected
+        assert len(outputs) == 2
+
+        # many threads can expand with the same session at once
+        results = []
+        barrier = threading.Barrier(8)
+
+        def worker():
+            barrier.wait()
+            results.append(expand())
+
+        threads = [threading.Thread(target=worker) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == [expected] * 8
+
+    def test_expansion_limits(self):
+        from macropy.core.macros import (ExpansionLimits,
+                                         MacroExpansionLimitError,
+                                         ModuleExpansionContext, detect_macros)
+        from ..exporters import TempModules, fresh_import
+
+        def expand(src, limits):
+            tree = ast.parse(src)
+            modules = [(importlib.import_module(mod), bind) for mod, bind
+                       in detect_macros(tree, 'limited', None, 'limited')]
+            ModuleExpansionContext(tree, src, modules, limits).expand_macros()
+
+        with TempModules() as tmp:
+            tmp.write('runaway_macros', '''
+                import ast
+                from macropy.core.macros import Macros
+
+                macros = Macros()
+
+                @macros.expr
+                def again(tree, **kw):
+                    new = ast.parse('again[0]', mode='eval').body
+                    if isinstance(new.slice, ast.Index):
+                        new.slice.value = tree
+                    else:
+                        new.slice = tree
+                    return new
+
+                @macros.expr
+                def once(tree, **kw):
+                    return tree
+            ''')
+            src = textwrap.dedent('''
+                from runaway_macros import macros, again, once
+                again[1]
+            ''')
+            # the output of the macro contains its own invocation
+            with self.assertRaises(MacroExpansionLimitError) as cm:
+                expand(src, ExpansionLimits(max_depth=20))
+            assert "'again' at line 3" in str(cm.exception)
+            assert (cm.exception.name, cm.exception.lineno) == ('again', 3)
+
+            # the nesting in the source isn't bounded
+            src = 'from runaway_macros import macros, once\n' + \
+                  'x = %s1%s\n' % ('once[' * 60, ']' * 60)
+            expand(src, ExpansionLimits())
+
+            src = 'from runaway_macros import macros, once\n' + \
+                  'x = [%s]\n' % ', '.join('once[%d]' % i for i in range(10))
+            expand(src, ExpansionLimits())
+            with self.assertRaises(MacroExpansionLimitError) as cm:
+                expand(src, ExpansionLimits(max_nodes=20))
+            assert 'more than 20 nodes' in str(cm.exception)
+            with self.assertRaises(MacroExpansionLimitError) as cm:
+                expand(src, ExpansionLimits(max_seconds=0))
+            assert "'once' at line 2" in str(cm.exception)
+
+            # the import fails, instead of raising at run time
+            tmp.write('runaway', 'from runaway_macros import macros, again\n'
+                      'again[1]\n')
+            with self.assertRaises(MacroExpansionLimitError):
+                fresh_import('runaway')
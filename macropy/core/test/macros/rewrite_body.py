@@ -0,0 +1,7 @@
+from macropy.core.test.macros.rewrite_body_macro import macros, rewrite, inner
+
+def run():
+    x = 10
+    with rewrite:
+        y = (x, 2)
+    return y
@@ -0,0 +1,26 @@
+import ast
+
+import macropy.core.macros
+from macropy.core.walkers import Walker
+
+macros = macropy.core.macros.Macros()
+
+
+@macros.expr
+def inner(tree, **kw):
+    return ast.BinOp(tree, ast.Mult(), ast.Num(n=10))
+
+
+@macros.block
+def rewrite(tree, **kw):
+    """Wraps in place each ``x`` of the already walked body in an
+    ``inner`` invocation."""
+    @Walker
+    def wrap(tree, stop, **kw):
+        if isinstance(tree, ast.Name) and tree.id == 'x':
+            stop()
+            new = ast.parse('inner[x]', mode='eval').body
+            return ast.copy_location(new, tree)
+
+    wrap.recurse(tree)
+    return tree
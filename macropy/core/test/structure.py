@@ -0,0 +1,76 @@
+import ast
+import gc
+import unittest
+import weakref
+
+from macropy.core import Captured, Literal
+from macropy.core.structure import (clone, structural_hash, structure_key,
+                                    structurally_equal)
+
+
+SOURCE = '''
+def func(a, *args, b=-0.0, **kw):
+    with open(a) as f:
+        return [x + 1.0 for x in f if x], {b: args}
+'''
+
+
+class Tests(unittest.TestCase):
+
+    def test_equality_and_hash(self):
+        a = ast.parse(SOURCE)
+        b = ast.parse('\n\n' + SOURCE)
+        assert structurally_equal(a, b)
+        assert structural_hash(a) == structural_hash(b)
+        assert not structurally_equal(a, b, positions=True)
+        assert structure_key(a) != structure_key(b, positions=True)
+
+        # constants that are equal but aren't the same code
+        for x, y in [('1', '1.0'), ('0.0', '-0.0'), ('True', '1'),
+                     ('(1, 2)', '(1, 2.0)')]:
+            x = ast.parse(x, mode='eval').body
+            y = ast.parse(y, mode='eval').body
+            assert not structurally_equal(x, y), (x, y)
+            assert structure_key(x) != structure_key(y)
+
+        # the ctx can be ignored
+        name = ast.Name(id='x')
+        assert not structurally_equal(name, ast.Name('x', ast.Load()))
+        assert structurally_equal(name, ast.Name('x', ast.Load()), ctx=False)
+        assert structure_key(name, ctx=False) == structure_key(
+            ast.Name('x', ast.Store()), ctx=False)
+
+        # captured values are compared by identity
+        value = []
+        assert structurally_equal(Captured(value, 'v'), Captured(value, 'v'))
+        assert not structurally_equal(Captured(value, 'v'),
+                                      Captured([], 'v'))
+        assert structure_key(Literal(name)) == structure_key(
+            Literal(ast.Name(id='x')))
+
+        # and kept alive by the keys, so that their ids aren't reused
+        class Value(object):
+            pass
+        value = Value()
+        ref = weakref.ref(value)
+        key = structure_key(Captured(value, 'v'))
+        del value
+        gc.collect()
+        assert ref() is not None
+        assert key == structure_key(Captured(ref(), 'v'))
+        assert key != structure_key(Captured(Value(), 'v'))
+
+    def test_clone(self):
+        tree = ast.parse(SOURCE)
+        value = object()
+        tree.body.append(Literal(ast.Expr(Captured(value, 'v'))))
+        new = clone(tree)
+        assert structurally_equal(tree, new, positions=True)
+        assert ast.dump(tree.body[0], include_attributes=True) == \
+            ast.dump(new.body[0], include_attributes=True)
+        originals = {id(n) for n in ast.walk(tree)}
+        assert not any(id(n) in originals for n in ast.walk(new)
+                       if n._fields or n._attributes)
+        assert new.body[1] is not tree.body[1]
+        assert new.body[1].body.value is not tree.body[1].body.value
+        assert new.body[1].body.value.val is value
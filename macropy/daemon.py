@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+"""A local daemon expanding modules on behalf of other processes.
+
+Many short lived processes on the same host, like command line tools,
+test shards or cron jobs, would each import the macro modules and
+expand the same modules. The daemon keeps the macro modules imported
+and the expanded modules in memory, serving them over a Unix domain
+socket::
+
+  python -m macropy.daemon [--socket PATH] [--max-entries N]
+
+The processes use it by setting a `DaemonExporter`:class: as the
+exporter, which asks the daemon for each module using macros, and lets
+the import hook expand it in process when the daemon isn't running,
+runs another version of Python or MacroPy, or fails to expand it.
+
+Each connection starts with a handshake, where both ends send the
+version of MacroPy and the magic number of the interpreter, as the
+code objects are exchanged marshalled. Then every message is a frame
+made of its length, as 4 bytes, and its marshalled content.
+"""
+
+import argparse
+import collections
+import importlib
+import importlib.machinery
+import logging
+import marshal
+import os
+import signal
+import socket
+import socketserver
+import struct
+import sys
+import threading
+
+from .core import cache
+
+
+logger = logging.getLogger(__name__)
+
+
+_LENGTH = struct.Struct('>I')
+
+
+def default_socket_path():
+    """Return the path of the socket used by default, honoring
+    ``MACROPY_DAEMON_SOCKET``."""
+    return (os.environ.get('MACROPY_DAEMON_SOCKET') or
+            os.path.join(cache.default_cache_dir(), 'daemon.sock'))
+
+
+def handshake():
+    """Return the bytes that both ends send when connecting."""
+    import macropy
+    return (b'macropy-daemon\0' + macropy.__version__.encode('ascii') +
+            b'\0' + cache.MAGIC)
+
+
+def send_frame(sock, data):
+    sock.sendall(_LENGTH.pack(len(data)) + data)
+
+
+def recv_frame(sock):
+    """Receive a frame, returning ``None`` if the connection has been
+    closed before it started."""
+    header = _recv_exactly(sock, _LENGTH.size)
+    if header is None:
+        return None
+    data = _recv_exactly(sock, _LENGTH.unpack(header)[0])
+    if data is None:
+        raise EOFError('Connection closed in the middle of a frame')
+    return data
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            if chunks:
+                raise EOFError('Connection closed in the middle of a frame')
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+class _Handler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        sock = self.request
+        expected = handshake()
+        hello = recv_frame(sock)
+        send_frame(sock, expected)
+        if hello != expected:
+            logger.info('Refusing an incompatible client')
+            return
+        while True:
+            frame = recv_frame(sock)
+            if frame is None:
+                return
+            try:
+                module_name, origin, data, path = marshal.loads(frame)
+                status, payload = self.server.expand(module_name, origin,
+                                                     data, path)
+            except Exception as e:
+                logger.exception('Failed expanding a module')
+                status, payload = 'failed', ('%s: %s' % (
+                    type(e).__name__, e)).encode('utf-8')
+            send_frame(sock, marshal.dumps((status, payload)))
+
+
+def find_origin(module_name, path):
+    """Return the file the module ``module_name`` would be imported from
+    with the import path ``path``, without importing anything, or
+    ``None`` if it can't be found there."""
+    search = list(path)
+    spec = None
+    parts = module_name.split('.')
+    for i in range(len(parts)):
+        if search is None:
+            return None
+        spec = importlib.machinery.PathFinder.find_spec(
+            '.'.join(parts[:i + 1]), search)
+        if spec is None:
+            return None
+        search = spec.submodule_search_locations
+    return spec.origin
+
+
+def path_key(key, path):
+    """Return the key of an expanded module that depends on the import
+    path ``path`` of the client too."""
+    return cache.digest(('%s\0%s' % (key, '\0'.join(path))).encode(
+        'utf-8', 'surrogateescape'))
+
+
+class ExpansionDaemon(socketserver.ThreadingMixIn,
+                      socketserver.UnixStreamServer):
+    """The server expanding the modules, each connection being handled by
+    a thread of its own.
+
+    The expanded modules are kept in memory, keyed like the entries of
+    the `~.core.cache.ExpansionCache`:class: and by the import path of
+    the client, and served until one of the macro modules used to
+    expand them changes. The modules are expanded one at a time, with
+    the import path of the client asking for them: the macro modules
+    imported by the daemon that changed since, or that the client
+    would import from another file, are imported again.
+
+    :param path: the path of the socket, by default
+      `default_socket_path`:func:. A stale socket file left there by a
+      daemon that isn't running anymore is removed
+    :param max_entries: the number of expanded modules kept, the least
+      recently used are dropped
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path=None, max_entries=1024):
+        self.path = path or default_socket_path()
+        self.max_entries = max_entries
+        # the expanded modules, as ``(deps, entry)``
+        self.entries = collections.OrderedDict()
+        # the ``(origin, digest)`` of the macro modules imported so far
+        self.loaded = {}
+        self._lock = threading.Lock()
+        # held while importing with the import path of a client
+        self._import_lock = threading.Lock()
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except OSError:
+                os.unlink(self.path)
+            else:
+                raise OSError('A daemon is already listening on %s' %
+                              self.path)
+            finally:
+                probe.close()
+        # the socket is created accessible only to its user, so that
+        # nobody else can connect before its permissions are set
+        umask = os.umask(0o177)
+        try:
+            super().__init__(self.path, _Handler)
+        finally:
+            os.umask(umask)
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def _forget_stale(self, path):
+        """Forget the macro modules that changed since they were imported,
+        or that would be imported from another file with the import path
+        ``path``, so that they are imported again."""
+        stale = [name for name, (origin, value) in self.loaded.items()
+                 if find_origin(name, path) != (origin or None) or
+                 origin and cache.file_digest(origin) != value]
+        for name in stale:
+            logger.info('Importing macro module %r again', name)
+            del self.loaded[name]
+            sys.modules.pop(name, None)
+
+    def expand(self, module_name, origin, data, path=()):
+        """Expand a module, or find it among the ones already expanded.
+
+        :param module_name: the full name of the module
+        :param origin: the path of its source file
+        :param data: its raw source
+        :param path: the import path of the client
+        :returns: a ``(status, payload)`` tuple, where status is either
+          ``'expanded'`` or ``'cached'``, the payload being the expanded
+          module serialized by `~.core.cache.dump_entry`:func:, or
+          ``'nomacros'``
+        """
+        from .compileall import expand_source
+
+        path = list(path) or list(sys.path)
+        key = path_key(cache.entry_key(data, module_name), path)
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+        if entry is not None:
+            deps, payload = entry
+            if cache.deps_current(deps):
+                return 'cached', payload
+        with self._import_lock:
+            saved_path = sys.path[:]
+            sys.path[:] = path
+            try:
+                importlib.invalidate_caches()
+                self._forget_stale(path)
+                result = expand_source(module_name, origin, data)
+                if result is not None:
+                    for name, dep_origin, value in result[2]:
+                        self.loaded[name] = (dep_origin, value)
+            finally:
+                sys.path[:] = saved_path
+        if result is None:
+            return 'nomacros', b''
+        code, tree, deps = result
+        payload = cache.dump_entry(code, deps)
+        with self._lock:
+            self.entries[key] = (deps, payload)
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        logger.info('Expanded %s', module_name)
+        return 'expanded', payload
+
+
+class DaemonExporter(object):
+    """An exporter asking an `ExpansionDaemon`:class: for the expanded
+    modules. When the daemon can't be reached, or it's incompatible, the
+    exporter stops asking and the modules are expanded in process, as
+    with the `~.core.exporters.NullExporter`:class:.
+
+    :param path: the path of the daemon's socket, by default
+      `default_socket_path`:func:
+    :param timeout: how long to wait for the daemon
+    """
+
+    def __init__(self, path=None, timeout=60):
+        self.path = path or default_socket_path()
+        self.timeout = timeout
+        self.available = True
+        self._sock = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            send_frame(sock, handshake())
+            if recv_frame(sock) != handshake():
+                raise ConnectionError('Incompatible daemon')
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    def _request(self, request):
+        with self._lock:
+            if not self.available:
+                return None
+            try:
+                if self._sock is None:
+                    self._sock = self._connect()
+                send_frame(self._sock, request)
+                reply = recv_frame(self._sock)
+                if reply is None:
+                    raise ConnectionError('Connection closed by the daemon')
+                return reply
+            except (OSError, EOFError) as e:
+                logger.info('Expansion daemon at %s unavailable: %s',
+                            self.path, e)
+                self.available = False
+                self.close()
+                return None
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def find(self, module_name, file_name, source):
+        if not file_name or not os.path.isabs(file_name):
+            return None
+        path = tuple(os.path.abspath(p) for p in sys.path
+                     if isinstance(p, str))
+        reply = self._request(marshal.dumps((module_name, file_name,
+                                             source, path)))
+        if reply is None:
+            return None
+        status, payload = marshal.loads(reply)
+        if status in ('expanded', 'cached'):
+            entry = cache.load_entry(payload)
+            if entry is not None:
+                deps, code = entry
+                if self._deps_match(deps, path):
+                    logger.debug('Using the expansion of module %r by the '
+                                 'daemon', module_name)
+                    return code, deps
+        if status == 'failed':
+            logger.debug('The daemon failed expanding %s: %s', module_name,
+                         payload.decode('utf-8', 'replace'))
+        return None
+
+    @staticmethod
+    def _deps_match(deps, path):
+        """Check that the macro modules used by the daemon are the ones
+        this process imports, or would import with the import path
+        ``path``, in their current version."""
+        for name, origin, value in deps:
+            module = sys.modules.get(name)
+            if module is not None:
+                expected = getattr(module, '__file__', None)
+                if expected:
+                    expected = os.path.abspath(expected)
+            else:
+                expected = find_origin(name, path)
+            if (expected or None) != (origin or None):
+                logger.debug('The daemon used macro module %r from %s '
+                             'instead of %s', name, origin, expected)
+                return False
+        return cache.deps_current(deps)
+
+    def export_transformed(self, code, tree, module_name, file_name, **kw):
+        pass
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        prog='python -m macropy.daemon',
+        description='Expand modules on behalf of other processes.')
+    parser.add_argument('--socket', default=None,
+                        help='the path of the socket (default: '
+                        '$MACROPY_DAEMON_SOCKET or daemon.sock in the '
+                        'cache directory)')
+    parser.add_argument('--max-entries', type=int, default=1024,
+                        help='how many expanded modules to keep')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='log every expansion')
+    return parser
+
+
+def main(args=None):
+    options = make_parser().parse_args(args)
+    logging.basicConfig(
+        level=logging.INFO if options.verbose else logging.WARNING)
+    import macropy.activate  # noqa: F401
+
+    server = ExpansionDaemon(options.socket, options.max_entries)
+
+    def stop(signum, frame):
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    print('Listening on %s' % server.path, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
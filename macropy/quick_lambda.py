@@ -17,10 +17,12 @@ def _():
     """Placeholder for a function argument in the `f` macro."""
 
 
-@macros.expr  # noqa: F811
-def f(tree, gen_sym, **kw):
+@macros.expr(context=True)  # noqa: F811
+def f(ctx):
     """Macro to concisely create function literals; any `_`s within the
     wrapped expression becomes an argument to the generated function."""
+    gen_sym = ctx.gen_sym
+
     @Walker
     def underscore_search(tree, collect, **kw):
         if isinstance(tree, ast.Name) and tree.id == "_":
@@ -29,7 +31,7 @@ def f(tree, gen_sym, **kw):
             collect(name)
             return tree
 
-    tree, used_names = underscore_search.recurse_collect(tree)
+    tree, used_names = underscore_search.recurse_collect(ctx.tree)
 
     new_tree = q[lambda: ast_literal[tree]]
     new_tree.args.args = [ast.arg(arg=x) for x in used_names]
@@ -62,9 +64,10 @@ def interned_name(gen_sym, **kw):
 
 
 @register(post_processing)  # noqa: F811
-def interned_processing(tree, gen_sym, interned_count, interned_name, **kw):
+def interned_processing(tree, interned_count, file_vars, **kw):
 
     if interned_count[0] != 0:
+        interned_name = file_vars['interned_name']
         with q as code:
             name[interned_name] = [None for x in range(u[interned_count[0]])]
 
@@ -16,6 +16,10 @@ from . import quick_lambda
 from . import string_interp
 from . import tracing
 from . import peg
+from . import compileall
+from . import bundle
+from . import build
+from . import daemon
 import macropy.experimental.test
 import macropy.core.test
 
@@ -25,7 +29,11 @@ Tests = test_suite(cases=[
     quick_lambda,
     string_interp,
     tracing,
-    peg
+    peg,
+    compileall,
+    bundle,
+    build,
+    daemon
 ], suites=[
     macropy.experimental.test,
     macropy.core.test
@@ -0,0 +1,85 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import textwrap
+import unittest
+from unittest import mock
+
+import macropy
+from macropy.build import expand_build_dir
+from macropy.core.test.exporters import MACRO_MODULE, TempModules
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.build_dir = tempfile.mkdtemp()
+        pkg = os.path.join(self.build_dir, 'built_pkg')
+        os.mkdir(pkg)
+        for name, src in [('__init__', ''), ('plain', 'value = 1\n'),
+                          ('mod', '''
+                              from built_macro import macros, f
+                              value = f[0] + 1
+                          ''')]:
+            with open(os.path.join(pkg, name + '.py'), 'w') as f:
+                f.write(textwrap.dedent(src))
+        self.pkg = pkg
+
+    def tearDown(self):
+        shutil.rmtree(self.build_dir)
+        for name in ('built_pkg', 'built_pkg.mod', 'built_pkg.plain'):
+            sys.modules.pop(name, None)
+
+    def run_built(self, macros_path):
+        # import the built module without MacroPy's import hook
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([
+            self.build_dir, macros_path,
+            os.path.dirname(os.path.dirname(macropy.__file__))]))
+        return subprocess.check_output(
+            [sys.executable, '-c', 'import sys, built_pkg.mod; '
+             'print(built_pkg.mod.value, "macropy.activate" in sys.modules)'],
+            env=env).decode().split()
+
+    def test_expand_source(self):
+        with TempModules() as tmp:
+            tmp.write('built_macro', MACRO_MODULE % 3)
+            written = expand_build_dir(self.build_dir)
+            assert written == [os.path.join(self.pkg, 'mod.py')]
+            with open(written[0]) as f:
+                assert 'f[' not in f.read()
+            assert self.run_built(tmp.path) == ['4', 'False']
+
+    def test_expand_bytecode(self):
+        with TempModules() as tmp:
+            tmp.write('built_macro', MACRO_MODULE % 3)
+            written = expand_build_dir(self.build_dir, 'bytecode')
+            assert written == [os.path.join(self.pkg, 'mod.pyc')]
+            assert not os.path.exists(os.path.join(self.pkg, 'mod.py'))
+            assert self.run_built(tmp.path) == ['4', 'False']
+
+    def test_build_py_outputs(self):
+        from setuptools import Distribution
+        from macropy.build import build_py
+        src = os.path.join(self.build_dir, 'src')
+        os.mkdir(src)
+        shutil.move(self.pkg, src)
+        build_lib = os.path.join(self.build_dir, 'lib')
+        dist = Distribution({'packages': ['built_pkg'],
+                             'package_dir': {'': src},
+                             'script_name': 'setup.py'})
+        cmd = build_py(dist)
+        cmd.build_lib = build_lib
+        cmd.macropy_mode = 'bytecode'
+        cmd.compile = True
+        cmd.ensure_finalized()
+        with TempModules() as tmp, \
+                mock.patch.object(sys, 'dont_write_bytecode', False):
+            tmp.write('built_macro', MACRO_MODULE % 3)
+            cmd.run()
+        outputs = cmd.get_outputs()
+        # the outputs are the files left on disk
+        mod = os.path.join(build_lib, 'built_pkg', 'mod.py')
+        assert mod + 'c' in outputs and mod not in outputs
+        assert all(os.path.exists(path) for path in outputs), outputs
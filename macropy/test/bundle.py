@@ -0,0 +1,96 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from macropy import bundle
+from macropy.core.test.exporters import MACRO_MODULE, TempModules, fresh_import
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_bundle(self):
+        output = os.path.join(self.tmp, 'bundle.zip')
+        with TempModules() as tmp:
+            tmp.write('bundle_macro', MACRO_MODULE % 5)
+            os.mkdir(os.path.join(tmp.path, 'bundle_pkg'))
+            init = tmp.write('bundle_pkg/__init__', '''
+                from bundle_macro import macros, f
+                value = f[0]
+            ''')
+            tmp.write('bundle_pkg/mod', '''
+                from bundle_macro import macros, f
+                from . import value as pkg_value
+                value = f[0] + pkg_value
+            ''')
+            tmp.write('bundle_pkg/plain', 'value = 1\n')
+            tmp.names.update(['bundle_pkg', 'bundle_pkg.mod',
+                              'bundle_pkg.plain'])
+
+            results = bundle.build([tmp.path], output, jobs=1,
+                                   report=lambda msg: None)
+            assert sorted(r[:2] for r in results) == [
+                ('bundle_pkg', 'expanded'), ('bundle_pkg.mod', 'expanded')]
+            sys.modules.pop('bundle_macro')
+
+            finder = bundle.install(output)
+            try:
+                mod = fresh_import('bundle_pkg.mod')
+                assert mod.value == 10
+                assert isinstance(mod.__loader__, bundle.BundleFinder)
+                assert sys.modules['bundle_pkg'].__file__ == init
+                assert fresh_import('bundle_pkg.plain').value == 1
+                # nothing was expanded
+                assert sys.modules['bundle_macro'].count == 0
+
+                # changed sources are ignored only when checking
+                tmp.write('bundle_pkg/mod', '''
+                    from bundle_macro import macros, f
+                    value = f[0] + 1
+                ''')
+                assert fresh_import('bundle_pkg.mod').value == 10
+                finder.check = True
+                assert fresh_import('bundle_pkg.mod').value == 6
+            finally:
+                sys.meta_path.remove(finder)
+
+    def test_missing_expansion(self):
+        output = os.path.join(self.tmp, 'bundle.zip')
+        with TempModules() as tmp:
+            tmp.write('bundle_macro', MACRO_MODULE % 5)
+            tmp.write('bundle_ok', '''
+                from bundle_macro import macros, f
+                value = f[0]
+            ''')
+            # a macro changing the source of the module it expands
+            touched = os.path.join(tmp.path, 'bundle_touched.py')
+            tmp.write('bundle_touch', '''
+                import ast
+                import macropy.core.macros
+                macros = macropy.core.macros.Macros()
+
+                @macros.expr
+                def touch(tree, **kw):
+                    with open(%r, 'a') as f:
+                        f.write('# touched\\n')
+                    return tree
+            ''' % touched)
+            tmp.write('bundle_touched', '''
+                from bundle_touch import macros, touch
+                value = touch[1]
+            ''')
+            messages = []
+            results = bundle.build([tmp.path], output, jobs=1,
+                                   report=messages.append)
+            assert sorted(r[:2] for r in results) == [
+                ('bundle_ok', 'expanded'), ('bundle_touched', 'failed')]
+            assert any('bundle_touched' in m for m in messages)
+            finder = bundle.BundleFinder(output)
+            assert sorted(finder.modules) == ['bundle_ok']
@@ -0,0 +1,66 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import macropy
+from macropy import compileall
+from macropy.core.exporters import CacheExporter, NullExporter, PycExporter
+from macropy.core.test.exporters import MACRO_MODULE, TempModules, fresh_import
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        macropy.exporter = NullExporter()
+        shutil.rmtree(self.cache_dir)
+
+    def expand(self, root, *args):
+        options = compileall.make_parser().parse_args(
+            ['--cache-dir', self.cache_dir, '-q'] + list(args) + [root])
+        return sorted(compileall.expand_all([root], options,
+                                            report=lambda msg: None))
+
+    def test_compileall(self):
+        with TempModules() as tmp:
+            tmp.write('aot_macro', MACRO_MODULE % 1)
+            tmp.write('aot_plain', 'value = 0\n')
+            tmp.write('aot_broken',
+                      'from aot_missing import macros, f\nvalue = f[0]\n')
+            os.mkdir(os.path.join(tmp.path, 'aot_pkg'))
+            tmp.write('aot_pkg/__init__', '''
+                from aot_macro import macros, f
+                value = f[0]
+            ''')
+            tmp.write('aot_pkg/mod', '''
+                from aot_macro import macros, f
+                from . import value as pkg_value
+                value = f[0] + pkg_value
+            ''')
+            tmp.names.update(['aot_pkg', 'aot_pkg.mod'])
+
+            results = self.expand(tmp.path, '-j', '2')
+            assert [r[:2] for r in results] == [
+                ('aot_broken', 'failed'),
+                ('aot_pkg', 'expanded'),
+                ('aot_pkg.mod', 'expanded')], results
+            assert 'aot_missing' in results[0][3], results[0]
+
+            # the modules are now loaded from the cache
+            macropy.exporter = CacheExporter(self.cache_dir)
+            assert fresh_import('aot_pkg.mod').value == 2
+            assert sys.modules['aot_macro'].count == 0
+
+            results = self.expand(tmp.path, '-j', '1')
+            assert [r[1] for r in results] == ['failed', 'cached', 'cached']
+            results = self.expand(tmp.path, '-j', '1', '--force')
+            assert [r[1] for r in results] == ['failed', 'expanded',
+                                               'expanded']
+
+            self.expand(tmp.path, '-j', '1', '--pycache')
+            assert os.path.exists(PycExporter.pyc_path(
+                os.path.join(tmp.path, 'aot_pkg', 'mod.py')))
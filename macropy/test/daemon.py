@@ -0,0 +1,145 @@
+import os
+import shutil
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+import types
+import unittest
+
+import macropy
+from macropy import daemon
+from macropy.core.exporters import NullExporter
+from macropy.core.test.exporters import MACRO_MODULE, TempModules, fresh_import
+
+
+ROOT = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'needs Unix sockets')
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.socket = os.path.join(self.tmp, 'daemon.sock')
+        self.process = None
+
+    def tearDown(self):
+        if isinstance(macropy.exporter, daemon.DaemonExporter):
+            macropy.exporter.close()
+        macropy.exporter = NullExporter()
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+        shutil.rmtree(self.tmp)
+
+    def start_daemon(self):
+        env = dict(os.environ, PYTHONPATH=os.path.abspath(ROOT),
+                   PYTHONDONTWRITEBYTECODE='1')
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'macropy.daemon', '--socket', self.socket],
+            env=env, stdout=subprocess.DEVNULL)
+        deadline = time.time() + 30
+        while not os.path.exists(self.socket):
+            self.assertIsNone(self.process.poll())
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.05)
+
+    def test_daemon(self):
+        self.start_daemon()
+        macropy.exporter = daemon.DaemonExporter(self.socket)
+        with TempModules() as tmp:
+            tmp.write('daemon_macro', MACRO_MODULE % 1)
+            tmp.write('daemon_target', '''
+                from daemon_macro import macros, f
+                value = f[0]
+            ''')
+            self.assertEqual(fresh_import('daemon_target').value, 1)
+            self.assertTrue(macropy.exporter.available)
+            # expanded by the daemon, not in this process
+            self.assertEqual(sys.modules['daemon_macro'].count, 0)
+
+            # served from the daemon's memory
+            source = open(os.path.join(tmp.path, 'daemon_target.py'),
+                          'rb').read()
+            code, deps = macropy.exporter.find(
+                'daemon_target', os.path.join(tmp.path, 'daemon_target.py'),
+                source)
+            self.assertEqual([name for name, origin, value in deps],
+                             ['daemon_macro'])
+
+            # a changed macro module is imported again by the daemon
+            tmp.write('daemon_macro', MACRO_MODULE % 2)
+            self.assertEqual(fresh_import('daemon_target').value, 2)
+            self.assertEqual(sys.modules['daemon_macro'].count, 0)
+
+    def test_import_path(self):
+        self.start_daemon()
+        macropy.exporter = daemon.DaemonExporter(self.socket)
+        target = '''
+            from daemon_macro import macros, f
+            value = f[0]
+        '''
+        # clients importing a macro module of the same name from different
+        # places get their own expansion
+        with TempModules() as first:
+            first.write('daemon_macro', MACRO_MODULE % 1)
+            first.write('daemon_target', target)
+            self.assertEqual(fresh_import('daemon_target').value, 1)
+            with TempModules() as second:
+                second.write('daemon_macro', MACRO_MODULE % 2)
+                second.write('daemon_target', target)
+                self.assertEqual(fresh_import('daemon_target').value, 2)
+                self.assertEqual(sys.modules['daemon_macro'].count, 0)
+
+        with TempModules() as tmp:
+            tmp.write('daemon_macro', MACRO_MODULE % 3)
+            filename = tmp.write('daemon_target', target)
+            with open(filename, 'rb') as f:
+                source = f.read()
+            self.assertIsNotNone(macropy.exporter.find(
+                'daemon_target', filename, source))
+            # this process uses another version of the macro module
+            other = tmp.write('other_macro', MACRO_MODULE % 4)
+            module = types.ModuleType('daemon_macro')
+            module.__file__ = other
+            sys.modules['daemon_macro'] = module
+            self.assertIsNone(macropy.exporter.find(
+                'daemon_target', filename, source))
+            self.assertTrue(macropy.exporter.available)
+
+    def test_socket_permissions(self):
+        server = daemon.ExpansionDaemon(self.socket)
+        try:
+            self.assertEqual(stat.S_IMODE(os.stat(self.socket).st_mode),
+                             0o600)
+        finally:
+            server.server_close()
+
+    def test_fallback(self):
+        macropy.exporter = daemon.DaemonExporter(self.socket)
+        with TempModules() as tmp:
+            tmp.write('daemon_macro', MACRO_MODULE % 3)
+            tmp.write('daemon_target', '''
+                from daemon_macro import macros, f
+                value = f[0]
+            ''')
+            # no daemon, expanded in process
+            self.assertEqual(fresh_import('daemon_target').value, 3)
+            self.assertFalse(macropy.exporter.available)
+            self.assertEqual(sys.modules['daemon_macro'].count, 1)
+
+    def test_stale_socket(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.socket)
+        sock.close()
+        server = daemon.ExpansionDaemon(self.socket)
+        try:
+            self.assertTrue(os.path.exists(self.socket))
+            with self.assertRaises(OSError):
+                daemon.ExpansionDaemon(self.socket)
+        finally:
+            server.server_close()
+        self.assertFalse(os.path.exists(self.socket))
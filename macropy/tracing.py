@@ -1,10 +1,10 @@
 # -*- coding: utf-8 -*-
 import ast
-import copy
 
 import macropy.core
 import macropy.core.macros
 import macropy.core.walkers
+from macropy.core import structure
 
 from macropy.core.quotes import ast_literal, u
 from macropy.core.hquotes import macros, hq, unhygienic
@@ -148,8 +148,7 @@ def trace(tree, exact_src, **kw):
 
 
 def require_transform(tree, exact_src):
-    ret = trace_walk_func(copy.deepcopy(tree), exact_src)
-    trace_walk_func(copy.deepcopy(tree), exact_src)
+    ret = trace_walk_func(structure.clone(tree), exact_src)
     new = hq[ast_literal[tree] or wrap_require(lambda log: ast_literal[ret])]
     return new
 